@@ -15,14 +15,29 @@ import shutil
 import string
 import gzip
 import random
+import tempfile
 from io import BytesIO
 from PIL import Image
 import pandas as pd
-import requests
 import yaml
 import markdown
 from huggingface_hub import snapshot_download, hf_hub_download, list_repo_files
-from hf_handler import HFHandler
+from hf_handler import HFHandler, SCAN_MAX_WORKERS
+from dataset_utils import (profile_dataset, is_profilable, sample_jsonl_records, RowCounter, AnalysisCache,
+                           profile_parquet, parquet_metadata_summary, external_dedup,
+                           PROFILE_CHUNK_ROWS, SAMPLE_ROWS)
+from prep_utils import (iter_clean, resolve_workers, can_shard, load_serialized_records,
+                        validate_sharded, validate_stream, InvalidEncoding,
+                        parse_split_ratios, split_output_paths, split_index_path, iter_split,
+                        parse_shard_options)
+from prep_pipeline import build_stages, iter_pipeline
+from tokenizer_utils import (TokenizerCache, TokenLengthCache, parse_warmup_list, iter_token_stats,
+                             TOKENIZER_WARMUP, DEFAULT_HISTOGRAM_BINS)
+from packing_utils import iter_pack, PACK_OVERFLOW_MODES
+from convert_utils import (InputTooLarge, FetchError, fetch_url_input, open_local_input,
+                           iter_parquet_jsonl, write_jsonl_parquet, PARQUET_BATCH_ROWS,
+                           collect_image_inputs, iter_batch_image_conversion, iter_images_zip,
+                           IMAGE_TARGET_FORMATS, ConversionCache)
 
 # Import security utilities
 try:
@@ -35,6 +50,12 @@ except ImportError:
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY') or os.urandom(32)
 hf_handler = HFHandler()
+conversion_cache = ConversionCache()
+row_counter = RowCounter()
+analysis_cache = AnalysisCache()
+tokenizer_cache = TokenizerCache()
+tokenizer_cache.warm_async(parse_warmup_list(TOKENIZER_WARMUP))
+token_length_cache = TokenLengthCache()
 
 progress_status = {"status": "Idle", "percentage": 0}
 
@@ -330,6 +351,48 @@ def hf_scan():
     else:
         return jsonify(result), 400
 
+@app.route('/api/hf_scan_batch', methods=['POST'])
+def hf_scan_batch():
+    data = request.json
+    repo_ids = data.get('repo_ids', [])
+    repo_type = data.get('repo_type', 'model')
+    token = data.get('token', '').strip() or None
+
+    if not repo_ids or not isinstance(repo_ids, list):
+        return jsonify({"error": "repo_ids must be a non-empty list"}), 400
+    # Checked here: scan_repos runs inside the stream, after the 200 has been sent
+    if not all(isinstance(r, str) for r in repo_ids):
+        return jsonify({"error": "repo_ids must contain only strings"}), 400
+    if not any(r.strip() for r in repo_ids):
+        return jsonify({"error": "repo_ids must contain at least one repo id"}), 400
+    if not isinstance(data.get('options') or {}, dict):
+        return jsonify({"error": "options must be an object"}), 400
+    try:
+        max_workers = int(str(data.get('max_workers', 8)))
+    except ValueError:
+        max_workers = 0
+    if max_workers < 1:
+        return jsonify({"error": "max_workers must be a positive integer"}), 400
+    max_workers = min(max_workers, SCAN_MAX_WORKERS)
+
+    return Response(stream_with_context(hf_handler.scan_repos(repo_ids, token, repo_type, data.get('options'), max_workers)), mimetype='application/json')
+
+@app.route('/api/hf_tree', methods=['POST'])
+def hf_tree():
+    data = request.json
+    repo_id = data.get('repo_id', '').strip()
+    repo_type = data.get('repo_type', 'model')
+    token = data.get('token', '').strip() or None
+    path = data.get('path', '')
+
+    if not repo_id: return jsonify({"error": "Repo ID is required"}), 400
+
+    result = hf_handler.list_folder(repo_id, path, token, repo_type, options=data.get('options'))
+    if result.get('success'):
+        return jsonify(result)
+    else:
+        return jsonify(result), 400
+
 @app.route('/api/hf_search', methods=['POST'])
 def hf_search():
     data = request.json
@@ -400,12 +463,12 @@ def get_file_info():
         
         # Estimate rows for certain file types
         estimated_rows = None
+        parquet_meta = None
         try:
             if extension == 'parquet':
                 # Read parquet metadata without loading full data
-                import pyarrow.parquet as pq
-                parquet_file = pq.ParquetFile(file_path)
-                estimated_rows = parquet_file.metadata.num_rows
+                parquet_meta = parquet_metadata_summary(file_path)
+                estimated_rows = parquet_meta["num_rows"]
             elif extension in ['csv']:
                 # Rough estimate for CSV
                 with open(file_path, 'rb') as f:
@@ -413,10 +476,9 @@ def get_file_info():
                     sample = f.read(1024 * 1024)
                     avg_line_length = len(sample) / sample.count(b'\n') if sample.count(b'\n') > 0 else 100
                     estimated_rows = int(file_size / avg_line_length)
-            elif extension in ['jsonl']:
-                # Count lines (limit to first 10000 for speed)
-                with open(file_path, 'rb') as f:
-                    estimated_rows = sum(1 for _ in f)
+            elif extension in ['jsonl'] or file_name.lower().endswith('.jsonl.gz'):
+                # Exact line count: block scan, cached by (path, size, mtime)
+                estimated_rows, _ = row_counter.count(file_path)
             elif extension in ['json']:
                 # Try to count array items
                 with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
@@ -431,7 +493,8 @@ def get_file_info():
             "size": file_size,
             "extension": extension,
             "estimated_rows": _formatNumber(estimated_rows) if estimated_rows else '-',
-            "modified_time": stat.st_mtime
+            "modified_time": stat.st_mtime,
+            "parquet": parquet_meta
         })
         
     except Exception as e:
@@ -449,40 +512,46 @@ def _formatNumber(num):
 
 @app.route('/api/convert', methods=['POST'])
 def convert_api():
+    source = None
     try:
         data = request.json
         mode = data.get('mode', 'url')
         category = data.get('category')
         target_format = data.get('target_format')
         
-        content_bytes = None
-        content_text = None
-        input_filename = "unknown"
-
-        if mode == 'url':
-            url = data.get('url')
-            input_filename = url.split('/')[-1]
-            resp = requests.get(url, headers={'User-Agent': 'Mozilla/5.0'}, stream=True)
-            if resp.status_code != 200: return jsonify({"error": "Fetch failed"}), 400
-            content_bytes = resp.content
-            try: content_text = resp.text
-            except: pass
-            
-        elif mode == 'local':
-            file_path = data.get('file_path')
-            if not os.path.exists(file_path): return jsonify({"error": "File not found"}), 404
-            input_filename = os.path.basename(file_path)
-            with open(file_path, 'rb') as f: content_bytes = f.read()
-            try: 
-                with open(file_path, 'r', encoding='utf-8') as f: content_text = f.read()
-            except: pass
+        max_bytes = parse_size(data['max_size']) if data.get('max_size') else None
+
+        try:
+            if mode == 'url':
+                source = fetch_url_input(data.get('url'), max_bytes)
+            elif mode == 'local':
+                file_path = data.get('file_path')
+                if not file_path or not os.path.exists(file_path): return jsonify({"error": "File not found"}), 404
+                source = open_local_input(file_path, max_bytes)
+            else:
+                return jsonify({"error": "Invalid mode"}), 400
+        except InputTooLarge as e:
+            return jsonify({"error": str(e)}), 413
+        except FetchError:
+            return jsonify({"error": "Fetch failed"}), 400
+        input_filename = source.filename
+
+        # Repeated conversions of identical content are served from the cache
+        cache_key = None
+        if category in ('image', 'data', 'document') and data.get('cache', True):
+            ext = input_filename.split('.')[-1].lower() if '.' in input_filename else ''
+            cache_key = ConversionCache.make_key(source.content_hash(), ext, category, target_format)
+            cached = conversion_cache.get(cache_key)
+            if cached:
+                cached_file, mimetype, filename = cached
+                return send_file(cached_file, mimetype=mimetype, as_attachment=True, download_name=filename)
         
         output_io = BytesIO()
         filename = "converted"
         mimetype = "application/octet-stream"
 
         if category == 'image':
-            image = Image.open(BytesIO(content_bytes))
+            image = Image.open(source.handle())
             if target_format in ['jpeg', 'pdf'] and image.mode in ("RGBA", "P"):
                 image = image.convert("RGB")
             
@@ -496,13 +565,13 @@ def convert_api():
             ext = input_filename.split('.')[-1].lower() if '.' in input_filename else ''
             
             if ext in ['xlsx', 'xls']:
-                parsed = pd.read_excel(BytesIO(content_bytes)).to_dict(orient='records')
+                parsed = pd.read_excel(source.handle()).to_dict(orient='records')
             elif ext == 'csv':
-                parsed = pd.read_csv(BytesIO(content_bytes)).to_dict(orient='records')
-            elif content_text:
-                try: parsed = json.loads(content_text)
+                parsed = pd.read_csv(source.handle()).to_dict(orient='records')
+            elif source.text():
+                try: parsed = json.loads(source.text())
                 except: 
-                    try: parsed = yaml.safe_load(content_text)
+                    try: parsed = yaml.safe_load(source.text())
                     except: pass
             
             if parsed is None: return jsonify({"error": "Parse error"}), 400
@@ -527,7 +596,7 @@ def convert_api():
         elif category == 'document':
             ext = input_filename.split('.')[-1].lower() if '.' in input_filename else ''
             if ext in ['xlsx', 'xls', 'csv']:
-                df = pd.read_csv(BytesIO(content_bytes)) if ext == 'csv' else pd.read_excel(BytesIO(content_bytes))
+                df = pd.read_csv(source.handle()) if ext == 'csv' else pd.read_excel(source.handle())
                 if target_format == 'markdown':
                     output_io.write(df.to_markdown(index=False).encode('utf-8'))
                     filename = "table.md"
@@ -535,53 +604,132 @@ def convert_api():
                     html = f"<html><link href='https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css' rel='stylesheet'><body class='p-4'>{df.to_html(classes='table table-bordered', index=False)}</body></html>"
                     output_io.write(html.encode('utf-8'))
                     filename = "table.html"
-            elif content_text and target_format == 'html':
-                html = markdown.markdown(content_text, extensions=['tables'])
+            elif source.text() and target_format == 'html':
+                html = markdown.markdown(source.text(), extensions=['tables'])
                 output_io.write(f"<html><body>{html}</body></html>".encode('utf-8'))
                 filename = "doc.html"
-            elif content_text and target_format == 'markdown':
-                output_io.write(content_text.encode('utf-8'))
+            elif source.text() and target_format == 'markdown':
+                output_io.write(source.text().encode('utf-8'))
                 filename = "doc.md"
             else: return jsonify({"error": "Unsupported doc conversion"}), 400
 
         elif category == 'parquet':
             ext = input_filename.split('.')[-1].lower() if '.' in input_filename else ''
+            if target_format == 'parquet':
+                if not input_filename.lower().endswith(('.jsonl', '.jsonl.gz')):
+                    return jsonify({"error": "Invalid file format. Expected .jsonl or .jsonl.gz file"}), 400
+                out_file = tempfile.TemporaryFile()
+                try:
+                    write_jsonl_parquet(
+                        source, out_file, input_filename.lower().endswith('.gz'),
+                        batch_rows=int(data.get('batch_rows', PARQUET_BATCH_ROWS)),
+                        row_group_size=int(data['row_group_size']) if data.get('row_group_size') else None,
+                        compression=data.get('compression', 'snappy')
+                    )
+                except Exception as e:
+                    out_file.close()
+                    return jsonify({"error": f"Parquet processing failed: {str(e)}"}), 500
+                out_file.seek(0)
+                return send_file(out_file, mimetype="application/vnd.apache.parquet", as_attachment=True, download_name="data.parquet")
+
             if ext != 'parquet':
                 return jsonify({"error": "Invalid file format. Expected .parquet file"}), 400
             
+            if target_format not in ('jsonl', 'jsonl.gz'):
+                return jsonify({"error": "Unsupported parquet conversion format"}), 400
+
+            compress = target_format == 'jsonl.gz' or bool(data.get('compress'))
+            batch_rows = int(data.get('batch_rows', PARQUET_BATCH_ROWS))
             try:
-                # Read parquet file using pandas
-                df = pd.read_parquet(BytesIO(content_bytes))
-                
-                if target_format == 'jsonl':
-                    # Convert DataFrame to JSON Lines format
-                    jsonl_lines = []
-                    for _, row in df.iterrows():
-                        # Convert row to dict and handle non-serializable types
-                        row_dict = row.to_dict()
-                        # Convert numpy types to python native types
-                        for key, value in row_dict.items():
-                            if hasattr(value, 'item'):  # numpy scalar
-                                row_dict[key] = value.item()
-                            elif isinstance(value, (pd.Timestamp, pd.NaT)):
-                                row_dict[key] = str(value) if pd.notna(value) else None
-                            elif pd.isna(value):
-                                row_dict[key] = None
-                        jsonl_lines.append(json.dumps(row_dict, ensure_ascii=False))
-                    
-                    output_io.write('\n'.join(jsonl_lines).encode('utf-8'))
-                    mimetype = "application/jsonlines"
-                    filename = "data.jsonl"
-                else:
-                    return jsonify({"error": "Unsupported parquet conversion format"}), 400
+                chunks = iter_parquet_jsonl(source.handle(), batch_rows, compress)
             except Exception as e:
                 return jsonify({"error": f"Parquet processing failed: {str(e)}"}), 500
+            parquet_source, source = source, None  # closed by the generator below
+
+            def generate():
+                try:
+                    yield from chunks
+                finally:
+                    parquet_source.close()
 
+            response = Response(stream_with_context(generate()),
+                                mimetype="application/gzip" if compress else "application/jsonlines")
+            response.headers['Content-Disposition'] = f'attachment; filename="{"data.jsonl.gz" if compress else "data.jsonl"}"'
+            return response
+
+        if cache_key:
+            conversion_cache.put(cache_key, output_io.getvalue(), mimetype, filename)
         output_io.seek(0)
         return send_file(output_io, mimetype=mimetype, as_attachment=True, download_name=filename)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    finally:
+        if source is not None:
+            source.close()
+
+@app.route('/api/convert/images', methods=['POST'])
+def convert_images_batch():
+    """Batch image conversion on a process pool; streams a zip or writes to output_dir"""
+    try:
+        data = request.json
+        files = data.get('files') or []
+        input_dir = data.get('input_dir')
+        output_dir = data.get('output_dir')
+        target_format = (data.get('target_format') or 'jpeg').lower()
+        max_size = data.get('max_size')  # [width, height] to downscale into
+        quality = data.get('quality')
+        workers = data.get('workers')
+
+        if not files and not input_dir:
+            return jsonify({"error": "Provide files or input_dir"}), 400
+        if input_dir and not os.path.isdir(input_dir):
+            return jsonify({"error": "Input directory not found"}), 404
+        missing = [f for f in files if not os.path.isfile(f)]
+        if missing:
+            return jsonify({"error": f"File not found: {missing[0]}"}), 404
+        if target_format not in IMAGE_TARGET_FORMATS:
+            return jsonify({"error": f"target_format must be one of {', '.join(IMAGE_TARGET_FORMATS)}"}), 400
+        if max_size and (not isinstance(max_size, list) or len(max_size) != 2
+                         or not all(isinstance(v, int) and not isinstance(v, bool) and v > 0 for v in max_size)):
+            return jsonify({"error": "max_size must be [width, height] of positive integers"}), 400
+        if quality is not None and (not isinstance(quality, int) or isinstance(quality, bool)
+                                    or not 1 <= quality <= 100):
+            return jsonify({"error": "quality must be an integer from 1 to 100"}), 400
+        try:
+            workers = resolve_workers(workers)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        inputs = collect_image_inputs(target_format, files, input_dir, data.get('recursive', True))
+        if not inputs:
+            return jsonify({"error": "No images found"}), 400
+
+        if not output_dir:
+            results = iter_batch_image_conversion(inputs, target_format, None, max_size, quality, workers)
+            response = Response(stream_with_context(iter_images_zip(results)), mimetype="application/zip")
+            response.headers['Content-Disposition'] = 'attachment; filename="images.zip"'
+            return response
+
+        os.makedirs(output_dir, exist_ok=True)
+
+        def generate():
+            total = len(inputs)
+            yield json.dumps({"type": "start", "total_files": total, "message": f"Converting {total} images..."}) + "\n"
+            done = failed = 0
+            for src, rel_out, _, error in iter_batch_image_conversion(inputs, target_format, output_dir, max_size, quality, workers):
+                done += 1
+                if error:
+                    failed += 1
+                    yield json.dumps({"type": "error", "file": src, "message": error}) + "\n"
+                if done % 500 == 0:
+                    yield json.dumps({"type": "progress", "completed": done, "total_files": total}) + "\n"
+            yield json.dumps({"type": "done", "total_files": total, "converted": done - failed,
+                              "failed": failed, "output_dir": output_dir}) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype='application/json')
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
 @app.route('/intelligence/<mode>')
 def intelligence_page(mode):
@@ -597,65 +745,27 @@ def analyze_dataset():
         if not file_path or not os.path.exists(file_path): 
             return jsonify({"error": "File not found"}), 404
         
-        file_path_lower = file_path.lower()
-        is_gz = file_path_lower.endswith('.gz')
-        df = None
-        total_rows = 0
-
-        # Format detection
-        if file_path_lower.endswith('.csv'):
-            df = pd.read_csv(file_path)
-            total_rows = len(df)
-        elif file_path_lower.endswith(('.xlsx', '.xls')):
-            df = pd.read_excel(file_path)
-            total_rows = len(df)
-        elif file_path_lower.endswith('.json') and not file_path_lower.endswith('.jsonl'):
-            df = pd.read_json(file_path)
-            total_rows = len(df)
-        elif file_path_lower.endswith('.jsonl') or file_path_lower.endswith('.jsonl.gz'):
-            import gzip
-            open_func = gzip.open if is_gz else open
-            mode = 'rt' if is_gz else 'r'
-            
-            records = []
-            with open_func(file_path, mode, encoding='utf-8', errors='replace') as f:
-                for i, line in enumerate(f):
-                    if i < 1000:
-                        try:
-                            line_data = json.loads(line)
-                            if line_data: records.append(line_data)
-                        except: pass
-                    else: break
-            
-            if records:
-                df = pd.DataFrame(records)
-                # Count total lines efficiently
-                with open_func(file_path, mode, encoding='utf-8', errors='replace') as f:
-                    total_rows = sum(1 for _ in f)
-            else:
-                return jsonify({"error": "Could not parse any valid JSON objects from file"}), 400
-        
-        if df is None:
+        if file_path.lower().endswith('.parquet'):
+            # Footer metadata and row-group statistics only; row data is never scanned
+            sample_size = int(data.get('sample_size', SAMPLE_ROWS))
+            return jsonify(profile_parquet(file_path, sample_size))
+
+        if not is_profilable(file_path):
             return jsonify({"error": "Unsupported or unrecognized dataset format"}), 400
 
-        # Safe duplicate detection (JSONL often has dicts/lists which are unhashable)
-        duplicates = 0
-        try:
-            duplicates = int(df.duplicated().sum())
-        except TypeError:
-            try:
-                duplicates = int(df.astype(str).duplicated().sum())
-            except:
-                duplicates = "Unsupported (Nested Data)"
-
-        analysis = {
-            "total_rows": total_rows,
-            "columns": list(df.columns),
-            "duplicates": duplicates,
-            "null_values": int(df.isnull().sum().sum()),
-            "memory_usage": f"{os.path.getsize(file_path) / 1024**2:.2f} MB",
-            "sample": df.head(5).to_dict(orient='records')
-        }
+        # Streaming profile: constant memory regardless of file size
+        chunk_rows = int(data.get('chunk_rows', PROFILE_CHUNK_ROWS))
+        sample_size = int(data.get('sample_size', SAMPLE_ROWS))
+        sample_mode = data.get('sample_mode', 'head')
+        if sample_mode not in ('head', 'reservoir', 'seek'):
+            return jsonify({"error": "sample_mode must be head, reservoir or seek"}), 400
+        if data.get('cache', True):
+            analysis, cache_status = analysis_cache.analyze(file_path, chunk_rows, sample_size, sample_mode)
+            analysis = {**analysis, "cache": cache_status}
+        else:
+            analysis = profile_dataset(file_path, chunk_rows, sample_size, sample_mode)
+        if not analysis["columns"]:
+            return jsonify({"error": "Could not parse any valid records from file"}), 400
         return jsonify(analysis)
     except Exception as e:
         import traceback
@@ -668,7 +778,23 @@ def clean_dataset():
         data = request.json
         file_path = data.get('path')
         if not os.path.exists(file_path): return jsonify({"error": "File not found"}), 404
-        
+
+        if data.get('mode', 'memory') == 'external':
+            # Out-of-core: hash-partitioned spill files, deduplicated one partition at a time
+            if not file_path.lower().endswith(('.csv', '.csv.gz', '.json', '.jsonl', '.jsonl.gz')):
+                return jsonify({"error": "External mode supports CSV, JSON and JSONL"}), 400
+            base = file_path[:-3] if file_path.lower().endswith('.gz') else file_path
+            root, ext = os.path.splitext(base)
+            output_path = f"{root}_cleaned{ext}"
+            partitions = data.get('partitions')
+            try:
+                result = external_dedup(file_path, output_path,
+                                        partitions=int(partitions) if partitions else None,
+                                        keep_order=bool(data.get('keep_order', True)))
+            except OSError as save_err:
+                return jsonify({"error": f"Failed to write cleaned file to disk: {str(save_err)}"}), 500
+            return jsonify({"success": True, **result, "saved_to": output_path})
+
         ext = file_path.split('.')[-1].lower()
         if ext == 'csv': df = pd.read_csv(file_path)
         elif ext == 'json': df = pd.read_json(file_path)
@@ -784,6 +910,23 @@ def preview_jsonl():
             
         preview_data = []
         is_gz = file_path.lower().endswith('.gz')
+        sample = data.get('sample', 'head')
+        
+        if sample in ('reservoir', 'seek'):
+            # Representative preview drawn from the whole file instead of its head
+            try:
+                preview_data = sample_jsonl_records(file_path, lines_to_read, sample, data.get('seed'))
+            except Exception as e:
+                return jsonify({"error": f"Failed to read file: {str(e)}"}), 500
+            return jsonify({
+                "success": True,
+                "filename": os.path.basename(file_path),
+                "preview": preview_data,
+                "total_previewed": len(preview_data),
+                "file_size": os.path.getsize(file_path),
+                "is_compressed": is_gz,
+                "sample": sample
+            })
         
         try:
             import gzip
@@ -841,78 +984,7 @@ def prep_clean():
             return jsonify({"error": "Input file not found"}), 404
         
         is_gz = input_path.lower().endswith('.gz')
-        open_func = gzip.open if is_gz else open
-        mode = 'rt' if is_gz else 'r'
-        
-        records = []
-        errors = []
-        
-        # Read all records
-        with open_func(input_path, mode, encoding='utf-8', errors='replace') as f:
-            for i, line in enumerate(f):
-                try:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    record = json.loads(line)
-                    records.append(record)
-                except json.JSONDecodeError as e:
-                    errors.append({"line": i + 1, "error": str(e)})
-        
-        initial_count = len(records)
-        
-        # Apply cleaning operations
-        cleaned_records = records.copy()
-        
-        # 1. Remove duplicates (convert to string for comparison)
-        if options.get('remove_duplicates', True):
-            seen = set()
-            unique_records = []
-            for record in cleaned_records:
-                record_str = json.dumps(record, sort_keys=True)
-                if record_str not in seen:
-                    seen.add(record_str)
-                    unique_records.append(record)
-            cleaned_records = unique_records
-        
-        # 2. Handle nulls - filter out records with all null values
-        if options.get('handle_nulls', True):
-            def has_valid_data(record):
-                if not record:
-                    return False
-                for v in record.values():
-                    if v is not None and v != '' and v != [] and v != {}:
-                        return True
-                return False
-            cleaned_records = [r for r in cleaned_records if has_valid_data(r)]
-        
-        # 3. Normalize text fields
-        if options.get('normalize_text', True):
-            for record in cleaned_records:
-                for key, value in record.items():
-                    if isinstance(value, str):
-                        record[key] = value.strip()
-        
-        # 4. Remove special characters
-        if options.get('remove_special_chars', False):
-            import re
-            for record in cleaned_records:
-                for key, value in record.items():
-                    if isinstance(value, str):
-                        record[key] = re.sub(r'[^\w\s-]', '', value)
-        
-        # 5. Filter by minimum length
-        if options.get('filter_min_length', False):
-            min_length = options.get('min_length', 10)
-            cleaned_records = [
-                r for r in cleaned_records 
-                if any(len(str(v)) >= min_length for v in r.values() if isinstance(v, str))
-            ]
-        
-        final_count = len(cleaned_records)
-        removed_count = initial_count - final_count
-        reduction_percent = round((removed_count / initial_count * 100), 2) if initial_count > 0 else 0
-        
+
         # Determine output path
         if not output_path:
             base, ext = os.path.splitext(input_path)
@@ -921,28 +993,32 @@ def prep_clean():
                 output_path = f"{base}_cleaned.jsonl.gz"
             else:
                 output_path = f"{base}_cleaned.jsonl"
-        
-        # Write cleaned data
-        os.makedirs(os.path.dirname(os.path.abspath(output_path)) or '.', exist_ok=True)
-        
-        if output_path.lower().endswith('.gz'):
-            with gzip.open(output_path, 'wt', encoding='utf-8') as f:
-                for record in cleaned_records:
-                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
-        else:
-            with open(output_path, 'w', encoding='utf-8') as f:
-                for record in cleaned_records:
-                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
-        
-        return jsonify({
-            "success": True,
-            "initial_count": initial_count,
-            "final_count": final_count,
-            "removed_count": removed_count,
-            "reduction_percent": reduction_percent,
-            "output_path": output_path,
-            "parse_errors": len(errors)
-        })
+
+        if options.get('near_dedup') and options.get('near_dedup_shingle', 'char') not in ('char', 'word'):
+            return jsonify({"error": "near_dedup_shingle must be char or word"}), 400
+
+        # Single streaming pass: parse -> filter -> normalize -> dedup -> write
+        try:
+            shards = parse_shard_options(data.get('shards'))
+            workers = resolve_workers(data.get('workers', 1))
+        except (ValueError, TypeError) as e:
+            return jsonify({"error": str(e)}), 400
+
+        events = iter_clean(input_path, output_path, options, workers, shards)
+        if data.get('stream', False):
+            def generate():
+                try:
+                    for event in events:
+                        yield json.dumps(event) + "\n"
+                except Exception as e:
+                    yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+            return Response(stream_with_context(generate()), mimetype='application/json')
+
+        summary = None
+        for summary in events:
+            pass
+        summary.pop("type")
+        return jsonify(summary)
         
     except Exception as e:
         import traceback
@@ -952,7 +1028,12 @@ def prep_clean():
 
 @app.route('/api/prep/split', methods=['POST'])
 def prep_split():
-    """Data Splitting: membagi data menjadi training dan validation set"""
+    """
+    Data Splitting: membagi data menjadi train/validation.
+    mode 'shuffle' (default) memuat dan mengacak semua record di memori;
+    mode 'hash' (opt-in) streaming, membagi ke split bernama (splits) dengan
+    hash ber-seed per record atau key_field, dan mendukung shards.
+    """
     try:
         data = request.json
         input_path = data.get('input_path')
@@ -965,20 +1046,56 @@ def prep_split():
             return jsonify({"error": "Input file not found"}), 404
         
         is_gz = input_path.lower().endswith('.gz')
-        open_func = gzip.open if is_gz else open
-        mode = 'rt' if is_gz else 'r'
-        
-        # Read all records
-        records = []
-        with open_func(input_path, mode, encoding='utf-8', errors='replace') as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    records.append(json.loads(line))
-                except:
-                    pass
+        try:
+            workers = resolve_workers(data.get('workers', 1))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        mode = data.get('mode', 'shuffle')
+        if mode not in ('shuffle', 'hash'):
+            return jsonify({"error": "mode must be 'shuffle' or 'hash'"}), 400
+
+        if mode == 'hash':
+            if 'shuffle' in data:
+                return jsonify({"error": "shuffle is not supported with mode 'hash'; assignment is by seeded hash"}), 400
+            # Streaming: each record goes to a split by seeded hash of the record (or key_field)
+            try:
+                splits = parse_split_ratios(data.get('splits'), train_ratio)
+                shards = parse_shard_options(data.get('shards'))
+            except (ValueError, TypeError) as e:
+                return jsonify({"error": str(e)}), 400
+            files = split_output_paths(input_path, output_dir, splits)
+            events = iter_split(input_path, files, splits, random_seed, data.get('key_field'), workers,
+                                shards, split_index_path(input_path, output_dir))
+            if data.get('stream', False):
+                def generate():
+                    try:
+                        for event in events:
+                            yield json.dumps(event) + "\n"
+                    except Exception as e:
+                        yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+                return Response(stream_with_context(generate()), mimetype='application/json')
+            
+            summary = None
+            for summary in events:
+                pass
+            summary.pop("type")
+            if summary["total_count"] == 0:
+                return jsonify({"error": "No valid records found in file"}), 400
+            for name, key in (("train", "train"), ("validation", "val")):
+                if name in summary["splits"]:
+                    summary[f"{key}_count"] = summary["splits"][name]["count"]
+                    summary[f"{key}_percent"] = summary["splits"][name]["percent"]
+                    summary[f"{key}_file"] = summary["splits"][name]["file"]
+            return jsonify(summary)
+        
+        # mode == 'shuffle': in-memory shuffle and slice into train/validation
+        for option in ('shards', 'splits', 'key_field'):
+            if data.get(option):
+                return jsonify({"error": f"{option} is only supported with mode 'hash'"}), 400
+
+        # Read all records (kept serialized; parsed on a process pool when workers > 1)
+        records = load_serialized_records(input_path, workers)
         
         total_count = len(records)
         if total_count == 0:
@@ -1013,12 +1130,12 @@ def prep_split():
         # Write train file
         with open(train_file, 'w', encoding='utf-8') as f:
             for record in train_records:
-                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                f.write(record + '\n')
         
         # Write validation file
         with open(val_file, 'w', encoding='utf-8') as f:
             for record in val_records:
-                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                f.write(record + '\n')
         
         return jsonify({
             "success": True,
@@ -1044,6 +1161,7 @@ def prep_tokenize():
         data = request.json
         input_path = data.get('input_path')
         model_base = data.get('model_base', 'Qwen/Qwen2-7B-Instruct')
+        revision = data.get('revision')
         text_field = data.get('text_field', 'text')
         calc_max_length = data.get('calc_max_length', True)
         calc_avg_length = data.get('calc_avg_length', True)
@@ -1053,18 +1171,43 @@ def prep_tokenize():
         if not input_path or not os.path.exists(input_path):
             return jsonify({"error": "Input file not found"}), 404
         
-        # Try to import transformers
+        # Load tokenizer (kept in a process-wide cache between requests)
         try:
-            from transformers import AutoTokenizer
+            tokenizer, tokenizer_cache_status = tokenizer_cache.get(model_base, revision)
         except ImportError:
             return jsonify({"error": "transformers library not installed. Run: pip install transformers"}), 500
-        
-        # Load tokenizer
-        try:
-            tokenizer = AutoTokenizer.from_pretrained(model_base, trust_remote_code=True)
         except Exception as e:
             return jsonify({"error": f"Failed to load tokenizer: {str(e)}"}), 500
         
+        if data.get('mode') == 'full':
+            # Whole dataset: batched tokenization with histogram and percentiles
+            bins = data.get('histogram_bins', DEFAULT_HISTOGRAM_BINS)
+            preview = 5 if preview_tokens else 0
+            if data.get('sidecar', False):
+                # Reuse / extend persisted per-record token lengths
+                events = token_length_cache.iter_stats(input_path, tokenizer, model_base, revision, text_field,
+                                                       data.get('max_length'), bins, preview)
+            else:
+                events = iter_token_stats(input_path, tokenizer, text_field, data.get('max_length'), bins,
+                                          preview=preview)
+            if data.get('stream', False):
+                def generate():
+                    try:
+                        for event in events:
+                            if event["type"] == "done":
+                                event.update({"tokenizer": model_base, "tokenizer_cache": tokenizer_cache_status})
+                            yield json.dumps(event) + "\n"
+                    except Exception as e:
+                        yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+                return Response(stream_with_context(generate()), mimetype='application/json')
+            
+            result = None
+            for result in events:
+                pass
+            result.pop("type")
+            result.update({"tokenizer": model_base, "tokenizer_cache": tokenizer_cache_status})
+            return jsonify(result)
+        
         is_gz = input_path.lower().endswith('.gz')
         open_func = gzip.open if is_gz else open
         mode = 'rt' if is_gz else 'r'
@@ -1111,7 +1254,8 @@ def prep_tokenize():
             "success": True,
             "tokenizer": model_base,
             "record_count": len(records),
-            "text_field": text_field
+            "text_field": text_field,
+            "tokenizer_cache": tokenizer_cache_status
         }
         
         if token_counts:
@@ -1142,99 +1286,181 @@ def prep_validate():
     try:
         data = request.json
         input_path = data.get('input_path')
-        validate_json = data.get('validate_json', True)
-        validate_fields = data.get('validate_fields', True)
-        validate_types = data.get('validate_types', False)
-        validate_encoding = data.get('validate_encoding', True)
-        required_fields = data.get('required_fields', [])
         max_records = data.get('max_records', 0)
+        max_errors = data.get('max_errors', 0)
         
         if not input_path or not os.path.exists(input_path):
             return jsonify({"error": "Input file not found"}), 404
         
-        is_gz = input_path.lower().endswith('.gz')
-        open_func = gzip.open if is_gz else open
-        mode = 'rt' if is_gz else 'r'
-        
-        total_count = 0
-        valid_count = 0
-        invalid_count = 0
-        errors = []
+        # Whole-file runs on uncompressed input can be split across processes
+        try:
+            workers = resolve_workers(data.get('workers', 1))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        try:
+            if max_records <= 0 and max_errors <= 0 and can_shard(input_path, workers):
+                return jsonify(validate_sharded(input_path, data, workers))
+            # One streaming pass: encoding, JSON, fields and types per line, stopping early if asked
+            return jsonify(validate_stream(input_path, data, max_records, max_errors))
+        except InvalidEncoding as e:
+            return jsonify({"error": str(e)}), 400
         
-        # Detect encoding if needed
-        if validate_encoding and not is_gz:
+    except Exception as e:
+        import traceback
+        print(traceback.format_exc())
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/prep/pack', methods=['POST'])
+def prep_pack():
+    """Sequence Packing: menyusun record ke dalam sequence sepanjang max_length untuk fine-tuning"""
+    try:
+        data = request.json
+        input_path = data.get('input_path')
+        output_path = data.get('output_path')
+        model_base = data.get('model_base', 'Qwen/Qwen2-7B-Instruct')
+        revision = data.get('revision')
+        text_field = data.get('text_field', 'text')
+        overflow = data.get('overflow', 'truncate')
+
+        if not input_path or not os.path.exists(input_path):
+            return jsonify({"error": "Input file not found"}), 404
+        try:
+            max_length = int(data.get('max_length', 2048))
+            batch_size = int(data.get('batch_size', 1))
+            epochs = int(data.get('epochs', 1))
+        except (ValueError, TypeError):
+            return jsonify({"error": "max_length, batch_size and epochs must be integers"}), 400
+        if max_length < 1:
+            return jsonify({"error": "max_length must be positive"}), 400
+        if overflow not in PACK_OVERFLOW_MODES:
+            return jsonify({"error": f"overflow must be one of {', '.join(PACK_OVERFLOW_MODES)}"}), 400
+
+        # Token lengths come from the sidecar; the tokenizer is only needed when it is missing or stale
+        tokenizer = None
+        if token_length_cache.load(input_path, model_base, revision, text_field) is None:
             try:
-                with open(input_path, 'rb') as f:
-                    raw_data = f.read()
-                    try:
-                        raw_data.decode('utf-8')
-                    except UnicodeDecodeError:
-                        return jsonify({"error": "File is not valid UTF-8 encoded"}), 400
+                tokenizer, _ = tokenizer_cache.get(model_base, revision)
+            except ImportError:
+                return jsonify({"error": "transformers library not installed. Run: pip install transformers"}), 500
             except Exception as e:
-                return jsonify({"error": f"Encoding validation failed: {str(e)}"}), 500
+                return jsonify({"error": f"Failed to load tokenizer: {str(e)}"}), 500
+
+        def load_tokenizer():
+            return tokenizer or tokenizer_cache.get(model_base, revision)[0]
+
+        def events():
+            # Tokenization progress (if any), then packing progress and the report
+            lengths, _, token_cache_status, _ = yield from token_length_cache.iter_lengths(
+                input_path, load_tokenizer, model_base, revision, text_field)
+            for event in iter_pack(input_path, lengths, max_length, overflow, batch_size, epochs, output_path):
+                if event["type"] == "done":
+                    event.update({"tokenizer": model_base, "text_field": text_field, "token_cache": token_cache_status})
+                yield event
+
+        if data.get('stream', False):
+            def generate():
+                try:
+                    for event in events():
+                        yield json.dumps(event) + "\n"
+                except Exception as e:
+                    yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+            return Response(stream_with_context(generate()), mimetype='application/json')
+
+        report = None
+        for report in events():
+            pass
+        report.pop("type")
+        return jsonify(report)
+
+    except Exception as e:
+        import traceback
+        print(traceback.format_exc())
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/prep/pipeline', methods=['POST'])
+def prep_pipeline():
+    """Pipeline: menjalankan validate, clean, filter, tokenize dan split dalam satu kali baca"""
+    try:
+        data = request.json
+        input_path = data.get('input_path')
+        output_path = data.get('output_path')
+
+        if not input_path or not os.path.exists(input_path):
+            return jsonify({"error": "Input file not found"}), 404
+
+        def load_tokenizer(model_base, revision=None):
+            try:
+                return tokenizer_cache.get(model_base, revision)[0]
+            except ImportError:
+                raise RuntimeError("transformers library not installed. Run: pip install transformers")
+
+        try:
+            stages = build_stages(data.get('stages', []), input_path, load_tokenizer)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": f"Failed to build pipeline: {str(e)}"}), 500
+
+        events = iter_pipeline(input_path, stages, output_path)
+        if data.get('stream', False):
+            def generate():
+                try:
+                    for event in events:
+                        yield json.dumps(event) + "\n"
+                except Exception as e:
+                    yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+            return Response(stream_with_context(generate()), mimetype='application/json')
+
+        report = None
+        for report in events:
+            pass
+        report.pop("type")
+        return jsonify(report)
+
+    except Exception as e:
+        import traceback
+        print(traceback.format_exc())
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/prep/to_parquet', methods=['POST'])
+def prep_to_parquet():
+    """Parquet Export: mengkonversi JSONL/JSONL.gz ke Parquet secara streaming"""
+    try:
+        data = request.json
+        input_path = data.get('input_path')
+        output_path = data.get('output_path')
+        batch_rows = int(data.get('batch_rows', PARQUET_BATCH_ROWS))
+        row_group_size = int(data.get('row_group_size', 0)) or None
+        compression = data.get('compression', 'snappy')
+        schema_sample_rows = int(data.get('schema_sample_rows', 0))
         
-        with open_func(input_path, mode, encoding='utf-8', errors='replace') as f:
-            for i, line in enumerate(f):
-                if max_records > 0 and i >= max_records:
-                    break
-                
-                total_count += 1
-                line_num = i + 1
-                line_errors = []
-                
-                # Check if line is empty
-                if not line.strip():
-                    invalid_count += 1
-                    errors.append({"line": line_num, "message": "Empty line"})
-                    continue
-                
-                # Validate JSON syntax
-                if validate_json:
-                    try:
-                        record = json.loads(line)
-                    except json.JSONDecodeError as e:
-                        invalid_count += 1
-                        errors.append({"line": line_num, "message": f"Invalid JSON: {str(e)}"})
-                        continue
-                else:
-                    try:
-                        record = json.loads(line)
-                    except:
-                        invalid_count += 1
-                        continue
-                
-                # Validate required fields
-                if validate_fields and required_fields:
-                    missing_fields = [f for f in required_fields if f not in record]
-                    if missing_fields:
-                        line_errors.append(f"Missing fields: {', '.join(missing_fields)}")
-                
-                # Validate data types (basic check)
-                if validate_types and record:
-                    for key, value in record.items():
-                        if value is not None and not isinstance(value, (str, int, float, bool, list, dict)):
-                            line_errors.append(f"Field '{key}' has unsupported type: {type(value).__name__}")
-                
-                if line_errors:
-                    invalid_count += 1
-                    for err in line_errors[:3]:  # Limit errors per line
-                        errors.append({"line": line_num, "message": err})
-                else:
-                    valid_count += 1
+        if not input_path or not os.path.exists(input_path):
+            return jsonify({"error": "Input file not found"}), 404
+        
+        is_gz = input_path.lower().endswith('.gz')
+        
+        # Determine output path
+        if not output_path:
+            base = input_path[:-3] if is_gz else input_path
+            base, _ = os.path.splitext(base)
+            output_path = f"{base}.parquet"
         
-        success_rate = round(valid_count / total_count * 100, 2) if total_count > 0 else 0
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)) or '.', exist_ok=True)
         
-        # Limit error display
-        display_errors = errors[:50]  # Show max 50 errors
+        try:
+            stats = write_jsonl_parquet(input_path, output_path, is_gz, batch_rows, row_group_size,
+                                        compression, schema_sample_rows)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
         return jsonify({
             "success": True,
-            "total_count": total_count,
-            "valid_count": valid_count,
-            "invalid_count": invalid_count,
-            "success_rate": success_rate,
-            "errors": display_errors,
-            "total_errors": len(errors)
+            "output_path": output_path,
+            "output_size": os.path.getsize(output_path),
+            **stats
         })
         
     except Exception as e:
@@ -1453,6 +1679,10 @@ def clear_lockout():
 @app.route('/api/cache/clear', methods=['POST'])
 def cache_clear():
     try:
+        conversion_cache.clear()
+        analysis_cache.clear()
+        tokenizer_cache.clear()
+        token_length_cache.clear()
         res = hf_handler.clear_cache()
         status = 200 if res.get('success') else 500
         return jsonify(res), status
@@ -1462,7 +1692,8 @@ def cache_clear():
 @app.route('/api/cache/status', methods=['GET'])
 def cache_status():
     try:
-        return jsonify(hf_handler.cache_status())
+        return jsonify({**hf_handler.cache_status(), "conversion_cache": conversion_cache.status(),
+                        "tokenizer_cache": tokenizer_cache.status()})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
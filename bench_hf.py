@@ -0,0 +1,162 @@
+"""
+Offline benchmarks for HFHandler against the local fake Hub (fake_hub.py).
+
+Reports scan latency (cold vs cached), cache hit rate, search latency and
+download throughput versus worker count. Run:
+
+    python bench_hf.py --files 200 --file-size 2MB --latency 0.02 --bandwidth 50MB
+    python bench_hf.py --output bench_output.txt
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+# hf_transfer bypasses the fake Hub's throttling; benchmark the plain HTTP path.
+# Must be unset before huggingface_hub is imported.
+os.environ.pop("HF_HUB_ENABLE_HF_TRANSFER", None)
+
+from fake_hub import FakeHub, make_repo
+from hf_handler import HFHandler
+
+REPO_ID = "bench/fake-model"
+
+
+def _parse_size(value):
+    units = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+    value = value.upper().strip()
+    for unit in ("GB", "MB", "KB", "B"):
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * units[unit])
+    return int(value)
+
+
+def _timed(fn, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return samples, result
+
+
+def _summary(samples):
+    ordered = sorted(samples)
+    return {
+        "mean_ms": round(statistics.mean(samples) * 1000, 2),
+        "p50_ms": round(ordered[len(ordered) // 2] * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2)
+    }
+
+
+def bench_scan(handler, repeat):
+    cold, result = _timed(lambda: handler.scan_repo(REPO_ID, options={"cache": False}), repeat)
+    if not result.get("success"):
+        raise RuntimeError(f"Scan failed: {result.get('error')}")
+
+    handler.clear_cache()
+    hits = 0
+    warm = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = handler.scan_repo(REPO_ID, options={"cache": True})
+        warm.append(time.perf_counter() - start)
+        hits += 1 if result.get("from_cache") else 0
+
+    drill, _ = _timed(lambda: handler.list_folder(REPO_ID, "dir0"), repeat)
+    return {
+        "files": result["total_files"],
+        "cold": _summary(cold),
+        "cached": _summary(warm),
+        "cache_hit_rate": round(hits / repeat, 3),
+        "folder_drilldown": _summary(drill)
+    }
+
+
+def bench_search(handler, repeat):
+    samples, result = _timed(lambda: handler.search_repositories("bench", limit=20), repeat)
+    if not result.get("success"):
+        raise RuntimeError(f"Search failed: {result.get('error')}")
+    return _summary(samples)
+
+
+def bench_download(handler, hub, files, concurrency_levels):
+    rows = []
+    for workers in concurrency_levels:
+        target = tempfile.mkdtemp(prefix="xtools_bench_")
+        try:
+            hub.reset_stats()
+            errors = 0
+            start = time.perf_counter()
+            for line in handler.download_files_to_local(REPO_ID, files, target, max_workers=workers):
+                if json.loads(line)["type"] == "error":
+                    errors += 1
+            elapsed = time.perf_counter() - start
+            total = sum(os.path.getsize(os.path.join(target, f)) for f in files
+                        if os.path.exists(os.path.join(target, f)))
+            rows.append({
+                "workers": workers,
+                "seconds": round(elapsed, 3),
+                "mb_per_s": round(total / 1024 ** 2 / elapsed, 2) if elapsed else None,
+                "errors": errors,
+                "requests": hub.stats["requests"]
+            })
+        finally:
+            shutil.rmtree(target, ignore_errors=True)
+    return rows
+
+
+def run(args):
+    repo = make_repo(args.files, _parse_size(args.file_size), depth=args.depth)
+    repos = {REPO_ID: repo}
+    for i in range(5):
+        repos[f"bench/extra-{i}"] = make_repo(10, 1024)
+
+    workdir = tempfile.mkdtemp(prefix="xtools_bench_cache_")
+    hub = FakeHub(repos, latency=args.latency,
+                  bandwidth=_parse_size(args.bandwidth) if args.bandwidth else None,
+                  failure_rate=args.failure_rate, page_size=args.page_size)
+    try:
+        with hub:
+            handler = HFHandler(endpoint=hub.url, cache_file=os.path.join(workdir, "cache.json"))
+            download_files = sorted(repo["files"])[:args.download_files]
+            return {
+                "config": vars(args),
+                "scan": bench_scan(handler, args.repeat),
+                "search": bench_search(handler, args.repeat),
+                "download": bench_download(handler, hub, download_files,
+                                           [int(c) for c in args.concurrency.split(",")])
+            }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark HFHandler against a local fake Hub")
+    parser.add_argument("--files", type=int, default=2000, help="Files in the synthetic repo")
+    parser.add_argument("--file-size", default="256KB", help="Size of each synthetic file")
+    parser.add_argument("--depth", type=int, default=3, help="Folder depth of the synthetic repo")
+    parser.add_argument("--download-files", type=int, default=32, help="Files fetched per download run")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="Comma-separated download worker counts")
+    parser.add_argument("--latency", type=float, default=0.01, help="Per-request latency in seconds")
+    parser.add_argument("--bandwidth", default=None, help="Per-response bandwidth cap, e.g. 20MB")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probability of an injected 503")
+    parser.add_argument("--page-size", type=int, default=1000, help="Tree listing page size")
+    parser.add_argument("--repeat", type=int, default=5, help="Repetitions for latency measurements")
+    parser.add_argument("--output", default=None, help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
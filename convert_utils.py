@@ -0,0 +1,741 @@
+"""
+Input handling and streaming helpers for the /api/convert endpoints.
+"""
+import hashlib
+import io
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Inputs larger than this are rejected (override with XTOOLS_CONVERT_MAX_BYTES or per request)
+DEFAULT_MAX_INPUT_BYTES = int(os.environ.get('XTOOLS_CONVERT_MAX_BYTES', 2 * 1024**3))
+# Remote inputs stay in memory up to this size, then spill to a temp file
+SPOOL_MAX_BYTES = 32 * 1024**2
+FETCH_CHUNK_SIZE = 1024 * 1024
+# Rows per Arrow record batch when streaming Parquet
+PARQUET_BATCH_ROWS = 64 * 1024
+# Size cap for the on-disk conversion result cache
+CONVERT_CACHE_MAX_BYTES = int(os.environ.get('XTOOLS_CONVERT_CACHE_MAX_BYTES', 1024**3))
+# Cache hits only reorder the LRU in memory; the index is written at most this often
+CONVERT_CACHE_INDEX_FLUSH_SECONDS = 30
+
+
+class InputTooLarge(Exception):
+    """Raised when a conversion input exceeds the configured size limit."""
+
+
+class FetchError(Exception):
+    """Raised when a remote conversion input cannot be downloaded."""
+
+
+class ConvertInput:
+    """
+    A single conversion input backed by one file-like object.
+    Remote inputs are spooled (memory, then disk); local files are read in
+    place. Converters get a seekable binary handle via handle(), or the
+    UTF-8 text via text(), without the content being buffered twice.
+    """
+
+    def __init__(self, fileobj, filename, size):
+        self._file = fileobj
+        self.filename = filename
+        self.size = size
+        self._text = None
+        self._text_loaded = False
+        self._hash = None
+
+    @property
+    def extension(self):
+        return self.filename.split('.')[-1].lower() if '.' in self.filename else ''
+
+    def handle(self):
+        """Return the underlying binary handle rewound to the start."""
+        self._file.seek(0)
+        return self._file
+
+    def content_hash(self):
+        """Hash of the input bytes, computed in one streaming pass."""
+        if self._hash is None:
+            digest = hashlib.blake2b(digest_size=20)
+            handle = self.handle()
+            for chunk in iter(lambda: handle.read(FETCH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+            self._hash = digest.hexdigest()
+        return self._hash
+
+    def text(self):
+        """Decode the input as UTF-8 (once); None if it is not valid text."""
+        if not self._text_loaded:
+            self._text_loaded = True
+            wrapper = io.TextIOWrapper(self.handle(), encoding='utf-8')
+            try:
+                self._text = wrapper.read()
+            except UnicodeDecodeError:
+                self._text = None
+            finally:
+                wrapper.detach()
+        return self._text
+
+    def close(self):
+        try:
+            self._file.close()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def fetch_url_input(url, max_bytes=None, timeout=60):
+    """Stream a remote file into a spooled temp file, enforcing max_bytes."""
+    limit = max_bytes or DEFAULT_MAX_INPUT_BYTES
+    try:
+        resp = requests.get(url, headers={'User-Agent': 'Mozilla/5.0'}, stream=True, timeout=timeout)
+    except requests.RequestException as e:
+        raise FetchError(str(e))
+
+    with resp:
+        if resp.status_code != 200:
+            raise FetchError(f"HTTP {resp.status_code}")
+        declared = resp.headers.get('Content-Length')
+        if declared and declared.isdigit() and int(declared) > limit:
+            raise InputTooLarge(f"Remote file is {int(declared)} bytes (limit {limit})")
+
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+        size = 0
+        try:
+            for chunk in resp.iter_content(chunk_size=FETCH_CHUNK_SIZE):
+                size += len(chunk)
+                if size > limit:
+                    raise InputTooLarge(f"Remote file exceeds limit of {limit} bytes")
+                spool.write(chunk)
+        except Exception:
+            spool.close()
+            raise
+
+    filename = url.split('?')[0].rstrip('/').split('/')[-1] or "download"
+    return ConvertInput(spool, filename, size)
+
+
+def open_local_input(file_path, max_bytes=None):
+    """Open a local file as a conversion input, enforcing max_bytes."""
+    limit = max_bytes or DEFAULT_MAX_INPUT_BYTES
+    size = os.path.getsize(file_path)
+    if size > limit:
+        raise InputTooLarge(f"File is {size} bytes (limit {limit})")
+    return ConvertInput(open(file_path, 'rb'), os.path.basename(file_path), size)
+
+
+def iter_parquet_jsonl(fileobj, batch_rows=PARQUET_BATCH_ROWS, compress=False):
+    """
+    Stream a Parquet file as JSON Lines, one encoded chunk per record batch.
+    Row groups are read batch by batch with pyarrow and each batch is
+    serialized in bulk, so memory stays bounded by batch_rows. With
+    compress=True the chunks form a single gzip stream.
+    The footer is read eagerly, so an invalid file raises here rather
+    than after a response has started streaming.
+    """
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(fileobj)
+    return _parquet_jsonl_chunks(parquet_file, batch_rows, compress)
+
+
+def _json_default(value):
+    # Dates/times as str() (e.g. "2024-01-01 00:00:00"), like the original
+    # row-by-row conversion; Decimal, bytes, timedelta and the like as text
+    return str(value)
+
+
+def _finite(value):
+    """Replace NaN/Infinity (which JSON cannot hold) with None, at any depth."""
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {k: _finite(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_finite(v) for v in value]
+    return value
+
+
+def _json_row(row):
+    try:
+        return json.dumps(row, ensure_ascii=False, default=_json_default, separators=(',', ':'), allow_nan=False)
+    except ValueError:
+        # Only rows holding NaN/Infinity take the normalizing pass
+        return json.dumps(_finite(row), ensure_ascii=False, default=_json_default, separators=(',', ':'))
+
+
+def _jsonl_rows(rows):
+    """
+    Encode Python rows (pyarrow to_pylist) as JSON Lines bytes. Values keep
+    their Arrow types: ints stay ints, floats round-trip exactly, "/" and
+    non-ASCII text are not escaped. Output is compact (no spaces after
+    separators). NaN/Infinity are written as null with or without orjson,
+    so the output is always valid JSON.
+    """
+    if orjson is not None:
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        return b''.join(orjson.dumps(row, default=_json_default, option=option) + b'\n' for row in rows)
+    return ''.join(_json_row(row) + '\n' for row in rows).encode('utf-8')
+
+
+def _parquet_jsonl_chunks(parquet_file, batch_rows, compress):
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    for batch in parquet_file.iter_batches(batch_size=batch_rows):
+        if batch.num_rows == 0:
+            continue
+        data = _jsonl_rows(batch.to_pylist())
+        if gz:
+            data = gz.compress(data)
+            if not data:
+                continue
+        yield data
+    if gz:
+        yield gz.flush()
+
+
+# --- Conversion result cache ---
+
+class ConversionCache:
+    """
+    Disk-backed cache of conversion outputs keyed by
+    (content hash, input extension, category, target format).
+    Entries are evicted least-recently-used once the total size exceeds
+    max_bytes. The LRU order is kept in an index file next to the entries;
+    hits update it in memory and it is written on put/clear or at most every
+    CONVERT_CACHE_INDEX_FLUSH_SECONDS.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=CONVERT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir or os.path.join(os.getcwd(), '.xtools_convert_cache')
+        self.index_file = os.path.join(self.cache_dir, 'index.json')
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total = 0
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self._load_index()
+
+    @staticmethod
+    def make_key(content_hash, ext, category, target_format):
+        raw = f"{content_hash}:{ext}:{category}:{target_format}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _load_index(self):
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                entries = json.load(f).get('entries', [])
+        except Exception:
+            entries = []
+        for entry in entries:
+            if os.path.exists(self._path(entry['key'])):
+                self._entries[entry['key']] = entry
+                self._total += entry['size']
+
+    def _save_index(self):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = self.index_file + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({"entries": list(self._entries.values())}, f)
+            os.replace(tmp, self.index_file)
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        except Exception as e:
+            print(f"Error saving conversion cache index: {e}")
+
+    def get(self, key):
+        """
+        Return (file, mimetype, filename) for a cached result, or None.
+        The file is opened under the lock, so a concurrent put evicting the
+        entry can't remove it before it is served; the caller closes it.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            handle = None
+            if entry is not None:
+                try:
+                    handle = open(self._path(key), 'rb')
+                except OSError:
+                    self._total -= self._entries.pop(key)['size']
+                    self._dirty = True
+            if handle is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            entry['last_used'] = time.time()
+            self.hits += 1
+            self._dirty = True
+            if time.monotonic() - self._saved_at >= CONVERT_CACHE_INDEX_FLUSH_SECONDS:
+                self._save_index()
+            return handle, entry['mimetype'], entry['filename']
+
+    def put(self, key, data, mimetype, filename):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp = self._path(key) + '.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, self._path(key))
+            except Exception as e:
+                print(f"Error writing conversion cache entry: {e}")
+                return
+            if key in self._entries:
+                self._total -= self._entries.pop(key)['size']
+            self._entries[key] = {"key": key, "size": len(data), "mimetype": mimetype,
+                                  "filename": filename, "last_used": time.time()}
+            self._total += len(data)
+            while self._total > self.max_bytes and self._entries:
+                old_key, old = self._entries.popitem(last=False)
+                self._total -= old['size']
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+            self._save_index()
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._total = 0
+            self._save_index()
+        return {"success": True, "message": "Conversion cache cleared"}
+
+    def status(self):
+        with self._lock:
+            return {"entries": len(self._entries), "total_bytes": self._total, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+# --- JSONL -> Parquet ---
+
+PARQUET_COMPRESSIONS = ('snappy', 'zstd', 'gzip', 'brotli', 'lz4', 'none')
+
+
+def _widen_type(a, b):
+    """Smallest Arrow type holding values of both a and b, or None if they conflict."""
+    import pyarrow as pa
+    import pyarrow.types as pat
+
+    if a.equals(b):
+        return a
+    if pat.is_null(a):
+        return b
+    if pat.is_null(b):
+        return a
+    if (pat.is_integer(a) or pat.is_floating(a)) and (pat.is_integer(b) or pat.is_floating(b)):
+        return pa.float64()
+    if pat.is_struct(a) and pat.is_struct(b):
+        fields = {a.field(i).name: a.field(i).type for i in range(a.num_fields)}
+        for i in range(b.num_fields):
+            f = b.field(i)
+            fields[f.name] = _widen_type(fields[f.name], f.type) if f.name in fields else f.type
+            if fields[f.name] is None:
+                return None
+        return pa.struct(list(fields.items()))
+    if pat.is_list(a) and pat.is_list(b):
+        value_type = _widen_type(a.value_type, b.value_type)
+        return pa.list_(value_type) if value_type is not None else None
+    return None
+
+
+def _column_type(values):
+    import pyarrow as pa
+    try:
+        return pa.array(values).type
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+        # OverflowError: integers outside int64/uint64
+        return pa.string()
+
+
+def _iter_jsonl_batches(fileobj, is_gz, batch_rows, stats):
+    import gzip
+
+    stream = gzip.GzipFile(fileobj=fileobj, mode='rb') if is_gz else fileobj
+    batch = []
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            stats["parse_errors"] += 1
+            continue
+        if not isinstance(record, dict):
+            stats["skipped_non_objects"] += 1
+            continue
+        batch.append(record)
+        if len(batch) >= batch_rows:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _open_source(source):
+    """Return (binary handle, should_close) for a path or ConvertInput."""
+    if isinstance(source, str):
+        return open(source, 'rb'), True
+    return source.handle(), False
+
+
+def infer_jsonl_schema(source, is_gz, batch_rows=PARQUET_BATCH_ROWS, sample_rows=0):
+    """
+    Infer an Arrow schema from JSONL in one streaming pass.
+    Column types are inferred per batch and widened as new batches arrive
+    (null -> any, int -> float, struct fields merged); conflicting types
+    fall back to string. sample_rows > 0 stops after that many records.
+    """
+    import pyarrow as pa
+
+    types = {}
+    stats = {"parse_errors": 0, "skipped_non_objects": 0}
+    seen = 0
+    handle, should_close = _open_source(source)
+    try:
+        for batch in _iter_jsonl_batches(handle, is_gz, batch_rows, stats):
+            columns = {}
+            for record in batch:
+                for key in record:
+                    columns.setdefault(key, None)
+            for key in columns:
+                batch_type = _column_type([r.get(key) for r in batch])
+                if key not in types:
+                    types[key] = batch_type
+                else:
+                    types[key] = _widen_type(types[key], batch_type) or pa.string()
+            seen += len(batch)
+            if sample_rows and seen >= sample_rows:
+                break
+    finally:
+        if should_close:
+            handle.close()
+
+    schema = pa.schema([(k, pa.string() if pa.types.is_null(t) else t) for k, t in types.items()])
+    return schema, stats
+
+
+class _SchemaMismatch(Exception):
+    """A record outside the schema sample does not fit the sampled schema."""
+
+
+def _check_sampled_schema(batch, schema, known):
+    """Raise _SchemaMismatch if a batch has keys, struct subfields or types the sampled schema lacks."""
+    import pyarrow as pa
+
+    for record in batch:
+        if not known.issuperset(record):
+            key = next(k for k in record if k not in known)
+            raise _SchemaMismatch(f"key '{key}' first appears after the schema sample")
+    for field in schema:
+        if pa.types.is_string(field.type):
+            continue  # non-string values are stored as their JSON text
+        batch_type = _column_type([r.get(field.name) for r in batch])
+        if not (_widen_type(field.type, batch_type) or pa.null()).equals(field.type):
+            raise _SchemaMismatch(f"column '{field.name}' has {batch_type} values outside the sampled type {field.type}")
+
+
+def _write_parquet_rows(source, output, is_gz, schema, batch_rows, row_group_size, compression, strict):
+    """
+    Pass 2 of write_jsonl_parquet. With strict set, a key missing from the
+    schema or a value that does not fit its column raises _SchemaMismatch
+    instead of being dropped.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    string_fields = [f.name for f in schema if pa.types.is_string(f.type)]
+    known = set(schema.names)
+    stats = {"parse_errors": 0, "skipped_non_objects": 0}
+    rows_written = 0
+    row_groups = 0
+    pending, pending_rows = [], 0
+    handle, should_close = _open_source(source)
+    try:
+        with pq.ParquetWriter(output, schema, compression=compression) as writer:
+            def flush(final=False):
+                # Write whole row groups; carry the remainder until the end
+                nonlocal pending, pending_rows, row_groups
+                if not pending:
+                    return
+                table = pa.concat_tables(pending)
+                full = table.num_rows if final else (table.num_rows // row_group_size) * row_group_size
+                if full:
+                    writer.write_table(table.slice(0, full), row_group_size=row_group_size)
+                    row_groups += -(-full // row_group_size)
+                rest = table.slice(full)
+                pending, pending_rows = ([rest], rest.num_rows) if rest.num_rows else ([], 0)
+
+            for batch in _iter_jsonl_batches(handle, is_gz, batch_rows, stats):
+                if strict:
+                    _check_sampled_schema(batch, schema, known)
+                # Values of columns widened to string are stored as their JSON text
+                for record in batch:
+                    for key in string_fields:
+                        value = record.get(key)
+                        if value is not None and not isinstance(value, str):
+                            record[key] = json.dumps(value, ensure_ascii=False)
+                try:
+                    table = pa.Table.from_pylist(batch, schema=schema)
+                except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError) as e:
+                    if not strict:
+                        raise
+                    raise _SchemaMismatch(f"value does not fit the sampled schema: {e}") from e
+                pending.append(table)
+                pending_rows += table.num_rows
+                rows_written += table.num_rows
+                if pending_rows >= row_group_size:
+                    flush()
+            flush(final=True)
+    finally:
+        if should_close:
+            handle.close()
+    return rows_written, row_groups, stats
+
+
+def write_jsonl_parquet(source, output, is_gz, batch_rows=PARQUET_BATCH_ROWS, row_group_size=None,
+                        compression='snappy', schema_sample_rows=0, schema=None):
+    """
+    Convert JSONL/JSONL.gz to Parquet with bounded memory.
+    Pass 1 infers and widens the schema; pass 2 re-reads in batches and
+    writes row groups of row_group_size rows. Only one batch (plus one
+    pending row group) is held in memory at a time.
+    source is a path or ConvertInput; output is a path or binary file.
+    With schema_sample_rows set, pass 1 stops after the sample. If a later
+    record has a key or value the sampled schema cannot hold, the schema is
+    inferred from the whole input and the output rewritten; when output is
+    a file that cannot be rewound a ValueError names the offending key.
+    A given schema skips pass 1; records that do not fit it raise ValueError.
+    """
+    import pyarrow as pa
+
+    row_group_size = row_group_size or batch_rows
+    compression = (compression or 'snappy').lower()
+    if compression not in PARQUET_COMPRESSIONS:
+        raise ValueError(f"Unsupported compression: {compression}")
+
+    fixed_schema = schema is not None
+    if not fixed_schema:
+        schema, _ = infer_jsonl_schema(source, is_gz, batch_rows, schema_sample_rows)
+        if not len(schema):
+            raise ValueError("No JSON objects found in input")
+
+    start = None if isinstance(output, (str, os.PathLike)) else output.tell()
+    try:
+        rows_written, row_groups, stats = _write_parquet_rows(
+            source, output, is_gz, schema, batch_rows, row_group_size, compression,
+            strict=fixed_schema or bool(schema_sample_rows))
+    except _SchemaMismatch as e:
+        if fixed_schema:
+            raise ValueError(f"Record does not fit the Parquet schema: {e}") from None
+        if start is not None:
+            if not (hasattr(output, 'seekable') and output.seekable()):
+                raise ValueError(f"Parquet schema sample too small: {e}") from None
+            output.seek(start)
+            output.truncate()
+        schema, _ = infer_jsonl_schema(source, is_gz, batch_rows)
+        rows_written, row_groups, stats = _write_parquet_rows(
+            source, output, is_gz, schema, batch_rows, row_group_size, compression, strict=False)
+
+    return {
+        "rows": rows_written,
+        "row_groups": row_groups,
+        "columns": [{"name": f.name, "type": str(f.type)} for f in schema],
+        "compression": compression,
+        **stats
+    }
+
+
+# --- Batch image conversion ---
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.gif', '.tif', '.tiff')
+IMAGE_FILE_EXTENSIONS = {'jpeg': 'jpg', 'tiff': 'tif'}
+IMAGE_TARGET_FORMATS = ('jpeg', 'jpg', 'png', 'webp', 'bmp', 'gif', 'tiff', 'tif', 'pdf')
+
+
+def convert_image(src, target_format, max_size=None, quality=None, dest=None):
+    """
+    Convert one image file. When max_size (w, h) is given the image is
+    downscaled to fit; JPEG sources use draft mode so the decoder skips
+    the full-resolution decode. Writes to dest if given, else returns bytes.
+    """
+    from PIL import Image
+
+    save_fmt = 'JPEG' if target_format.upper() in ('JPG', 'JPEG') else target_format.upper()
+    with Image.open(src) as image:
+        if max_size:
+            if image.format == 'JPEG':
+                image.draft('RGB', max_size)
+            image.thumbnail(max_size)
+        if save_fmt in ('JPEG', 'PDF') and image.mode in ("RGBA", "P", "LA"):
+            image = image.convert("RGB")
+
+        params = {"quality": int(quality)} if quality and save_fmt in ('JPEG', 'WEBP') else {}
+        if dest:
+            image.save(dest, format=save_fmt, **params)
+            return None
+        out = io.BytesIO()
+        image.save(out, format=save_fmt, **params)
+        return out.getvalue()
+
+
+def _convert_image_task(task):
+    # Runs in a worker process; never raises so one bad file can't stop the batch
+    src, rel_out, target_format, max_size, quality, output_dir = task
+    try:
+        if output_dir:
+            dest = os.path.join(output_dir, rel_out)
+            os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+            convert_image(src, target_format, max_size, quality, dest)
+            return src, rel_out, None, None
+        return src, rel_out, convert_image(src, target_format, max_size, quality), None
+    except Exception as e:
+        return src, rel_out, None, str(e)
+
+
+def _convert_image_chunk(tasks):
+    return [_convert_image_task(task) for task in tasks]
+
+
+def collect_image_inputs(target_format, files=None, input_dir=None, recursive=True):
+    """
+    Resolve the batch inputs to (source path, relative output name) pairs.
+    Directory inputs keep their relative layout; listed files are flattened,
+    with duplicate names suffixed to stay unique.
+    """
+    out_ext = IMAGE_FILE_EXTENSIONS.get(target_format.lower(), target_format.lower())
+    sources = []
+    if input_dir:
+        root = os.path.abspath(input_dir)
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    path = os.path.join(dirpath, name)
+                    sources.append((path, os.path.relpath(path, root)))
+            if not recursive:
+                break
+    for path in files or []:
+        sources.append((path, os.path.basename(path)))
+
+    inputs, used = [], set()
+    for path, rel in sources:
+        stem = os.path.splitext(rel)[0]
+        rel_out = f"{stem}.{out_ext}"
+        n = 1
+        while rel_out in used:
+            rel_out = f"{stem}_{n}.{out_ext}"
+            n += 1
+        used.add(rel_out)
+        inputs.append((path, rel_out))
+    return inputs
+
+
+def iter_batch_image_conversion(inputs, target_format, output_dir=None, max_size=None,
+                                quality=None, workers=None):
+    """
+    Convert (source, rel_out) pairs on a process pool, yielding
+    (source, rel_out, data, error) in input order. data is None when
+    output_dir is set, since workers write files directly.
+    """
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    if not inputs:
+        return
+    workers = max(1, int(workers or os.cpu_count() or 1))
+    size = tuple(max_size) if max_size else None
+    # Large chunks amortize IPC; small enough that progress keeps flowing
+    chunksize = max(1, min(64, len(inputs) // (workers * 8) or 1))
+    chunks = (
+        [(src, rel, target_format, size, quality, output_dir) for src, rel in inputs[i:i + chunksize]]
+        for i in range(0, len(inputs), chunksize)
+    )
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Keep about two chunks per worker in flight so a slow consumer
+        # (e.g. a zip download) doesn't pile converted images up in memory
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_convert_image_chunk, chunk))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+class _ZipSink:
+    """Write-only, non-seekable buffer that zipfile can stream into."""
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_images_zip(results):
+    """
+    Stream converted images as a zip archive. Failed files are listed in
+    an _errors.json entry at the end of the archive.
+    """
+    import zipfile
+
+    sink = _ZipSink()
+    errors = []
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED) as archive:
+        for src, rel_out, data, error in results:
+            if error:
+                errors.append({"file": src, "error": error})
+                continue
+            archive.writestr(rel_out, data)
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+        if errors:
+            archive.writestr('_errors.json', json.dumps(errors, indent=2))
+    yield sink.drain()
@@ -0,0 +1,1086 @@
+"""
+Out-of-core dataset profiling for the Dataset Intelligence endpoints.
+
+Files are read in chunks and folded into fixed-size sketches, so memory
+stays constant no matter how large the input is:
+  - exact null counts, min/max/mean
+  - approximate distinct counts (HyperLogLog)
+  - approximate quantiles (reservoir sample) and top values (capped counters)
+  - duplicate-row estimate from HyperLogLog over row hashes
+"""
+import base64
+import gzip
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from file_utils import last_byte, tail_hash
+from prep_utils import open_jsonl_input
+
+PROFILE_CHUNK_ROWS = 50000
+HLL_PRECISION = 14
+# Duplicates are estimated as rows minus distinct rows, so the row sketch needs more precision
+ROW_HLL_PRECISION = 16
+# Distinct row hashes kept for an exact duplicate count; above this the row HLL estimates it
+EXACT_DUPLICATE_ROWS = 1_000_000
+RESERVOIR_SIZE = 10000
+TOP_VALUES_CAPACITY = 500
+TOP_VALUES_REPORTED = 10
+SAMPLE_ROWS = 5
+QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+
+
+def _bit_length(values):
+    """Vectorized int.bit_length() for uint64 arrays (exact, via 32-bit halves)."""
+    hi = (values >> np.uint64(32)).astype(np.float64)
+    lo = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    hi_len = np.frexp(hi)[1]
+    lo_len = np.frexp(lo)[1]
+    return np.where(hi_len > 0, hi_len + 32, lo_len)
+
+
+class HyperLogLog:
+    """HyperLogLog cardinality sketch over 64-bit hashes (~1.04/sqrt(2**p) relative error)."""
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.p = precision
+        self.m = 1 << precision
+        self.registers = registers if registers is not None else np.zeros(self.m, dtype=np.uint8)
+
+    def add_hashes(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if not len(hashes):
+            return
+        width = 64 - self.p
+        idx = (hashes >> np.uint64(width)).astype(np.int64)
+        rest = hashes & np.uint64((1 << width) - 1)
+        rank = (width - _bit_length(rest) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, idx, rank)
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # Small-range correction (linear counting)
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+    def to_state(self):
+        return {"p": self.p, "registers": base64.b64encode(self.registers.tobytes()).decode('ascii')}
+
+    @classmethod
+    def from_state(cls, state):
+        registers = np.frombuffer(base64.b64decode(state["registers"]), dtype=np.uint8).copy()
+        return cls(state["p"], registers)
+
+
+def _integral_as_int(series):
+    """
+    Cast float series holding only whole numbers to int64. A CSV column
+    reads as float in chunks that contain NaN and as int elsewhere, and
+    both must hash and count the same.
+    """
+    if not pd.api.types.is_float_dtype(series):
+        return series
+    values = series.to_numpy(dtype=np.float64)
+    finite = values[np.isfinite(values)]
+    if len(finite) and np.all(finite == np.round(finite)) and np.all(np.abs(finite) < 2**63):
+        return pd.Series(np.nan_to_num(values).astype(np.int64), index=series.index)
+    return series
+
+
+def _hash_series(series):
+    """64-bit hash per value (values at null positions are meaningless)."""
+    series = _integral_as_int(series)
+    try:
+        return pd.util.hash_pandas_object(series, index=False).to_numpy()
+    except TypeError:
+        # Unhashable values (dicts/lists from JSON) are hashed by their text form
+        return pd.util.hash_pandas_object(series.astype(str), index=False).to_numpy()
+
+
+def _mix64(values):
+    """splitmix64 finalizer, vectorized."""
+    with np.errstate(over='ignore'):
+        values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return values ^ (values >> np.uint64(31))
+
+
+def _column_salt(name):
+    return np.uint64(int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'little'))
+
+
+class ColumnProfile:
+    """Streaming statistics for one column."""
+
+    def __init__(self, rng):
+        self._rng = rng
+        self.count = 0
+        self.nulls = 0
+        self.hll = HyperLogLog()
+        self.top = {}
+        self.numeric_count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.reservoir = np.empty(0, dtype=np.float64)
+
+    def update(self, series, null_mask, hashes):
+        self.count += len(series)
+        self.nulls += int(null_mask.sum())
+        values = series[~null_mask]
+        if not len(values):
+            return
+
+        self.hll.add_hashes(hashes[~null_mask.to_numpy()])
+        self._update_top(_integral_as_int(values))
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            self._update_numeric(values.to_numpy(dtype=np.float64))
+
+    def _update_top(self, values):
+        try:
+            counts = values.value_counts(sort=False)
+        except TypeError:
+            counts = values.astype(str).value_counts(sort=False)
+        for value, n in counts.items():
+            key = str(value)
+            self.top[key] = self.top.get(key, 0) + int(n)
+        if len(self.top) > TOP_VALUES_CAPACITY:
+            # Keep the heaviest values; surviving counts are lower bounds
+            keep = sorted(self.top.items(), key=lambda kv: kv[1], reverse=True)[:TOP_VALUES_CAPACITY // 2]
+            self.top = dict(keep)
+
+    def _update_numeric(self, arr):
+        arr = arr[np.isfinite(arr)]
+        if not len(arr):
+            return
+        seen = self.numeric_count
+        self.numeric_count += len(arr)
+        self.total += float(arr.sum())
+        lo, hi = float(arr.min()), float(arr.max())
+        self.min = lo if self.min is None else min(self.min, lo)
+        self.max = hi if self.max is None else max(self.max, hi)
+
+        # Vectorized reservoir sampling (Algorithm R over the whole batch)
+        room = RESERVOIR_SIZE - len(self.reservoir)
+        if room > 0:
+            self.reservoir = np.concatenate([self.reservoir, arr[:room]])
+            arr = arr[room:]
+            seen += room
+        if len(arr):
+            positions = np.arange(seen, seen + len(arr)) + 1
+            slots = (self._rng.random(len(arr)) * positions).astype(np.int64)
+            keep = slots < RESERVOIR_SIZE
+            self.reservoir[slots[keep]] = arr[keep]
+
+    def to_state(self):
+        return {
+            "count": self.count, "nulls": self.nulls, "hll": self.hll.to_state(), "top": self.top,
+            "numeric_count": self.numeric_count, "total": self.total, "min": self.min, "max": self.max,
+            "reservoir": base64.b64encode(self.reservoir.tobytes()).decode('ascii')
+        }
+
+    @classmethod
+    def from_state(cls, state, rng):
+        profile = cls(rng)
+        profile.count = state["count"]
+        profile.nulls = state["nulls"]
+        profile.hll = HyperLogLog.from_state(state["hll"])
+        profile.top = state["top"]
+        profile.numeric_count = state["numeric_count"]
+        profile.total = state["total"]
+        profile.min = state["min"]
+        profile.max = state["max"]
+        profile.reservoir = np.frombuffer(base64.b64decode(state["reservoir"]), dtype=np.float64).copy()
+        return profile
+
+    def result(self):
+        distinct = min(self.hll.count(), self.count - self.nulls)
+        stats = {
+            "count": self.count,
+            "nulls": self.nulls,
+            "distinct_approx": distinct,
+            "top_values": [
+                {"value": v, "count": n}
+                for v, n in sorted(self.top.items(), key=lambda kv: kv[1], reverse=True)[:TOP_VALUES_REPORTED]
+            ]
+        }
+        if self.numeric_count:
+            quantiles = np.quantile(self.reservoir, QUANTILES) if len(self.reservoir) else []
+            stats.update({
+                "min": self.min,
+                "max": self.max,
+                "mean": self.total / self.numeric_count,
+                "quantiles_approx": {f"p{int(q * 100)}": float(v) for q, v in zip(QUANTILES, quantiles)}
+            })
+        return stats
+
+
+def _json_value(value):
+    """Plain JSON value for a DataFrame cell: NaN/NaT -> None, numpy scalars unwrapped, floats kept exact."""
+    if isinstance(value, dict):
+        return {str(k): _json_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_json_value(v) for v in value]
+    if value is None or value is pd.NaT:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return value if np.isfinite(value) else None
+    if isinstance(value, (str, bool, int)):
+        return value
+    if isinstance(value, pd.Timestamp):
+        return None if pd.isna(value) else value.isoformat()
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def _records(df):
+    # Not df.to_json: it rounds floats to 10 significant digits
+    return [{str(k): _json_value(v) for k, v in row.items()} for row in df.to_dict('records')]
+
+
+class DatasetProfiler:
+    """
+    Folds DataFrame chunks into per-column and row-level sketches.
+    sample_mode 'head' keeps the first sample_size rows; 'reservoir' keeps
+    a uniform random sample of all rows seen.
+    Duplicate rows are counted exactly from a set of 64-bit row hashes until
+    it exceeds EXACT_DUPLICATE_ROWS, then estimated from the row HLL.
+    """
+
+    def __init__(self, seed=0, sample_size=SAMPLE_ROWS, sample_mode='head'):
+        self._rng = np.random.default_rng(seed)
+        self.columns = {}
+        self.total_rows = 0
+        self.row_hll = HyperLogLog(ROW_HLL_PRECISION)
+        self.row_hashes = np.zeros(0, dtype=np.uint64)  # sorted distinct, None once over the cap
+        self.sample = []
+        self.sample_size = sample_size
+        self.sample_mode = sample_mode
+        self.parse_errors = 0
+
+    def update(self, df):
+        rows = len(df)
+        if not rows:
+            return
+        # Row hash = sum of salted per-column value hashes, skipping nulls, so it
+        # doesn't depend on column order or on columns missing from a chunk
+        row_hashes = np.zeros(rows, dtype=np.uint64)
+        for col in df.columns:
+            key = str(col)
+            if key not in self.columns:
+                profile = ColumnProfile(self._rng)
+                # Column first seen now: it was null in every earlier row
+                profile.count = profile.nulls = self.total_rows
+                self.columns[key] = profile
+            series = df[col]
+            null_mask = series.isna()
+            hashes = _hash_series(series)
+            self.columns[key].update(series, null_mask, hashes)
+            with np.errstate(over='ignore'):
+                row_hashes += np.where(null_mask.to_numpy(), np.uint64(0), _mix64(hashes ^ _column_salt(key)))
+        for key, profile in self.columns.items():
+            if key not in df.columns:
+                profile.count += rows
+                profile.nulls += rows
+        row_hashes = _mix64(row_hashes)
+        self.row_hll.add_hashes(row_hashes)
+        if self.row_hashes is not None:
+            self.row_hashes = np.union1d(self.row_hashes, row_hashes)
+            if len(self.row_hashes) > EXACT_DUPLICATE_ROWS:
+                self.row_hashes = None
+        self._update_sample(df)
+        self.total_rows += rows
+
+    def _update_sample(self, df):
+        room = self.sample_size - len(self.sample)
+        if room > 0:
+            self.sample.extend(_records(df.head(room)))
+        if self.sample_mode != 'reservoir' or len(df) <= room:
+            return
+        # Algorithm R: row at global position i replaces a random slot with prob k/(i+1).
+        # Only the chosen rows are materialized.
+        start = max(room, 0)
+        positions = np.arange(self.total_rows + start, self.total_rows + len(df)) + 1
+        slots = (self._rng.random(len(positions)) * positions).astype(np.int64)
+        chosen = np.flatnonzero(slots < self.sample_size)
+        if len(chosen):
+            for slot, record in zip(slots[chosen], _records(df.iloc[start + chosen])):
+                self.sample[slot] = record
+
+    def to_state(self):
+        """JSON-serializable snapshot; from_state() resumes profiling from it."""
+        return {
+            "columns": [[k, p.to_state()] for k, p in self.columns.items()],
+            "total_rows": self.total_rows,
+            "row_hll": self.row_hll.to_state(),
+            "row_hashes": None if self.row_hashes is None else base64.b64encode(self.row_hashes.tobytes()).decode('ascii'),
+            "sample": self.sample,
+            "sample_size": self.sample_size,
+            "sample_mode": self.sample_mode,
+            "parse_errors": self.parse_errors
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        # Reseed from the row count so resumed runs stay deterministic
+        profiler = cls(seed=state["total_rows"], sample_size=state["sample_size"], sample_mode=state["sample_mode"])
+        profiler.columns = {k: ColumnProfile.from_state(v, profiler._rng) for k, v in state["columns"]}
+        profiler.total_rows = state["total_rows"]
+        profiler.row_hll = HyperLogLog.from_state(state["row_hll"])
+        row_hashes = state.get("row_hashes")
+        profiler.row_hashes = None if row_hashes is None else np.frombuffer(base64.b64decode(row_hashes), dtype=np.uint64).copy()
+        profiler.sample = state["sample"]
+        profiler.parse_errors = state["parse_errors"]
+        return profiler
+
+    def _duplicates(self):
+        """(count, approximate, error bound); count is None when the estimate is within the error."""
+        if self.row_hashes is not None:
+            return self.total_rows - len(self.row_hashes), False, 0
+        distinct_rows = min(self.row_hll.count(), self.total_rows)
+        error = int(round(1.04 / np.sqrt(self.row_hll.m) * distinct_rows))
+        duplicates = self.total_rows - distinct_rows
+        return (duplicates if duplicates > error else None), True, error
+
+    def result(self):
+        duplicates, approximate, error = self._duplicates()
+        return {
+            "total_rows": self.total_rows,
+            "columns": list(self.columns),
+            "duplicates": duplicates,
+            "duplicates_approximate": approximate,
+            "duplicates_error": error,
+            "null_values": sum(p.nulls for p in self.columns.values()),
+            "column_stats": {k: p.result() for k, p in self.columns.items()},
+            "sample": self.sample,
+            "parse_errors": self.parse_errors
+        }
+
+
+def reservoir_sample_lines(file_path, k, seed=None):
+    """
+    Uniform sample of k non-empty lines in one streaming pass (works on .gz).
+    Uses Algorithm L, which draws a random number per replacement rather
+    than per line. Returns [(line_number, line)] in file order.
+    """
+    import math
+    import random
+
+    rng = random.Random(seed)
+    is_gz = file_path.lower().endswith('.gz')
+    open_func = gzip.open if is_gz else open
+    mode = 'rt' if is_gz else 'r'
+    reservoir = []
+    if k <= 0:
+        return reservoir
+
+    def uniform():
+        return rng.random() or 1e-12  # log(0) guard
+
+    w = math.exp(math.log(uniform()) / k)
+    next_index = k + int(math.log(uniform()) / math.log(1 - w))
+    index = 0
+    with open_func(file_path, mode, encoding='utf-8', errors='replace') as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            if index < k:
+                reservoir.append((line_no, line))
+            elif index == next_index:
+                reservoir[rng.randrange(k)] = (line_no, line)
+                w *= math.exp(math.log(uniform()) / k)
+                next_index += 1 + int(math.log(uniform()) / math.log(1 - w))
+            index += 1
+    reservoir.sort()
+    return reservoir
+
+
+def seek_sample_lines(file_path, k, seed=None, max_attempts_factor=4):
+    """
+    Sample up to k distinct lines of an uncompressed file by seeking to
+    random byte offsets and snapping forward to the next line start.
+    Reads only ~k lines, but favours lines that follow long lines; use
+    reservoir_sample_lines() when an exactly uniform sample is required.
+    Returns [(byte_offset, line)] in file order.
+    """
+    import random
+
+    rng = random.Random(seed)
+    size = os.path.getsize(file_path)
+    found = {}
+    if size == 0 or k <= 0:
+        return []
+    with open(file_path, 'rb') as f:
+        for _ in range(k * max_attempts_factor):
+            if len(found) >= k:
+                break
+            offset = rng.randrange(size)
+            if offset > 0:
+                # Step back one byte so an offset already at a line start is kept
+                f.seek(offset - 1)
+                f.readline()
+            else:
+                f.seek(0)
+            start = f.tell()
+            line = f.readline()
+            if not line:
+                # Ran past the last line: wrap around to the first one
+                start = 0
+                f.seek(0)
+                line = f.readline()
+            if line.strip():
+                found[start] = line.decode('utf-8', errors='replace')
+    return sorted(found.items())
+
+
+def sample_jsonl_records(file_path, k, method='reservoir', seed=None):
+    """Sample k records from a JSONL file ('head', 'reservoir' or 'seek')."""
+    if method == 'seek' and not file_path.lower().endswith('.gz'):
+        lines = seek_sample_lines(file_path, k, seed)
+    elif method in ('reservoir', 'seek'):
+        lines = reservoir_sample_lines(file_path, k, seed)
+    else:
+        lines = []
+        is_gz = file_path.lower().endswith('.gz')
+        with (gzip.open if is_gz else open)(file_path, 'rt' if is_gz else 'r', encoding='utf-8', errors='replace') as f:
+            for line_no, line in enumerate(f, 1):
+                if len(lines) >= k:
+                    break
+                if line.strip():
+                    lines.append((line_no, line))
+
+    records = []
+    for _, line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            records.append({"_error": "Invalid JSON on this line", "raw": line.strip()[:200] + "..."})
+    return records
+
+
+def _open_jsonl_text(file_path, start_offset=0, end_offset=None):
+    return open_jsonl_input(file_path, start_offset, end_offset)[0]
+
+
+def _iter_jsonl_chunks(file_path, chunk_rows, stats, start_offset=0, end_offset=None):
+    records = []
+    with _open_jsonl_text(file_path, start_offset, end_offset) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                stats["parse_errors"] += 1
+                continue
+            if not isinstance(record, dict):
+                stats["parse_errors"] += 1
+                continue
+            records.append(record)
+            if len(records) >= chunk_rows:
+                yield pd.DataFrame(records)
+                records = []
+    if records:
+        yield pd.DataFrame(records)
+
+
+def _iter_excel_chunks(file_path, chunk_rows):
+    if not file_path.lower().endswith('.xlsx'):
+        # Legacy .xls has no streaming reader; load it whole
+        df = pd.read_excel(file_path)
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start:start + chunk_rows]
+        return
+
+    from openpyxl import load_workbook
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(c) if c is not None else f"Unnamed: {i}" for i, c in enumerate(header)]
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= chunk_rows:
+                yield pd.DataFrame(batch, columns=columns)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=columns)
+    finally:
+        workbook.close()
+
+
+def iter_dataset_chunks(file_path, chunk_rows=PROFILE_CHUNK_ROWS, stats=None, start_offset=0, end_offset=None):
+    """
+    Yield DataFrame chunks of a CSV, Excel, JSON or JSONL(.gz) file.
+    Yields nothing for unsupported formats; check is_profilable() first.
+    start_offset and end_offset (uncompressed JSONL only) limit reading to
+    that byte range.
+    """
+    stats = stats if stats is not None else {"parse_errors": 0}
+    lower = file_path.lower()
+    if lower.endswith(('.csv', '.csv.gz')):
+        yield from pd.read_csv(file_path, chunksize=chunk_rows)
+    elif lower.endswith(('.xlsx', '.xls')):
+        yield from _iter_excel_chunks(file_path, chunk_rows)
+    elif lower.endswith(('.jsonl', '.jsonl.gz')):
+        yield from _iter_jsonl_chunks(file_path, chunk_rows, stats, start_offset, end_offset)
+    elif lower.endswith('.json'):
+        # A JSON array has no line structure to stream; load it, then profile in chunks
+        df = pd.read_json(file_path)
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start:start + chunk_rows]
+
+
+def is_profilable(file_path):
+    return file_path.lower().endswith(('.csv', '.csv.gz', '.xlsx', '.xls', '.json', '.jsonl', '.jsonl.gz'))
+
+
+def _new_profiler(file_path, sample_size, sample_mode):
+    # 'seek' on uncompressed JSONL samples separately; elsewhere it falls back to a reservoir
+    if sample_mode == 'seek':
+        sample_mode = 'head' if file_path.lower().endswith('.jsonl') else 'reservoir'
+    return DatasetProfiler(sample_size=sample_size, sample_mode=sample_mode)
+
+
+def _fold_file(profiler, file_path, chunk_rows, start_offset=0, end_offset=None):
+    stats = {"parse_errors": 0}
+    for chunk in iter_dataset_chunks(file_path, chunk_rows, stats, start_offset, end_offset):
+        profiler.update(chunk)
+    profiler.parse_errors += stats["parse_errors"]
+
+
+def _profile_result(profiler, file_path, sample_size, sample_mode):
+    result = profiler.result()
+    if sample_mode == 'seek' and file_path.lower().endswith('.jsonl'):
+        result["sample"] = sample_jsonl_records(file_path, sample_size, 'seek')
+    result["sample_mode"] = sample_mode
+    result["memory_usage"] = f"{os.path.getsize(file_path) / 1024**2:.2f} MB"
+    return result
+
+
+def profile_dataset(file_path, chunk_rows=PROFILE_CHUNK_ROWS, sample_size=SAMPLE_ROWS, sample_mode='head'):
+    """
+    Profile a dataset file in one streaming pass with constant memory.
+    sample_mode 'reservoir' draws the sample uniformly during the pass;
+    'seek' (uncompressed JSONL only) samples random offsets separately.
+    """
+    profiler = _new_profiler(file_path, sample_size, sample_mode)
+    _fold_file(profiler, file_path, chunk_rows)
+    return _profile_result(profiler, file_path, sample_size, sample_mode)
+
+
+class AnalysisCache:
+    """
+    Persisted analysis results keyed by (path, size, mtime, options).
+    An unchanged file returns the stored result directly. For uncompressed
+    JSONL that has only been appended to (old tail unchanged), the stored
+    profiler state is restored and just the new byte range is folded in.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=200):
+        self.cache_dir = cache_dir or os.path.join(os.getcwd(), '.xtools_analysis_cache')
+        self.max_entries = max_entries
+
+    def _entry_path(self, file_path, options):
+        raw = json.dumps([file_path, options], sort_keys=True)
+        return os.path.join(self.cache_dir, hashlib.sha1(raw.encode('utf-8')).hexdigest() + '.json')
+
+    def _read(self, entry_path):
+        try:
+            with open(entry_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def _write(self, entry_path, entry):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = entry_path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp, entry_path)
+            self._evict()
+        except Exception as e:
+            print(f"Error saving analysis cache: {e}")
+
+    def _evict(self):
+        files = [os.path.join(self.cache_dir, n) for n in os.listdir(self.cache_dir) if n.endswith('.json')]
+        if len(files) <= self.max_entries:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def analyze(self, file_path, chunk_rows=PROFILE_CHUNK_ROWS, sample_size=SAMPLE_ROWS, sample_mode='head'):
+        """Return (result, cache_status) where cache_status is 'hit', 'incremental' or 'miss'."""
+        path = os.path.abspath(file_path)
+        stat = os.stat(path)
+        size, mtime = stat.st_size, stat.st_mtime_ns
+        options = {"sample_size": sample_size, "sample_mode": sample_mode}
+        entry_path = self._entry_path(path, options)
+        entry = self._read(entry_path)
+
+        if entry and entry["size"] == size and entry["mtime"] == mtime:
+            return entry["result"], 'hit'
+
+        status = 'miss'
+        appendable = path.lower().endswith('.jsonl')
+        if (entry and appendable and entry.get("appendable") and 0 < entry["size"] < size
+                and entry.get("tail_hash") == tail_hash(path, entry["size"])):
+            profiler = DatasetProfiler.from_state(entry["state"])
+            # Stop at the size stat'ed above: bytes appended meanwhile belong to the next run
+            _fold_file(profiler, path, chunk_rows, start_offset=entry["size"], end_offset=size)
+            status = 'incremental'
+        else:
+            profiler = _new_profiler(path, sample_size, sample_mode)
+            _fold_file(profiler, path, chunk_rows, end_offset=size if appendable else None)
+
+        result = _profile_result(profiler, path, sample_size, sample_mode)
+        # Resuming is only safe from a line boundary
+        ends_with_newline = last_byte(path, size) == b'\n'
+        self._write(entry_path, {
+            "path": path,
+            "size": size,
+            "mtime": mtime,
+            "options": options,
+            "appendable": appendable and ends_with_newline,
+            "tail_hash": tail_hash(path, size) if appendable else None,
+            "state": profiler.to_state() if appendable else None,
+            "result": result
+        })
+        return result, status
+
+    def clear(self):
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+        return {"success": True, "message": "Analysis cache cleared"}
+
+
+# --- Parquet metadata ---
+
+def _stat_value(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return str(value)
+
+
+def parquet_metadata_summary(file_path, meta=None):
+    """File-level Parquet facts from the footer alone (no row data is read)."""
+    if meta is None:
+        import pyarrow.parquet as pq
+        meta = pq.ParquetFile(file_path).metadata
+    compressed = uncompressed = 0
+    for rg in range(meta.num_row_groups):
+        group = meta.row_group(rg)
+        uncompressed += group.total_byte_size
+        compressed += sum(group.column(c).total_compressed_size for c in range(group.num_columns))
+    return {
+        "num_rows": meta.num_rows,
+        "num_row_groups": meta.num_row_groups,
+        "num_columns": meta.num_columns,
+        "created_by": meta.created_by,
+        "compressed_size": compressed,
+        "uncompressed_size": uncompressed
+    }
+
+
+def profile_parquet(file_path, sample_size=SAMPLE_ROWS):
+    """
+    Profile a Parquet file from its footer: schema, per-column null counts,
+    min/max and sizes come from row-group statistics, so I/O is a few KB
+    regardless of file size. The sample reads only the first row group.
+    Statistics are reported per leaf column; min/max/nulls are None when
+    any row group lacks them.
+    """
+    import pyarrow.parquet as pq
+    pf = pq.ParquetFile(file_path)
+    meta = pf.metadata
+    arrow_schema = pf.schema_arrow
+
+    columns = {}
+    for c in range(meta.num_columns):
+        col = meta.schema.column(c)
+        columns[col.path] = {
+            "count": meta.num_rows,
+            "nulls": 0,
+            "min": None,
+            "max": None,
+            "physical_type": col.physical_type,
+            "logical_type": str(col.logical_type),
+            "compressed_size": 0,
+            "uncompressed_size": 0,
+            "_stats_complete": True
+        }
+
+    for rg in range(meta.num_row_groups):
+        group = meta.row_group(rg)
+        for c in range(group.num_columns):
+            chunk = group.column(c)
+            entry = columns[chunk.path_in_schema]
+            entry["compressed_size"] += chunk.total_compressed_size
+            entry["uncompressed_size"] += chunk.total_uncompressed_size
+            stats = chunk.statistics
+            if stats is None or not stats.has_null_count:
+                entry["_stats_complete"] = False
+                continue
+            entry["nulls"] += stats.null_count
+            if not stats.has_min_max:
+                # All-null chunks carry no min/max but don't invalidate the others
+                if stats.null_count != group.num_rows:
+                    entry["_stats_complete"] = False
+                continue
+            lo, hi = stats.min, stats.max
+            entry["min"] = lo if entry["min"] is None else min(entry["min"], lo)
+            entry["max"] = hi if entry["max"] is None else max(entry["max"], hi)
+
+    for entry in columns.values():
+        if not entry.pop("_stats_complete"):
+            entry["nulls"] = entry["min"] = entry["max"] = None
+        entry["min"], entry["max"] = _stat_value(entry["min"]), _stat_value(entry["max"])
+
+    sample = []
+    if meta.num_row_groups and sample_size > 0:
+        batch = next(pf.iter_batches(batch_size=sample_size, row_groups=[0]), None)
+        if batch is not None:
+            sample = _records(batch.to_pandas())
+
+    null_counts = [e["nulls"] for e in columns.values()]
+    return {
+        "total_rows": meta.num_rows,
+        "columns": list(arrow_schema.names),
+        "schema": {field.name: str(field.type) for field in arrow_schema},
+        "duplicates": None,
+        "duplicates_approximate": True,
+        "null_values": None if None in null_counts else sum(null_counts),
+        "column_stats": columns,
+        "sample": sample,
+        "sample_mode": 'head',
+        "parse_errors": 0,
+        "metadata_only": True,
+        "parquet": parquet_metadata_summary(file_path, meta),
+        "memory_usage": f"{os.path.getsize(file_path) / 1024**2:.2f} MB"
+    }
+
+
+# --- Row counting ---
+
+ROW_COUNT_BLOCK_SIZE = 8 * 1024**2
+# Uncompressed files at least this large are counted by parallel workers
+PARALLEL_COUNT_MIN_BYTES = 1024**3
+ROW_COUNT_CACHE_ENTRIES = 2000
+
+
+def _count_newlines_range(file_path, start, end):
+    count = 0
+    with open(file_path, 'rb', buffering=0) as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(ROW_COUNT_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            count += block.count(b'\n')
+            remaining -= len(block)
+    return count
+
+
+class RowCounter:
+    """
+    Line counts for large files, cached by (path, size, mtime).
+    Uncompressed files are scanned in large binary blocks (split across
+    processes above PARALLEL_COUNT_MIN_BYTES); gzip files are streamed
+    through the decompressor. When a file has only grown and its old tail
+    is unchanged, only the appended bytes are counted.
+    """
+
+    def __init__(self, cache_file=None, workers=None):
+        import threading
+
+        self.cache_file = cache_file or os.path.join(os.getcwd(), '.xtools_rowcount_cache.json')
+        self.workers = workers or os.cpu_count() or 1
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.cache_file, 'r', encoding='utf-8') as f:
+                    self._entries = json.load(f).get('entries', {})
+            except Exception:
+                self._entries = {}
+        return self._entries
+
+    def _store(self, path, entry):
+        with self._lock:
+            entries = self._load()
+            entries.pop(path, None)
+            entries[path] = entry
+            while len(entries) > ROW_COUNT_CACHE_ENTRIES:
+                entries.pop(next(iter(entries)))
+            try:
+                tmp = self.cache_file + '.tmp'
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump({"entries": entries}, f)
+                os.replace(tmp, self.cache_file)
+            except Exception as e:
+                print(f"Error saving row count cache: {e}")
+
+    def _count_plain(self, file_path, start, end):
+        span = end - start
+        if span < PARALLEL_COUNT_MIN_BYTES or self.workers < 2:
+            return _count_newlines_range(file_path, start, end)
+
+        from concurrent.futures import ProcessPoolExecutor
+        step = -(-span // self.workers)
+        ranges = [(s, min(s + step, end)) for s in range(start, end, step)]
+        with ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(_count_newlines_range, file_path, s, e) for s, e in ranges]
+            return sum(f.result() for f in futures)
+
+    @staticmethod
+    def _count_gzip(file_path):
+        newlines = 0
+        last = b''
+        with gzip.open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(ROW_COUNT_BLOCK_SIZE), b''):
+                newlines += block.count(b'\n')
+                last = block[-1:]
+        return newlines, last
+
+    def count(self, file_path):
+        """Return (line_count, source) where source is 'cache', 'incremental' or 'scan'."""
+        path = os.path.abspath(file_path)
+        stat = os.stat(path)
+        size, mtime = stat.st_size, stat.st_mtime_ns
+        is_gz = path.lower().endswith('.gz')
+
+        with self._lock:
+            cached = dict(self._load().get(path) or {})
+        if cached.get('size') == size and cached.get('mtime') == mtime:
+            return cached['lines'], 'cache'
+
+        source = 'scan'
+        if is_gz:
+            newlines, last = self._count_gzip(path)
+        elif (cached and not cached.get('gz') and 0 < cached.get('size', 0) < size
+                and cached.get('tail_hash') == tail_hash(path, cached['size'])):
+            # Append-only growth: count just the new bytes
+            newlines = cached['newlines'] + self._count_plain(path, cached['size'], size)
+            last = last_byte(path, size)
+            source = 'incremental'
+        else:
+            newlines = self._count_plain(path, 0, size)
+            last = last_byte(path, size)
+
+        # A final line without a trailing newline still counts
+        lines = newlines + (1 if last and last != b'\n' else 0)
+        entry = {"size": size, "mtime": mtime, "newlines": newlines, "lines": lines, "gz": is_gz}
+        if not is_gz:
+            entry["tail_hash"] = tail_hash(path, size)
+        self._store(path, entry)
+        return lines, source
+
+
+# --- External deduplication ---
+
+DEDUP_PARTITION_BYTES = 64 * 1024**2
+DEDUP_MAX_PARTITIONS = 1024
+
+
+def _dedup_key(record):
+    # Missing and null compare equal, and 3.0 == 3 (CSV chunks infer int or float independently)
+    items = {}
+    for k, v in record.items():
+        if v is None:
+            continue
+        if isinstance(v, float) and v.is_integer():
+            v = int(v)
+        items[k] = v
+    raw = json.dumps(items, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(raw.encode('utf-8'), digest_size=16).digest()
+
+
+def _dedup_output_format(file_path):
+    lower = file_path.lower()
+    if lower.endswith(('.csv', '.csv.gz')):
+        return 'csv'
+    if lower.endswith('.json'):
+        return 'json'
+    return 'jsonl'
+
+
+def _iter_dedup_records(file_path, chunk_rows, stats, columns):
+    """
+    Yield (record, JSON text) for every row. JSONL lines and the objects of
+    a JSON array pass through as written, so values and key sets are kept;
+    CSV (and other JSON shapes) go through DataFrame chunks.
+    """
+    lower = file_path.lower()
+    if lower.endswith(('.jsonl', '.jsonl.gz')):
+        with _open_jsonl_text(file_path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    stats["parse_errors"] += 1
+                    continue
+                if not isinstance(record, dict):
+                    stats["parse_errors"] += 1
+                    continue
+                yield record, line
+        return
+    if lower.endswith('.json'):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if isinstance(data, list) and all(isinstance(record, dict) for record in data):
+            for record in data:
+                yield record, json.dumps(record, ensure_ascii=False)
+            return
+    for chunk in iter_dataset_chunks(file_path, chunk_rows, stats):
+        columns.update(dict.fromkeys(str(c) for c in chunk.columns))
+        for record in _records(chunk):
+            yield record, json.dumps(record, ensure_ascii=False)
+
+
+class _RecordWriter:
+    """Writes records as CSV, a JSON array or JSONL, one at a time."""
+
+    def __init__(self, f, fmt, columns):
+        self.f = f
+        self.fmt = fmt
+        self.first = True
+        if fmt == 'csv':
+            import csv
+            self.csv = csv.DictWriter(f, fieldnames=columns, restval='', extrasaction='ignore')
+            self.csv.writeheader()
+        elif fmt == 'json':
+            f.write('[')
+
+    def write(self, line):
+        if self.fmt == 'jsonl':
+            self.f.write(line + '\n')
+        elif self.fmt == 'csv':
+            record = json.loads(line)
+            self.csv.writerow({k: '' if v is None else v for k, v in record.items()})
+        else:
+            body = json.dumps(json.loads(line), indent=2, ensure_ascii=False).replace('\n', '\n  ')
+            self.f.write(('\n  ' if self.first else ',\n  ') + body)
+        self.first = False
+
+    def close(self):
+        if self.fmt == 'json':
+            self.f.write('\n]' if not self.first else ']')
+
+
+def external_dedup(file_path, output_path, partitions=None, keep_order=True,
+                   chunk_rows=PROFILE_CHUNK_ROWS, spill_dir=None):
+    """
+    Drop duplicate rows from a dataset larger than memory.
+
+    Rows stream in chunks and are hash-partitioned into spill files by a
+    128-bit digest of their content; each partition is then deduplicated in
+    memory, so peak memory is about one partition. With keep_order the
+    surviving rows of every partition are merged back by original row
+    number (first occurrence wins), otherwise partitions are written one
+    after another. Output keeps the input format (CSV, JSON array or JSONL);
+    JSONL rows are written back exactly as read.
+    """
+    import heapq
+    import tempfile
+
+    if partitions is None:
+        partitions = os.path.getsize(file_path) // DEDUP_PARTITION_BYTES + 1
+    partitions = max(1, min(int(partitions), DEDUP_MAX_PARTITIONS))
+    stats = {"parse_errors": 0}
+    columns = {}
+    initial_rows = 0
+
+    with tempfile.TemporaryDirectory(prefix='xtools_dedup_', dir=spill_dir) as tmp:
+        # Pass 1: spill "row_number \t digest \t record" lines into partitions
+        spills = [open(os.path.join(tmp, f'part_{i:04d}'), 'w', encoding='utf-8') for i in range(partitions)]
+        try:
+            for record, line in _iter_dedup_records(file_path, chunk_rows, stats, columns):
+                digest = _dedup_key(record)
+                part = int.from_bytes(digest[:8], 'little') % partitions
+                spills[part].write(f"{initial_rows}\t{digest.hex()}\t{line}\n")
+                initial_rows += 1
+        finally:
+            for f in spills:
+                f.close()
+
+        # Pass 2: dedup each partition in memory, writing survivors sorted by row number
+        cleaned_rows = 0
+        kept_paths = []
+        for i in range(partitions):
+            part_path = os.path.join(tmp, f'part_{i:04d}')
+            seen = set()
+            kept = []
+            with open(part_path, 'r', encoding='utf-8') as f:
+                for entry in f:
+                    row, digest, line = entry.rstrip('\n').split('\t', 2)
+                    if digest in seen:
+                        continue
+                    seen.add(digest)
+                    kept.append((int(row), line))
+            os.remove(part_path)
+            cleaned_rows += len(kept)
+            kept_path = part_path + '.kept'
+            with open(kept_path, 'w', encoding='utf-8') as f:
+                for row, line in kept:
+                    f.write(f"{row}\t{line}\n")
+            kept_paths.append(kept_path)
+
+        # Pass 3: write output, k-way merged back into original order if requested
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        readers = [open(p, 'r', encoding='utf-8') for p in kept_paths]
+        try:
+            def rows(f):
+                for entry in f:
+                    row, line = entry.rstrip('\n').split('\t', 1)
+                    yield int(row), line
+
+            merged = heapq.merge(*map(rows, readers)) if keep_order else (r for f in readers for r in rows(f))
+            with open(output_path, 'w', encoding='utf-8', newline='') as out:
+                writer = _RecordWriter(out, _dedup_output_format(file_path), list(columns))
+                for _, line in merged:
+                    writer.write(line)
+                writer.close()
+        finally:
+            for f in readers:
+                f.close()
+
+    return {
+        "initial_rows": initial_rows,
+        "cleaned_rows": cleaned_rows,
+        "partitions": partitions,
+        "parse_errors": stats["parse_errors"]
+    }
@@ -0,0 +1,297 @@
+"""
+Near-duplicate detection for the Data Preparation endpoints.
+
+Records are reduced to MinHash signatures over character or word shingles
+of their text, and signatures are bucketed in an LSH index (banding), so
+each new record is compared only against the few earlier records that
+share a bucket with it. Only the signatures of kept records are held in
+memory, never the records themselves.
+"""
+import zlib
+
+import numpy as np
+
+DEFAULT_NUM_PERM = 128
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_SHINGLE_SIZE = {"char": 5, "word": 3}
+# Caps the (shingles x permutations) matrix hashed at once
+MAX_SHINGLES_PER_BLOCK = 65536
+ROLLING_BASE = np.uint64(1099511628211)
+MIX_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+LSH_INITIAL_SLOTS = 4096
+
+
+def _rolling_hashes(values, k):
+    """64-bit polynomial hash of every length-k window of a uint64 array."""
+    n = len(values) - k + 1
+    h = np.zeros(n, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for j in range(k):
+            h = h * ROLLING_BASE + values[j:j + n]
+        h ^= h >> np.uint64(31)
+        h *= MIX_MULTIPLIER
+        h ^= h >> np.uint64(29)
+    return h
+
+
+def optimal_bands(num_perm, threshold):
+    """
+    Pick (bands, rows) with bands * rows == num_perm whose LSH S-curve
+    midpoint (1 / bands) ** (1 / rows) is the highest one not above
+    threshold. Erring low favours recall; candidates are verified against
+    the threshold anyway, so extra ones only cost a comparison.
+    """
+    best = (1, num_perm)
+    best_midpoint = -1.0
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        midpoint = (1.0 / bands) ** (1.0 / rows)
+        if best_midpoint < midpoint <= threshold:
+            best, best_midpoint = (bands, rows), midpoint
+    return best
+
+
+class MinHasher:
+    """
+    MinHash signatures with num_perm multiply-shift hash functions. Shingle
+    hashing and the per-permutation minimum are vectorized with numpy and
+    batched across records.
+    """
+
+    def __init__(self, num_perm=DEFAULT_NUM_PERM, shingle='char', shingle_size=None, seed=1):
+        if shingle not in DEFAULT_SHINGLE_SIZE:
+            raise ValueError("shingle must be 'char' or 'word'")
+        self.num_perm = num_perm
+        self.shingle = shingle
+        self.shingle_size = int(shingle_size or DEFAULT_SHINGLE_SIZE[shingle])
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+
+    def shingle_hashes(self, text):
+        """Unique 64-bit hashes of the text's shingles (lowercased, whitespace collapsed)."""
+        words = text.lower().split()
+        if not words:
+            return np.empty(0, dtype=np.uint64)
+        if self.shingle == 'word':
+            values = np.array([zlib.crc32(w.encode('utf-8')) for w in words], dtype=np.uint64)
+        else:
+            values = np.frombuffer(' '.join(words).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+        return np.unique(_rolling_hashes(values, min(self.shingle_size, len(values))))
+
+    def _permuted(self, hashes):
+        # (num_perm, shingles) layout keeps each reduction contiguous; computed in place
+        with np.errstate(over='ignore'):
+            matrix = self._a[:, None] * hashes[None, :]
+            matrix += self._b[:, None]
+        matrix >>= np.uint64(32)
+        return matrix
+
+    def signatures(self, texts):
+        """
+        Signatures for a batch of texts as an (n, num_perm) uint32 array,
+        plus a boolean mask of texts that had no shingles (their rows are
+        meaningless and should not be indexed).
+        """
+        shingles = [self.shingle_hashes(t) for t in texts]
+        out = np.full((len(texts), self.num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+        empty = np.array([len(s) == 0 for s in shingles], dtype=bool)
+
+        group, group_size = [], 0
+        for i, hashes in enumerate(shingles):
+            if not len(hashes):
+                continue
+            if len(hashes) > MAX_SHINGLES_PER_BLOCK:
+                # One very long text: fold its shingles in slices
+                for start in range(0, len(hashes), MAX_SHINGLES_PER_BLOCK):
+                    block = self._permuted(hashes[start:start + MAX_SHINGLES_PER_BLOCK]).min(axis=1)
+                    np.minimum(out[i], block.astype(np.uint32), out=out[i])
+                continue
+            if group_size + len(hashes) > MAX_SHINGLES_PER_BLOCK:
+                self._fill(out, group, shingles)
+                group, group_size = [], 0
+            group.append(i)
+            group_size += len(hashes)
+        if group:
+            self._fill(out, group, shingles)
+        return out, empty
+
+    def _fill(self, out, group, shingles):
+        lengths = [len(shingles[i]) for i in group]
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        matrix = self._permuted(np.concatenate([shingles[i] for i in group]))
+        out[group] = np.minimum.reduceat(matrix, offsets, axis=1).T
+
+
+class LSHIndex:
+    """
+    Banded LSH over MinHash signatures. query() returns the id of the most
+    similar indexed signature whose estimated Jaccard similarity reaches
+    the threshold, or None.
+
+    Each band of a signature is reduced to a 64-bit key. Per band, an
+    open-addressing table in numpy arrays maps a key to the newest id with
+    that key, and a (records, bands) array chains older ids. An indexed
+    record costs its signature (num_perm * 4 bytes) plus 28-56 bytes per
+    band of index (tables double at half load), with no Python objects
+    per record.
+    """
+
+    def __init__(self, num_perm=DEFAULT_NUM_PERM, threshold=DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self.bands, self.rows = optimal_bands(num_perm, threshold)
+        rng = np.random.default_rng(0)
+        self._coefficients = rng.integers(1, 2**63, size=self.rows, dtype=np.uint64) | np.uint64(1)
+        self._salts = rng.integers(1, 2**63, size=self.bands, dtype=np.uint64)
+        self._band_ids = np.arange(self.bands)
+        self._mask = LSH_INITIAL_SLOTS - 1
+        # Key 0 marks an empty slot; band keys are never 0
+        self._keys = np.zeros((self.bands, LSH_INITIAL_SLOTS), dtype=np.uint64)
+        self._heads = np.zeros((self.bands, LSH_INITIAL_SLOTS), dtype=np.int32)
+        self._filled = np.zeros(self.bands, dtype=np.int64)
+        self._next = np.empty((1024, self.bands), dtype=np.int32)
+        self.signatures = np.empty((1024, num_perm), dtype=np.uint32)
+        self.size = 0
+
+    def _band_keys(self, signature):
+        # uint64 array arithmetic wraps silently
+        values = signature.reshape(self.bands, self.rows).astype(np.uint64)
+        keys = (values * self._coefficients).sum(axis=1, dtype=np.uint64) ^ self._salts
+        keys ^= keys >> np.uint64(31)
+        keys *= MIX_MULTIPLIER
+        keys ^= keys >> np.uint64(29)
+        keys[keys == 0] = 1
+        return keys
+
+    def probe(self, signature):
+        """
+        (keys, slots, found) for a signature: per band, the slot holding its
+        key or the empty slot it would take. Valid until the next insert.
+        """
+        keys = self._band_keys(signature)
+        slots = (keys & np.uint64(self._mask)).astype(np.int64)
+        stored = self._keys[self._band_ids, slots]
+        # Most bands land on their slot first time; walk the few collisions in plain Python
+        for band in np.flatnonzero((stored != keys) & (stored != 0)):
+            table, key, slot = self._keys[band], keys[band], int(slots[band])
+            while True:
+                slot = (slot + 1) & self._mask
+                if table[slot] == key or table[slot] == 0:
+                    break
+            slots[band], stored[band] = slot, table[slot]
+        return keys, slots, stored == keys
+
+    def query(self, signature, probe=None):
+        _, slots, found = probe or self.probe(signature)
+        if not found.any():
+            return None
+        candidates = set()
+        for band in np.flatnonzero(found):
+            key_id = int(self._heads[band, slots[band]])
+            while key_id >= 0 and key_id not in candidates:
+                candidates.add(key_id)
+                key_id = int(self._next[key_id, band])
+        ids = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        similarity = (self.signatures[ids] == signature).mean(axis=1)
+        best = int(np.argmax(similarity))
+        return int(ids[best]) if similarity[best] >= self.threshold else None
+
+    def insert(self, signature, probe=None):
+        keys, slots, found = probe or self.probe(signature)
+        if self.size == len(self.signatures):
+            self.signatures = _grown(self.signatures, self.size)
+            self._next = _grown(self._next, self.size)
+        key_id = self.size
+        self.signatures[key_id] = signature
+        self.size += 1
+        self._next[key_id] = np.where(found, self._heads[self._band_ids, slots], -1)
+        self._keys[self._band_ids, slots] = keys
+        self._heads[self._band_ids, slots] = key_id
+        self._filled += ~found
+        if self._filled.max() * 2 > self._mask + 1:
+            self._rehash()
+        return key_id
+
+    def _rehash(self):
+        # Double the tables, keeping the load factor at or below one half
+        size = (self._mask + 1) * 2
+        mask = size - 1
+        keys = np.zeros((self.bands, size), dtype=np.uint64)
+        heads = np.zeros((self.bands, size), dtype=np.int32)
+        for band in range(self.bands):
+            occupied = np.flatnonzero(self._keys[band])
+            band_keys, band_heads = self._keys[band, occupied], self._heads[band, occupied]
+            slots = (band_keys & np.uint64(mask)).astype(np.int64)
+            remaining = np.arange(len(occupied))
+            while len(remaining):
+                wanted = slots[remaining]
+                placed = np.zeros(len(remaining), dtype=bool)
+                placed[np.unique(wanted, return_index=True)[1]] = True
+                placed &= keys[band, wanted] == 0
+                keys[band, wanted[placed]] = band_keys[remaining[placed]]
+                heads[band, wanted[placed]] = band_heads[remaining[placed]]
+                remaining = remaining[~placed]
+                slots[remaining] = (slots[remaining] + 1) & mask
+        self._keys, self._heads, self._mask = keys, heads, mask
+
+
+def _grown(array, rows):
+    grown = np.empty((rows * 2,) + array.shape[1:], dtype=array.dtype)
+    grown[:rows] = array[:rows]
+    return grown
+
+
+class NearDuplicateFilter:
+    """
+    Streaming near-dedup: feed signatures in record order; a record is a
+    near duplicate when an earlier kept record is at least `threshold`
+    similar. Tracks cluster sizes (kept representative + dropped members).
+    """
+
+    def __init__(self, num_perm=DEFAULT_NUM_PERM, threshold=DEFAULT_THRESHOLD):
+        self.index = LSHIndex(num_perm, threshold)
+        self.cluster_members = {}
+        self.removed = 0
+
+    def check(self, signature, empty=False):
+        """Return True if the record should be dropped; indexes it otherwise."""
+        if empty:
+            return False
+        probe = self.index.probe(signature)
+        match = self.index.query(signature, probe)
+        if match is not None:
+            self.cluster_members[match] = self.cluster_members.get(match, 1) + 1
+            self.removed += 1
+            return True
+        self.index.insert(signature, probe)
+        return False
+
+    def stats(self):
+        sizes = sorted(self.cluster_members.values(), reverse=True)
+        histogram = {}
+        for size in sizes:
+            upper = 2
+            while upper < size:
+                upper *= 2
+            label = "2" if upper == 2 else f"{upper // 2 + 1}-{upper}"
+            histogram[label] = histogram.get(label, 0) + 1
+        return {
+            "near_duplicates": self.removed,
+            "clusters": len(sizes),
+            "largest_cluster": sizes[0] if sizes else 0,
+            "mean_cluster_size": round(sum(sizes) / len(sizes), 2) if sizes else 0,
+            "cluster_size_histogram": histogram,
+            "bands": self.index.bands,
+            "rows_per_band": self.index.rows,
+            "indexed_signatures": self.index.size
+        }
+
+
+def record_text(record, fields=None):
+    """Text used for near-dedup: the given fields, or every string value, joined by newlines."""
+    if fields:
+        values = [record.get(f) for f in fields]
+        return '\n'.join(v if isinstance(v, str) else str(v) for v in values if v is not None and v != '')
+    return '\n'.join(v for v in record.values() if isinstance(v, str) and v)
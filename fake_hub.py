@@ -0,0 +1,262 @@
+"""
+Local stand-in for the Hugging Face Hub, used to benchmark HFHandler offline.
+
+Serves just enough of the Hub HTTP API for huggingface_hub clients:
+  - GET  /api/{models,datasets}                       search results
+  - GET  /api/{models,datasets}/{repo}/tree/{rev}     recursive tree listing
+  - HEAD/GET /{repo}/resolve/{rev}/{path}             file metadata and download
+  - HEAD/GET /datasets/{repo}/resolve/{rev}/{path}
+
+Latency, bandwidth and failure rate are configurable so benchmarks can
+model a slow or flaky network.
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+FAKE_COMMIT = "0" * 40
+CHUNK_SIZE = 64 * 1024
+
+
+def make_repo(num_files=100, file_size=1024 * 1024, depth=2, fanout=4, repo_type="model"):
+    """
+    Build a synthetic repo layout: num_files files of file_size bytes spread
+    over a folder tree `depth` levels deep with `fanout` folders per level.
+    """
+    files = {}
+    for i in range(num_files):
+        parts = [f"dir{(i // fanout ** level) % fanout}" for level in range(depth)]
+        ext = ("parquet", "jsonl", "safetensors", "json")[i % 4]
+        files["/".join(parts + [f"file_{i:06d}.{ext}"])] = file_size
+    return {"type": repo_type, "files": files}
+
+
+def _file_bytes(path, size):
+    # Deterministic content so repeated downloads are byte-identical
+    seed = hashlib.sha256(path.encode("utf-8")).digest()
+    block = (seed * (CHUNK_SIZE // len(seed) + 1))[:CHUNK_SIZE]
+    remaining = size
+    while remaining > 0:
+        n = min(remaining, CHUNK_SIZE)
+        yield block[:n]
+        remaining -= n
+
+
+class FakeHub:
+    """
+    Threaded HTTP server holding an in-memory set of repos.
+
+    repos maps repo_id -> {"type": "model"|"dataset", "files": {path: size}}.
+    latency is added to every request (seconds), bandwidth caps each response
+    body (bytes/second, None for unlimited), and failure_rate is the
+    probability that a request answers 503 instead.
+    """
+
+    def __init__(self, repos=None, latency=0.0, bandwidth=None, failure_rate=0.0,
+                 page_size=1000, seed=0, host="127.0.0.1", port=0):
+        self.repos = repos or {}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.page_size = page_size
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "failures": 0, "bytes_sent": 0}
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {"requests": 0, "failures": 0, "bytes_sent": 0}
+
+    def _record(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def _should_fail(self):
+        if self.failure_rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+    def _make_handler(self):
+        hub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_HEAD(self):
+                self._dispatch(head=True)
+
+            def do_GET(self):
+                self._dispatch(head=False)
+
+            def _dispatch(self, head):
+                hub._record("requests")
+                if hub.latency:
+                    time.sleep(hub.latency)
+                if hub._should_fail():
+                    hub._record("failures")
+                    return self._send_json({"error": "Injected failure"}, status=503)
+
+                parsed = urlparse(self.path)
+                path = unquote(parsed.path)
+                query = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+
+                match = re.match(r"^/api/(models|datasets)/(.+?)/tree/([^/]+)/?(.*)$", path)
+                if match:
+                    kind, repo_id, _, sub = match.groups()
+                    return self._tree(kind, repo_id, sub, query)
+                match = re.match(r"^/api/(models|datasets)/?$", path)
+                if match:
+                    return self._search(match.group(1), query)
+                match = re.match(r"^/(datasets/)?(.+?)/resolve/([^/]+)/(.+)$", path)
+                if match:
+                    prefix, repo_id, _, filename = match.groups()
+                    return self._resolve(repo_id, "dataset" if prefix else "model", filename, head)
+                self._send_json({"error": "Not found"}, status=404)
+
+            def _repo(self, repo_id, repo_type):
+                repo = hub.repos.get(repo_id)
+                if repo is None or repo.get("type", "model") != repo_type:
+                    return None
+                return repo
+
+            def _tree(self, kind, repo_id, sub, query):
+                repo = self._repo(repo_id, "dataset" if kind == "datasets" else "model")
+                if repo is None:
+                    return self._send_json({"error": "Repository not found"}, status=404)
+
+                recursive = query.get("recursive", "").lower() in ("1", "true")
+                prefix = f"{sub.strip('/')}/" if sub.strip('/') else ""
+                entries, folders = [], set()
+                for path, size in sorted(repo["files"].items()):
+                    if not path.startswith(prefix):
+                        continue
+                    rel = path[len(prefix):].split("/")
+                    limit = len(rel) if recursive else 1
+                    for i in range(1, min(len(rel), limit + 1)):
+                        folder = prefix + "/".join(rel[:i])
+                        if folder not in folders:
+                            folders.add(folder)
+                            entries.append({"type": "directory", "oid": FAKE_COMMIT, "path": folder})
+                    if recursive or len(rel) == 1:
+                        entries.append({"type": "file", "oid": FAKE_COMMIT, "size": size, "path": path})
+
+                start = int(query.get("cursor", 0))
+                page = entries[start:start + hub.page_size]
+                headers = {}
+                if start + hub.page_size < len(entries):
+                    next_url = f"{hub.url}{urlparse(self.path).path}?recursive={query.get('recursive', 'False')}&cursor={start + hub.page_size}"
+                    headers["Link"] = f'<{next_url}>; rel="next"'
+                self._send_json(page, headers=headers)
+
+            def _search(self, kind, query):
+                repo_type = "dataset" if kind == "datasets" else "model"
+                search = query.get("search", "").lower()
+                limit = int(query.get("limit", 20))
+                results = []
+                for i, (repo_id, repo) in enumerate(sorted(hub.repos.items())):
+                    if repo.get("type", "model") != repo_type or search not in repo_id.lower():
+                        continue
+                    results.append({
+                        "id": repo_id,
+                        "author": repo_id.split("/")[0],
+                        "downloads": len(repo["files"]) * 10 + i,
+                        "likes": i,
+                        "tags": [],
+                        "lastModified": "2024-01-01T00:00:00.000Z"
+                    })
+                results.sort(key=lambda r: r["downloads"], reverse=True)
+                self._send_json(results[:limit])
+
+            def _resolve(self, repo_id, repo_type, filename, head):
+                repo = self._repo(repo_id, repo_type)
+                size = repo["files"].get(filename) if repo else None
+                if size is None:
+                    return self._send_json({"error": "Entry not found"}, status=404,
+                                           headers={"X-Error-Code": "EntryNotFound"})
+
+                etag = hashlib.sha1(f"{repo_id}/{filename}".encode("utf-8")).hexdigest()
+                start, end = 0, size - 1
+                status = 200
+                range_header = self.headers.get("Range")
+                if range_header and not head:
+                    m = re.match(r"bytes=(\d+)-(\d*)", range_header)
+                    if m:
+                        start = int(m.group(1))
+                        end = int(m.group(2)) if m.group(2) else end
+                        status = 206
+                length = max(0, end - start + 1)
+
+                self.send_response(status)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(size if head else length))
+                self.send_header("ETag", f'"{etag}"')
+                self.send_header("X-Repo-Commit", FAKE_COMMIT)
+                self.send_header("Accept-Ranges", "bytes")
+                if status == 206:
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                self.end_headers()
+                if head:
+                    return
+
+                sent = 0
+                started = time.perf_counter()
+                for chunk in _file_bytes(filename, size):
+                    chunk_end = sent + len(chunk)
+                    if chunk_end <= start or sent > end:
+                        sent = chunk_end
+                        continue
+                    piece = chunk[max(0, start - sent):min(len(chunk), end + 1 - sent)]
+                    sent = chunk_end
+                    self.wfile.write(piece)
+                    hub._record("bytes_sent", len(piece))
+                    if hub.bandwidth:
+                        # Sleep until the transfer rate falls back under the cap
+                        ahead = (min(sent, end + 1) - start) / hub.bandwidth - (time.perf_counter() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+
+            def _send_json(self, payload, status=200, headers=None):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+                    hub._record("bytes_sent", len(body))
+
+        return Handler
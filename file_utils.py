@@ -0,0 +1,28 @@
+"""
+Helpers for caches that follow files as they grow.
+
+A cache entry records a file's size and a hash of the bytes just before
+that offset. If the file is later larger and that tail still matches, it
+has only been appended to, so cached work can resume from the old size
+instead of starting over.
+"""
+import hashlib
+
+TAIL_HASH_BYTES = 4096
+
+
+def last_byte(file_path, size):
+    """The byte at offset size - 1 (b'' for an empty file)."""
+    if size == 0:
+        return b''
+    with open(file_path, 'rb') as f:
+        f.seek(size - 1)
+        return f.read(1)
+
+
+def tail_hash(file_path, end):
+    """Hex digest of the TAIL_HASH_BYTES bytes that end at offset end."""
+    with open(file_path, 'rb') as f:
+        start = max(0, end - TAIL_HASH_BYTES)
+        f.seek(start)
+        return hashlib.blake2b(f.read(end - start), digest_size=16).hexdigest()
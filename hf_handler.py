@@ -1,15 +1,24 @@
-from huggingface_hub import HfApi, hf_hub_download, list_models, list_datasets
+from huggingface_hub import HfApi, hf_hub_download
 import json
 import os
 import time
+from collections import OrderedDict
 from urllib.parse import quote
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import queue
+import threading
+
+# Per-folder indexes kept in memory for /api/hf_tree drill-downs
+FOLDER_INDEX_CACHE_ENTRIES = 32
+# Upper bound on threads for concurrent batch scans
+SCAN_MAX_WORKERS = 32
 
 class HFHandler:
-    def __init__(self):
-        self.api = HfApi()
-        self.cache_file = os.path.join(os.getcwd(), ".xtools_cache.json")
+    def __init__(self, endpoint=None, cache_file=None):
+        # endpoint/cache_file are overridable so a local fake Hub can be used (see fake_hub.py)
+        self.endpoint = endpoint
+        self.api = HfApi(endpoint=endpoint)
+        self.cache_file = cache_file or os.path.join(os.getcwd(), ".xtools_cache.json")
         # ensure cache file exists with initial structure
         if not os.path.exists(self.cache_file):
             try:
@@ -18,8 +27,11 @@ class HFHandler:
             except Exception:
                 pass
         self._cache = {}
+        self._cache_lock = threading.Lock()
+        self._folder_indexes = OrderedDict()
+        self._folder_index_lock = threading.Lock()
 
-    def _load_cache_from_disk(self, key, ttl):
+    def _load_cache_from_disk(self, key, ttl, with_ts=False):
         try:
             with open(self.cache_file, 'r', encoding='utf-8') as f:
                 content = json.load(f)
@@ -29,11 +41,35 @@ class HFHandler:
                 return None
             if ttl is not None and (time.time() - entry.get('ts', 0) > ttl):
                 return None
+            if with_ts:
+                return entry
             return entry.get('value')
         except Exception:
             return None
 
+    def _load_cache(self, key, ttl):
+        """
+        Look up a cache entry in memory first, then on disk.
+        """
+        entry = self._cache.get(key)
+        if entry and (ttl is None or time.time() - entry['ts'] <= ttl):
+            return entry['value']
+        entry = self._load_cache_from_disk(key, ttl, with_ts=True)
+        if not entry:
+            return None
+        self._cache[key] = {"ts": entry.get('ts', 0), "value": entry.get('value')}
+        return entry.get('value')
+
+    def _save_cache(self, key, value):
+        self._cache[key] = {"ts": time.time(), "value": value}
+        self._save_cache_to_disk(key, value)
+
     def _save_cache_to_disk(self, key, value):
+        # Concurrent scans share the cache file; serialize read-modify-write
+        with self._cache_lock:
+            self._write_cache_entry(key, value)
+
+    def _write_cache_entry(self, key, value):
         try:
             os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
             if os.path.exists(self.cache_file):
@@ -58,6 +94,8 @@ class HFHandler:
         Clear both in-memory and on-disk caches.
         """
         self._cache = {}
+        with self._folder_index_lock:
+            self._folder_indexes.clear()
         try:
             if os.path.exists(self.cache_file):
                 os.remove(self.cache_file)
@@ -85,13 +123,86 @@ class HFHandler:
         memory_entries = len(self._cache)
         return {"success": True, "disk_entries": disk_entries, "memory_entries": memory_entries}
 
+    @staticmethod
+    def _file_extension(path):
+        lower = path.lower()
+        if lower.endswith('.jsonl.gz'):
+            return 'jsonl.gz'
+        if lower.endswith('.tar.gz'):
+            return 'tar.gz'
+        return lower.split('.')[-1] if '.' in path else 'unknown'
+
+    @staticmethod
+    def _build_folder_index(files):
+        """
+        Build a per-folder index from a flat file list.
+        Each folder maps to its recursive size/file count plus its direct
+        subfolders and files, so a drill-down only touches its children.
+        The repo root is stored under the empty path "".
+        """
+        folders = {"": {"size": 0, "file_count": 0, "dirs": [], "files": {}}}
+        for f in files:
+            parts = f['path'].split('/')
+            size = int(f['size'])
+            parent = ""
+            node = folders[""]
+            node["size"] += size
+            node["file_count"] += 1
+            for name in parts[:-1]:
+                current = f"{parent}/{name}" if parent else name
+                child = folders.get(current)
+                if child is None:
+                    child = {"size": 0, "file_count": 0, "dirs": [], "files": {}}
+                    folders[current] = child
+                    node["dirs"].append(name)
+                child["size"] += size
+                child["file_count"] += 1
+                parent, node = current, child
+            node["files"][parts[-1]] = size
+        for node in folders.values():
+            node["dirs"].sort()
+        return folders
+
+    @staticmethod
+    def _folder_summary(folders):
+        """Top-level folders of an index with their recursive size and file count."""
+        return [
+            {"name": name, "path": name, "size": folders[name]["size"], "file_count": folders[name]["file_count"]}
+            for name in folders[""]["dirs"]
+        ]
+
+    def _folder_index(self, cache_key, files=None, ttl=None):
+        """
+        The folder index of a scan, kept in a small in-memory LRU under the
+        scan's cache key (never in scan responses or the disk cache).
+        Built from files when missing or older than ttl; returns None if it
+        cannot be.
+        """
+        with self._folder_index_lock:
+            entry = self._folder_indexes.get(cache_key)
+            if entry is not None and (ttl is None or time.time() - entry["ts"] <= ttl):
+                self._folder_indexes.move_to_end(cache_key)
+                return entry["folders"]
+        if files is None:
+            return None
+        folders = self._build_folder_index(files)
+        self._store_folder_index(cache_key, folders)
+        return folders
+
+    def _store_folder_index(self, cache_key, folders):
+        with self._folder_index_lock:
+            self._folder_indexes[cache_key] = {"ts": time.time(), "folders": folders}
+            self._folder_indexes.move_to_end(cache_key)
+            while len(self._folder_indexes) > FOLDER_INDEX_CACHE_ENTRIES:
+                self._folder_indexes.popitem(last=False)
+
     def search_repositories(self, query, limit=20, sort="downloads", direction=-1, repo_type="model"):
         """
         Search HuggingFace for models or datasets.
         """
         try:
             if repo_type == "model":
-                results = list_models(
+                results = self.api.list_models(
                     search=query,
                     sort=sort,
                     direction=direction,
@@ -128,8 +239,8 @@ class HFHandler:
                         limit=limit
                     )
                 except Exception as e:
-                    # Fallback: try without sort parameter
-                    results = list_datasets(
+                    # Fallback: retry on a fresh client, still against the configured endpoint
+                    results = HfApi(endpoint=self.endpoint).list_datasets(
                         search=query,
                         limit=limit
                     )
@@ -197,9 +308,14 @@ class HFHandler:
 
         # Return cached result if requested
         if use_cache and not refresh:
-            cached = self._load_cache_from_disk(cache_key, ttl)
+            cached = self._load_cache(cache_key, ttl)
             if cached:
                 data = cached
+                if not isinstance(data.get('folders'), list):
+                    # Entries written without a summary (or with the full index embedded)
+                    folders = self._folder_index(cache_key, data['files'])
+                    data = {**data, "folders": self._folder_summary(folders)}
+                    self._cache[cache_key]["value"] = data
                 # Apply filtering on cached data if needed
                 if filter_exts:
                     filtered_files = [f for f in data['files'] if f['extension'] in filter_exts]
@@ -215,6 +331,7 @@ class HFHandler:
                         "success": True,
                         "files": filtered_files,
                         "extensions": extensions_filtered,
+                        "folders": self._folder_summary(self._build_folder_index(filtered_files)),
                         "total_files": len(filtered_files),
                         "from_cache": True
                     }
@@ -248,11 +365,7 @@ class HFHandler:
                 if size is None:
                     continue
 
-                ext = path.split('.')[-1].lower() if '.' in path else 'unknown'
-                if path.lower().endswith('.jsonl.gz'):
-                    ext = 'jsonl.gz'
-                elif path.lower().endswith('.tar.gz'):
-                    ext = 'tar.gz'
+                ext = self._file_extension(path)
 
                 file_info = {"path": path, "size": int(size), "extension": ext}
                 all_files.append(file_info)
@@ -263,10 +376,18 @@ class HFHandler:
                 extensions[ext]["total_size"] += int(size)
 
             all_files.sort(key=lambda x: x['path'])
-            data = {"success": True, "files": all_files, "extensions": extensions, "total_files": len(all_files)}
+            folders = self._build_folder_index(all_files)
+            self._store_folder_index(cache_key, folders)
+            data = {
+                "success": True,
+                "files": all_files,
+                "extensions": extensions,
+                "folders": self._folder_summary(folders),
+                "total_files": len(all_files)
+            }
 
             if use_cache:
-                self._save_cache_to_disk(cache_key, data)
+                self._save_cache(cache_key, data)
 
             if filter_exts:
                 filtered_files = [f for f in all_files if f['extension'] in filter_exts]
@@ -281,6 +402,7 @@ class HFHandler:
                     "success": True,
                     "files": filtered_files,
                     "extensions": extensions_filtered,
+                    "folders": self._folder_summary(self._build_folder_index(filtered_files)),
                     "total_files": len(filtered_files),
                     "from_cache": False
                 }
@@ -290,13 +412,131 @@ class HFHandler:
         except Exception as e:
             return {"success": False, "error": str(e)}
 
+    def list_folder(self, repo_id, path="", token=None, repo_type="model", options=None):
+        """
+        Drill down into a folder of a scanned repository.
+        Served from the folder index built by scan_repo (kept in memory
+        apart from the scan cache), so only the direct children of the
+        folder are visited.
+        """
+        opts = {"cache": True, **(options or {})}
+        opts.pop('filter_exts', None)
+        actual_token = token if token and str(token).strip() else None
+        cache_key = f"{repo_id}:{actual_token}:{repo_type}"
+        ttl = int(opts.get('cache_ttl', 300))
+        folders = None if opts.get('refresh') else self._folder_index(cache_key, ttl=ttl)
+        from_cache = folders is not None
+        if folders is None:
+            scan = self.scan_repo(repo_id, token, repo_type, options=opts)
+            if not scan.get('success'):
+                return scan
+            folders = self._folder_index(cache_key, scan['files'])
+            from_cache = scan.get('from_cache', False)
+
+        folder = (path or "").strip('/')
+        node = folders.get(folder)
+        if node is None:
+            return {"success": False, "error": f"Folder not found: {folder}"}
+
+        prefix = f"{folder}/" if folder else ""
+        dirs = []
+        for name in node["dirs"]:
+            child = folders[prefix + name]
+            dirs.append({
+                "name": name,
+                "path": prefix + name,
+                "size": child["size"],
+                "file_count": child["file_count"]
+            })
+        files = [
+            {"name": name, "path": prefix + name, "size": size, "extension": self._file_extension(name)}
+            for name, size in sorted(node["files"].items())
+        ]
+        return {
+            "success": True,
+            "path": folder,
+            "size": node["size"],
+            "file_count": node["file_count"],
+            "dirs": dirs,
+            "files": files,
+            "from_cache": from_cache
+        }
+
+    def scan_repos(self, repo_ids, token=None, repo_type="model", options=None, max_workers=8):
+        """
+        Generator that scans many repositories concurrently on a bounded pool.
+        Emits one JSON line per repo as soon as its scan finishes, then a
+        'done' event with combined size and extension totals.
+        Scans go through scan_repo, so they share its memory/disk cache.
+        """
+        opts = dict(options or {})
+        include_files = bool(opts.pop('include_files', False))
+        repo_ids = list(dict.fromkeys(r.strip() for r in repo_ids if r and r.strip()))
+        total_repos = len(repo_ids)
+        max_workers = max(1, min(int(max_workers), SCAN_MAX_WORKERS, total_repos or 1))
+
+        yield json.dumps({
+            "type": "start",
+            "total_repos": total_repos,
+            "message": f"Scanning {total_repos} repositories using {max_workers} threads..."
+        }) + "\n"
+
+        combined_extensions = {}
+        combined_size = 0
+        combined_files = 0
+        failed = 0
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self.scan_repo, r, token, repo_type, opts): r for r in repo_ids}
+            for future in as_completed(futures):
+                repo_id = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"success": False, "error": str(e)}
+
+                if not result.get('success'):
+                    failed += 1
+                    yield json.dumps({"type": "error", "repo_id": repo_id, "error": result.get('error')}) + "\n"
+                    continue
+
+                repo_size = sum(e["total_size"] for e in result['extensions'].values())
+                combined_size += repo_size
+                combined_files += result['total_files']
+                for ext, stats in result['extensions'].items():
+                    if ext not in combined_extensions:
+                        combined_extensions[ext] = {"count": 0, "total_size": 0}
+                    combined_extensions[ext]["count"] += stats["count"]
+                    combined_extensions[ext]["total_size"] += stats["total_size"]
+
+                event = {
+                    "type": "repo",
+                    "repo_id": repo_id,
+                    "total_files": result['total_files'],
+                    "total_size": repo_size,
+                    "extensions": result['extensions'],
+                    "from_cache": result.get('from_cache', False)
+                }
+                if include_files:
+                    event["files"] = result['files']
+                yield json.dumps(event) + "\n"
+
+        yield json.dumps({
+            "type": "done",
+            "total_repos": total_repos,
+            "failed_repos": failed,
+            "total_files": combined_files,
+            "total_size": combined_size,
+            "extensions": combined_extensions
+        }) + "\n"
+
     def generate_browser_links(self, repo_id, file_paths, repo_type="model"):
         """
         Generates direct download URLs for the browser.
         """
         links = []
         prefix = "datasets/" if repo_type == "dataset" else ""
-        base_url = f"https://huggingface.co/{prefix}{repo_id}/resolve/main"
+        base_url = f"{self.endpoint or 'https://huggingface.co'}/{prefix}{repo_id}/resolve/main"
         
         for path in file_paths:
             safe_path = quote(path)
@@ -383,6 +623,7 @@ class HFHandler:
                             repo_type=repo_type,
                             local_dir=local_dir,
                             token=actual_token,
+                            endpoint=self.endpoint,
                             local_dir_use_symlinks=False
                         )
                         success = True
@@ -0,0 +1,223 @@
+"""
+Sequence packing planner for fine-tuning datasets.
+
+Records are binned into fixed context-length sequences from their
+per-line token lengths (see tokenizer_utils.TokenLengthCache). The
+planner is best-fit-decreasing over integer lengths: records of the same
+length are placed as one block, so the Python-level work grows with the
+number of distinct lengths and open-bin capacities, not with the number
+of records.
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from prep_utils import open_jsonl_input, open_jsonl_output, PROGRESS_INTERVAL_SECONDS
+
+PACK_OVERFLOW_MODES = ('truncate', 'drop')
+# Spill partition size when writing a packed dataset
+PACK_PARTITION_BYTES = 64 * 1024**2
+PACK_MAX_PARTITIONS = 1024
+
+
+def _take_bins(stack, k):
+    """Pop k bin ids from a stack of id arrays."""
+    taken = []
+    while k:
+        ids = stack[-1]
+        if len(ids) <= k:
+            stack.pop()
+            taken.append(ids)
+            k -= len(ids)
+        else:
+            taken.append(ids[-k:])
+            stack[-1] = ids[:-k]
+            k = 0
+    return taken[0] if len(taken) == 1 else np.concatenate(taken)
+
+
+def plan_packing(lengths, max_length, overflow='truncate'):
+    """
+    Assign every line with tokens to a sequence of at most max_length
+    tokens. Lines longer than max_length are truncated to it (each fills a
+    sequence alone) or dropped. Returns (bin_of, packed_lengths): the
+    sequence index of every line (-1 when not packed) and the token count
+    each line contributes.
+    """
+    if overflow not in PACK_OVERFLOW_MODES:
+        raise ValueError(f"overflow must be one of {', '.join(PACK_OVERFLOW_MODES)}")
+    max_length = int(max_length)
+    if max_length < 1:
+        raise ValueError("max_length must be positive")
+    lengths = np.asarray(lengths)
+    packed_lengths = np.minimum(lengths, max_length).astype(np.int64)
+    if overflow == 'drop':
+        packed_lengths[lengths > max_length] = 0
+    bin_of = np.full(len(lengths), -1, dtype=np.int64)
+
+    candidates = np.flatnonzero(packed_lengths)
+    order = np.argsort(-packed_lengths[candidates], kind='stable')
+    items = candidates[order]
+    sizes = packed_lengths[items]
+    # Blocks of equal length, longest first
+    starts = np.flatnonzero(np.diff(sizes, prepend=-1))
+    ends = np.append(starts[1:], len(items))
+
+    # free[r]: stack of id arrays of open sequences with r tokens of room
+    free = [[] for _ in range(max_length)]
+    free_count = np.zeros(max_length, dtype=np.int64)
+    next_bin = 0
+    for start, end in zip(starts, ends):
+        size = int(sizes[start])
+        block = items[start:end]
+        placed = 0
+        # Best fit: the open sequences with the least room that still fits
+        while placed < len(block):
+            room = np.flatnonzero(free_count[size:])
+            if not len(room):
+                break
+            r = size + int(room[0])
+            k = min(len(block) - placed, int(free_count[r]))
+            bins = _take_bins(free[r], k)
+            free_count[r] -= k
+            bin_of[block[placed:placed + k]] = bins
+            placed += k
+            if r - size:
+                free[r - size].append(bins)
+                free_count[r - size] += k
+        rest = len(block) - placed
+        if rest:
+            # New sequences, each holding as many of these records as fit
+            per_bin = max_length // size
+            bin_of[block[placed:]] = next_bin + np.arange(rest) // per_bin
+            full, partial = divmod(rest, per_bin)
+            room = max_length - per_bin * size
+            if room and full:
+                free[room].append(np.arange(next_bin, next_bin + full))
+                free_count[room] += full
+            if partial:
+                free[max_length - partial * size].append(np.array([next_bin + full]))
+                free_count[max_length - partial * size] += 1
+            next_bin += full + (1 if partial else 0)
+    return bin_of, packed_lengths
+
+
+def packing_summary(lengths, bin_of, packed_lengths, max_length, overflow='truncate', batch_size=1, epochs=1):
+    """Padding waste and effective training steps, packed versus one record per sequence."""
+    lengths = np.asarray(lengths)
+    packed = bin_of >= 0
+    records = int(np.count_nonzero(packed))
+    sequences = int(bin_of.max()) + 1 if records else 0
+    tokens = int(packed_lengths.sum())
+    over = int(np.count_nonzero(lengths > max_length))
+    batch_size = max(1, int(batch_size))
+    epochs = max(1, int(epochs))
+
+    def steps(n):
+        return -(-n // batch_size) * epochs
+
+    def waste(capacity):
+        return round((capacity - tokens) / capacity * 100, 2) if capacity else 0
+
+    per_sequence = np.bincount(bin_of[packed], minlength=sequences) if records else np.zeros(0)
+    result = {
+        "max_length": max_length,
+        "records": records,
+        "total_tokens": tokens,
+        "over_max_length": over,
+        "overflow": overflow,
+        "packed": {
+            "sequences": sequences,
+            "padding_tokens": sequences * max_length - tokens,
+            "padding_waste_percent": waste(sequences * max_length),
+            "avg_records_per_sequence": round(records / sequences, 2) if sequences else 0,
+            "max_records_per_sequence": int(per_sequence.max()) if sequences else 0,
+            "steps": steps(sequences)
+        },
+        "unpacked": {
+            "sequences": records,
+            "padding_tokens": records * max_length - tokens,
+            "padding_waste_percent": waste(records * max_length),
+            "steps": steps(records)
+        },
+        "batch_size": batch_size,
+        "epochs": epochs
+    }
+    if overflow == 'truncate':
+        result["truncated_tokens"] = int(lengths[lengths > max_length].sum(dtype=np.uint64)) - over * max_length
+    if records:
+        result["steps_saved_percent"] = round((1 - steps(sequences) / steps(records)) * 100, 2)
+    return result
+
+
+def iter_write_packed(input_path, output_path, bin_of, packed_lengths, spill_dir=None):
+    """
+    Write one JSONL line per sequence, {"num_tokens": n, "records": [...]},
+    with records in file order and sequences in plan order. Lines are
+    spilled to partitions by sequence range first, so peak memory is about
+    one partition. Yields progress events, returns the sequence count.
+    """
+    sequences = int(bin_of.max()) + 1 if len(bin_of) and bin_of.max() >= 0 else 0
+    partitions = max(1, min(os.path.getsize(input_path) // PACK_PARTITION_BYTES + 1, PACK_MAX_PARTITIONS))
+    total_bytes = os.path.getsize(input_path)
+    last_report = time.monotonic()
+
+    with tempfile.TemporaryDirectory(prefix='xtools_pack_', dir=spill_dir) as tmp:
+        # Pass 1: spill "sequence \t line" into partitions of contiguous sequence ranges
+        spills = [open(os.path.join(tmp, f'part_{i:04d}'), 'w', encoding='utf-8') for i in range(partitions)]
+        text, raw = open_jsonl_input(input_path)
+        try:
+            for line_no, line in enumerate(text):
+                if line_no >= len(bin_of):
+                    break
+                seq = int(bin_of[line_no])
+                if seq < 0:
+                    continue
+                spills[seq * partitions // sequences].write(f"{seq}\t{line.strip()}\n")
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL_SECONDS:
+                    last_report = now
+                    yield {"type": "progress", "phase": "spill", "bytes_read": raw.tell(), "total_bytes": total_bytes}
+        finally:
+            text.close()
+            for f in spills:
+                f.close()
+
+        # Pass 2: group each partition by sequence and write it out
+        tokens = np.bincount(bin_of[bin_of >= 0], weights=packed_lengths[bin_of >= 0], minlength=sequences)
+        written = 0
+        with open_jsonl_output(output_path) as out:
+            for i in range(partitions):
+                part_path = os.path.join(tmp, f'part_{i:04d}')
+                groups = {}
+                with open(part_path, 'r', encoding='utf-8') as f:
+                    for entry in f:
+                        seq, line = entry.rstrip('\n').split('\t', 1)
+                        groups.setdefault(int(seq), []).append(line)
+                os.remove(part_path)
+                for seq in sorted(groups):
+                    out.write(f'{{"num_tokens": {int(tokens[seq])}, "records": [{", ".join(groups[seq])}]}}\n')
+                written += len(groups)
+                yield {"type": "progress", "phase": "write", "sequences_written": written, "sequences": sequences}
+    return written
+
+
+def iter_pack(input_path, lengths, max_length, overflow='truncate', batch_size=1, epochs=1,
+              output_path=None, spill_dir=None):
+    """Plan packing over per-line token lengths, optionally write the packed dataset, and yield a done report."""
+    started = time.perf_counter()
+    bin_of, packed_lengths = plan_packing(lengths, max_length, overflow)
+    plan_seconds = time.perf_counter() - started
+    result = packing_summary(lengths, bin_of, packed_lengths, int(max_length), overflow, batch_size, epochs)
+    if output_path:
+        yield from iter_write_packed(input_path, output_path, bin_of, packed_lengths, spill_dir)
+        result["output_path"] = output_path
+    yield {
+        "type": "done",
+        "success": True,
+        **result,
+        "plan_seconds": round(plan_seconds, 3),
+        "seconds": round(time.perf_counter() - started, 3)
+    }
@@ -0,0 +1,419 @@
+"""
+Fused Data Preparation pipeline: validate -> clean -> filter ->
+tokenize-stats -> split over a single streaming read.
+
+The input is read and parsed once. Records move through the stages in
+batches (so tokenization and MinHash can be vectorized), each stage drops
+what it rejects and passes the rest on, and every stage reports its own
+counts and time.
+"""
+import json
+import os
+import re
+import time
+
+from prep_utils import (fast_loads, open_jsonl_input, open_jsonl_output, LineValidator, RecordCleaner,
+                        NearDedupStage, extract_text, HashSplitter, parse_split_ratios, split_output_paths,
+                        MAX_ERRORS_REPORTED, PROGRESS_INTERVAL_SECONDS)
+from tokenizer_utils import token_lengths
+
+PIPELINE_BATCH = 256
+
+
+class PipelineItem:
+    __slots__ = ('line_no', 'line', 'record', 'error')
+
+    def __init__(self, line_no, line, record=None, error=None):
+        self.line_no = line_no
+        self.line = line
+        self.record = record
+        self.error = error
+
+
+class PipelineStage:
+    """Base stage: process() takes a batch of items and returns the ones to keep, in order."""
+    name = 'stage'
+
+    def __init__(self, options):
+        self.options = options
+        self.seconds = 0.0
+        self.records_in = 0
+        self.records_out = 0
+
+    def __call__(self, items):
+        started = time.perf_counter()
+        kept = self.process(items)
+        self.seconds += time.perf_counter() - started
+        self.records_in += len(items)
+        self.records_out += len(kept)
+        return kept
+
+    def process(self, items):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+    def report(self):
+        return {}
+
+    def summary(self):
+        return {
+            "stage": self.name,
+            "seconds": round(self.seconds, 3),
+            "records_in": self.records_in,
+            "records_out": self.records_out,
+            **self.report()
+        }
+
+
+class ValidateStage(PipelineStage):
+    """prep_validate's checks. Invalid lines are dropped unless drop_invalid is false."""
+    name = 'validate'
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.validator = LineValidator(options)
+        self.drop_invalid = options.get('drop_invalid', True)
+        self.valid = self.invalid = self.total_errors = 0
+        self.errors = []
+
+    def process(self, items):
+        kept = []
+        for item in items:
+            if item.error == 'empty':
+                valid, messages = False, ["Empty line"]
+            else:
+                valid, messages = self.validator.check_parsed(item.record, item.error)
+            if valid:
+                self.valid += 1
+                kept.append(item)
+                continue
+            self.invalid += 1
+            self.total_errors += len(messages)
+            for m in messages:
+                if len(self.errors) < MAX_ERRORS_REPORTED:
+                    self.errors.append({"line": item.line_no, "message": m})
+            if not self.drop_invalid:
+                kept.append(item)
+        return kept
+
+    def report(self):
+        total = self.valid + self.invalid
+        return {
+            "valid_count": self.valid,
+            "invalid_count": self.invalid,
+            "success_rate": round(self.valid / total * 100, 2) if total > 0 else 0,
+            "errors": self.errors,
+            "total_errors": self.total_errors
+        }
+
+
+class CleanStage(PipelineStage):
+    """prep_clean's rules, including optional near-dedup, on already parsed records."""
+    name = 'clean'
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.cleaner = RecordCleaner(options)
+        self.near = NearDedupStage.from_options(options)
+        self.removed = {"duplicate": 0, "near_duplicate": 0, "empty": 0, "too_short": 0, "invalid": 0}
+
+    def process(self, items):
+        kept = []
+        for item in items:
+            record, reason = self.cleaner.clean(item.record)
+            if reason:
+                self.removed[reason] += 1
+                continue
+            item.record = record
+            kept.append(item)
+        if self.near and kept:
+            signatures, empty = self.near.signatures([item.record for item in kept])
+            survivors = []
+            for item, signature, is_empty in zip(kept, signatures, empty):
+                if self.near.filter.check(signature, is_empty):
+                    self.removed["near_duplicate"] += 1
+                else:
+                    survivors.append(item)
+            kept = survivors
+        return kept
+
+    def report(self):
+        result = {"removed_by": self.removed, "unique_digests": len(self.cleaner.seen)}
+        if self.near:
+            result["near_dedup"] = self.near.filter.stats()
+        return result
+
+
+class FilterStage(PipelineStage):
+    """
+    Keeps records matching every rule. A rule names a field and any of
+    min_length / max_length (characters of str(value)), regex (must match)
+    and exclude_regex (must not match). A missing field fails its rule.
+    """
+    name = 'filter'
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.rules = []
+        for rule in options.get('rules', []):
+            if not rule.get('field'):
+                raise ValueError("Every filter rule needs a field")
+            self.rules.append({
+                "field": rule['field'],
+                "min_length": self._length(rule, 'min_length'),
+                "max_length": self._length(rule, 'max_length'),
+                "regex": self._pattern(rule, 'regex'),
+                "exclude_regex": self._pattern(rule, 'exclude_regex')
+            })
+        self.failed_by_field = {}
+
+    @staticmethod
+    def _length(rule, key):
+        value = rule.get(key)
+        if value is None:
+            return None
+        try:
+            if isinstance(value, bool):
+                raise TypeError
+            length = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Filter rule {key} for '{rule['field']}' must be an integer") from None
+        if length < 0:
+            raise ValueError(f"Filter rule {key} for '{rule['field']}' must not be negative")
+        return length
+
+    @staticmethod
+    def _pattern(rule, key):
+        if not rule.get(key):
+            return None
+        try:
+            return re.compile(rule[key])
+        except re.error as e:
+            raise ValueError(f"Filter rule {key} for '{rule['field']}' is not a valid regex: {e}") from None
+
+    def _passes(self, record, rule):
+        if not isinstance(record, dict) or record.get(rule["field"]) is None:
+            return False
+        value = record[rule["field"]]
+        text = value if isinstance(value, str) else str(value)
+        if rule["min_length"] is not None and len(text) < rule["min_length"]:
+            return False
+        if rule["max_length"] is not None and len(text) > rule["max_length"]:
+            return False
+        if rule["regex"] is not None and not rule["regex"].search(text):
+            return False
+        if rule["exclude_regex"] is not None and rule["exclude_regex"].search(text):
+            return False
+        return True
+
+    def process(self, items):
+        kept = []
+        for item in items:
+            for rule in self.rules:
+                if not self._passes(item.record, rule):
+                    self.failed_by_field[rule["field"]] = self.failed_by_field.get(rule["field"], 0) + 1
+                    break
+            else:
+                kept.append(item)
+        return kept
+
+    def report(self):
+        return {"failed_by_field": self.failed_by_field}
+
+
+class TokenizeStatsStage(PipelineStage):
+    """Token counts of text_field with the model_base tokenizer, one batched call per batch."""
+    name = 'tokenize_stats'
+
+    def __init__(self, options, tokenizer):
+        super().__init__(options)
+        self.tokenizer = tokenizer
+        self.model_base = options.get('model_base')
+        self.text_field = options.get('text_field', 'text')
+        self.max_length = options.get('max_length')
+        self.count = self.total = self.max = self.over_max_length = 0
+
+    def process(self, items):
+        texts = [extract_text(item.record, self.text_field) if isinstance(item.record, dict) else ''
+                 for item in items]
+        texts = [t for t in texts if t]
+        if texts:
+            lengths = token_lengths(self.tokenizer, texts)
+            self.count += len(lengths)
+            self.total += sum(lengths)
+            self.max = max(self.max, max(lengths))
+            if self.max_length:
+                self.over_max_length += sum(1 for n in lengths if n > self.max_length)
+        return items
+
+    def report(self):
+        result = {
+            "tokenizer": self.model_base,
+            "text_field": self.text_field,
+            "record_count": self.count,
+            "total_tokens": self.total,
+            "max_tokens": self.max,
+            "avg_tokens": round(self.total / self.count, 2) if self.count else 0
+        }
+        if self.max_length:
+            result["max_length"] = self.max_length
+            result["over_max_length"] = self.over_max_length
+        return result
+
+
+class SplitStage(PipelineStage):
+    """
+    Terminal stage: writes each record to a named split chosen by
+    HashSplitter (seeded hash of the record or of key_field).
+    """
+    name = 'split'
+
+    def __init__(self, options, input_path):
+        super().__init__(options)
+        splits = parse_split_ratios(options.get('splits'), float(options.get('train_ratio', 0.8)))
+        self.splitter = HashSplitter(splits, options.get('random_seed', 42), options.get('key_field'))
+        self.files = split_output_paths(input_path, options.get('output_dir'), splits)
+        self.counts = {name: 0 for name in splits}
+        self.handles = {name: open_jsonl_output(path) for name, path in self.files.items()}
+
+    def process(self, items):
+        for item in items:
+            name = self.splitter.assign(item.record)
+            self.handles[name].write(json.dumps(item.record, ensure_ascii=False) + '\n')
+            self.counts[name] += 1
+        return items
+
+    def finish(self):
+        for handle in self.handles.values():
+            handle.close()
+
+    def report(self):
+        total = sum(self.counts.values())
+        return {
+            "splits": {
+                name: {"count": n, "percent": round(n / total * 100, 1) if total else 0, "file": self.files[name]}
+                for name, n in self.counts.items()
+            },
+            "missing_key": self.splitter.missing_key
+        }
+
+
+STAGE_TYPES = ('validate', 'clean', 'filter', 'tokenize_stats', 'split')
+
+
+def build_stages(stage_specs, input_path, load_tokenizer=None):
+    """
+    Build stages from [{"type": ..., ...options}]. validate may only come
+    first and split only last. load_tokenizer(model_base, revision) is
+    called for a tokenize_stats stage. Raises ValueError on a bad spec.
+    """
+    if not stage_specs:
+        raise ValueError("At least one stage is required")
+    stages = []
+    for i, spec in enumerate(stage_specs):
+        kind = spec.get('type')
+        if kind not in STAGE_TYPES:
+            raise ValueError(f"Unknown stage type: {kind}. Use one of {', '.join(STAGE_TYPES)}")
+        if kind == 'validate' and i != 0:
+            raise ValueError("validate must be the first stage")
+        if kind == 'split' and i != len(stage_specs) - 1:
+            raise ValueError("split must be the last stage")
+        if kind == 'validate':
+            stages.append(ValidateStage(spec))
+        elif kind == 'clean':
+            stages.append(CleanStage(spec))
+        elif kind == 'filter':
+            stages.append(FilterStage(spec))
+        elif kind == 'tokenize_stats':
+            if load_tokenizer is None:
+                raise ValueError("tokenize_stats needs a tokenizer loader")
+            spec = {**spec, "model_base": spec.get('model_base', 'Qwen/Qwen2-7B-Instruct')}
+            stages.append(TokenizeStatsStage(spec, load_tokenizer(spec["model_base"], spec.get('revision'))))
+        else:
+            stages.append(SplitStage(spec, input_path))
+    return stages
+
+
+def iter_pipeline(input_path, stages, output_path=None):
+    """
+    Run stages over one streaming read of a JSONL(.gz) file. Records that
+    survive every stage are written to output_path when given. Yields
+    progress events, then a {"type": "done", ...} report with per-stage
+    summaries and timings.
+    """
+    started = time.perf_counter()
+    validate = stages[0] if stages and isinstance(stages[0], ValidateStage) else None
+    rest = stages[1:] if validate else stages
+    total_bytes = os.path.getsize(input_path)
+    counts = {"lines": 0, "records": 0, "parse_errors": 0, "records_out": 0}
+    parse_seconds = 0.0
+    last_report = time.monotonic()
+    out = open_jsonl_output(output_path) if output_path else None
+
+    def run(batch):
+        items = validate(batch) if validate else batch
+        items = [item for item in items if item.error is None]
+        for stage in rest:
+            if not items:
+                break
+            items = stage(items)
+        if out is not None:
+            for item in items:
+                out.write(json.dumps(item.record, ensure_ascii=False) + '\n')
+        counts["records_out"] += len(items)
+
+    text, raw = open_jsonl_input(input_path)
+    try:
+        batch = []
+        for line in text:
+            counts["lines"] += 1
+            parse_started = time.perf_counter()
+            if not line.strip():
+                item = PipelineItem(counts["lines"], line, error='empty')
+            else:
+                try:
+                    item = PipelineItem(counts["lines"], line, fast_loads(line))
+                    counts["records"] += 1
+                except ValueError as e:
+                    item = PipelineItem(counts["lines"], line, error=e)
+                    counts["parse_errors"] += 1
+            parse_seconds += time.perf_counter() - parse_started
+            if item.error == 'empty' and not validate:
+                continue
+            batch.append(item)
+            if len(batch) >= PIPELINE_BATCH:
+                run(batch)
+                batch = []
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL_SECONDS:
+                    last_report = now
+                    yield {
+                        "type": "progress",
+                        "bytes_read": raw.tell(),
+                        "total_bytes": total_bytes,
+                        "lines_read": counts["lines"],
+                        "records_out": counts["records_out"]
+                    }
+        if batch:
+            run(batch)
+    finally:
+        text.close()
+        for stage in stages:
+            stage.finish()
+        if out is not None:
+            out.close()
+
+    yield {
+        "type": "done",
+        "success": True,
+        "total_lines": counts["lines"],
+        "parsed_records": counts["records"],
+        "parse_errors": counts["parse_errors"],
+        "records_out": counts["records_out"],
+        "output_path": output_path,
+        "read_parse_seconds": round(parse_seconds, 3),
+        "total_seconds": round(time.perf_counter() - started, 3),
+        "stages": [stage.summary() for stage in stages]
+    }
@@ -0,0 +1,1100 @@
+"""
+Streaming record pipelines for the Data Preparation endpoints.
+
+Records are parsed, filtered, normalized and written one line at a time,
+so memory does not grow with the size of the input. Deduplication keeps
+fixed-size digests of the records written so far instead of the records
+themselves.
+
+Uncompressed inputs can also be processed in parallel: the file is cut
+into newline-aligned byte ranges that worker processes handle
+independently, and the per-range results are merged in file order so the
+output is identical to a single-process run. orjson (in requirements.txt)
+is used for parsing; without it the json module is used and a warning is
+printed on import.
+"""
+import base64
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    print("Warning: orjson not found, prep endpoints parse JSON with the slower json module")
+
+DIGEST_BYTES = 16
+PROGRESS_INTERVAL_SECONDS = 0.5
+SPECIAL_CHARS_RE = re.compile(r'[^\w\s-]')
+RANGE_BLOCK_BYTES = 16 * 1024**2
+# Ranges per worker; more, smaller ranges even out skewed line lengths
+RANGES_PER_WORKER = 4
+MIN_RANGE_BYTES = 8 * 1024**2
+MAX_ERRORS_REPORTED = 50
+NEAR_DEDUP_BATCH = 512
+# orjson turns integers beyond 64 bits into floats; leave such lines to json
+LONG_DIGITS_RE = re.compile(r'\d{19}')
+
+
+def fast_loads(line):
+    """
+    json.loads semantics with orjson speed. Anything orjson rejects (NaN,
+    lone surrogates, syntax errors) is retried with json.loads, which either
+    accepts it or raises the usual JSONDecodeError. Lines with 19+ digit
+    runs skip orjson, which would read huge integers as floats.
+    """
+    if orjson is not None and not LONG_DIGITS_RE.search(line):
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(line)
+
+
+def resolve_workers(value):
+    """Worker count from a request option: 0/None/'auto' means every core.
+
+    Raises ValueError for anything that is not a non-negative integer, so routes
+    can answer 400 before any work starts.
+    """
+    if value in (None, 'auto') or (value == 0 and not isinstance(value, bool)):
+        return os.cpu_count() or 1
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError("workers must be a non-negative integer or 'auto'")
+    try:
+        workers = int(value)
+    except ValueError:
+        raise ValueError("workers must be a non-negative integer or 'auto'") from None
+    if workers < 0:
+        raise ValueError("workers must be a non-negative integer or 'auto'")
+    return workers or os.cpu_count() or 1
+
+
+def can_shard(path, workers):
+    return workers > 1 and not path.lower().endswith('.gz')
+
+
+def newline_ranges(path, parts):
+    """
+    Split a file into up to `parts` (start, end) byte ranges, each ending
+    just after a newline (or at EOF), so no line straddles two ranges.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    parts = max(1, min(parts, size // MIN_RANGE_BYTES + 1))
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, parts):
+            target = max(size * i // parts, bounds[-1])
+            f.seek(target)
+            f.readline()
+            pos = f.tell()
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _translate_newlines(text):
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def iter_checked_lines(stream, limit=None):
+    """
+    Yield (line, valid_utf8) for a binary stream (up to limit bytes), with
+    lines exactly as iterating a TextIOWrapper(encoding='utf-8',
+    errors='replace') would produce them: universal newlines translated to
+    '\n' and kept on each line. Blocks are decoded at newline boundaries
+    (UTF-8 sequences never contain a newline byte); only a block that fails
+    to decode is re-decoded line by line to flag the bad lines.
+    """
+    carry = b''
+    remaining = limit
+    while True:
+        size = RANGE_BLOCK_BYTES if remaining is None else min(RANGE_BLOCK_BYTES, remaining)
+        block = stream.read(size) if size > 0 else b''
+        if remaining is not None:
+            remaining -= len(block)
+        if not block and not carry:
+            return
+        data = carry + block
+        if block:
+            cut = data.rfind(b'\n') + 1
+            if cut == 0:
+                carry = data
+                continue
+            data, carry = data[:cut], data[cut:]
+        else:
+            carry = b''
+        try:
+            lines = _translate_newlines(data.decode('utf-8')).split('\n')
+            for line in lines[:-1]:
+                yield line + '\n', True
+            if lines[-1]:
+                yield lines[-1], True
+        except UnicodeDecodeError:
+            segments = data.split(b'\n')
+            for i, segment in enumerate(segments):
+                try:
+                    text, valid = segment.decode('utf-8'), True
+                except UnicodeDecodeError:
+                    text, valid = segment.decode('utf-8', errors='replace'), False
+                if i < len(segments) - 1:
+                    text += '\n'
+                lines = _translate_newlines(text).split('\n')
+                for line in lines[:-1]:
+                    yield line + '\n', valid
+                if lines[-1]:
+                    yield lines[-1], valid
+
+
+def iter_range_lines(path, start, end, encoding_state=None):
+    """
+    Yield the text lines of bytes [start, end) as iter_checked_lines does.
+    If encoding_state is a dict, encoding_state["valid_utf8"] is cleared on
+    undecodable bytes.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        for line, valid in iter_checked_lines(f, end - start):
+            if not valid and encoding_state is not None:
+                encoding_state["valid_utf8"] = False
+            yield line
+
+
+def run_shards(task, path, ranges, args, workers):
+    """Run task(path, start, end, *args) over ranges on a process pool; yield results in range order."""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(task, path, start, end, *args) for start, end in ranges]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+class _BoundedReader(io.RawIOBase):
+    """Raw reader that reports EOF after a fixed number of bytes."""
+
+    def __init__(self, raw, limit):
+        self._raw = raw
+        self._remaining = limit
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._remaining <= 0:
+            return 0
+        n = self._raw.readinto(memoryview(b)[:self._remaining]) or 0
+        self._remaining -= n
+        return n
+
+    def close(self):
+        self._raw.close()
+        super().close()
+
+
+def open_jsonl_input(path, start_offset=0, end_offset=None):
+    """
+    Open a JSONL(.gz) file for text reading. Returns (text, raw) where raw
+    is the underlying binary file; raw.tell() is the compressed position
+    and serves as a progress counter. start_offset (uncompressed files
+    only) must be at a line boundary; end_offset (uncompressed files only)
+    makes reading stop there even if the file has grown since.
+    """
+    raw = open(path, 'rb')
+    if start_offset:
+        raw.seek(start_offset)
+    if path.lower().endswith('.gz'):
+        stream = gzip.GzipFile(fileobj=raw, mode='rb')
+    elif end_offset is not None:
+        stream = io.BufferedReader(_BoundedReader(raw, end_offset - start_offset))
+    else:
+        stream = raw
+    return io.TextIOWrapper(stream, encoding='utf-8', errors='replace'), raw
+
+
+def open_jsonl_output(path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)) or '.', exist_ok=True)
+    if path.lower().endswith('.gz'):
+        return gzip.open(path, 'wt', encoding='utf-8')
+    return open(path, 'w', encoding='utf-8')
+
+
+def strip_jsonl_extension(path):
+    for suffix in ('.gz', '.jsonl'):
+        if path.lower().endswith(suffix):
+            path = path[:-len(suffix)]
+    return path
+
+
+@contextlib.contextmanager
+def open_record_output(output_path, shards=None, name='output', schema_source=None):
+    """
+    Yield (writer, info) for record output: a plain JSONL(.gz) file, or with
+    shards (see parse_shard_options) a ShardedWriter next to output_path.
+    Parquet shards share one schema inferred from schema_source (the input).
+    After the block, info["shard_index"] holds the index path and contents.
+    """
+    info = {}
+    if not shards:
+        with open_jsonl_output(output_path) as out:
+            yield out, info
+        return
+    prefix = strip_jsonl_extension(output_path)
+    sharded = ShardedOutput(shards, prefix + '.index.json', schema_source)
+    writer = sharded.writer(name, prefix)
+    try:
+        yield writer, info
+    except BaseException:
+        sharded.executor.shutdown(wait=True)
+        raise
+    info["shard_index"] = {"path": sharded.index_path, **sharded.close()}
+
+
+def record_digest(record):
+    """128-bit digest of a record's canonical JSON (key order does not matter)."""
+    raw = json.dumps(record, sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(raw.encode('utf-8'), digest_size=DIGEST_BYTES).digest()
+
+
+def _has_valid_data(record):
+    for v in record.values():
+        if v is not None and v != '' and v != [] and v != {}:
+            return True
+    return False
+
+
+class RecordCleaner:
+    """
+    Per-record cleaning rules configured from prep_clean options.
+    clean() returns (record, None) for a record to keep, or (None, reason)
+    when it is dropped. Duplicates are checked last, on the normalized
+    record that would be written; prepare() applies everything else.
+    """
+
+    def __init__(self, options=None):
+        options = options or {}
+        self.remove_duplicates = options.get('remove_duplicates', True)
+        self.handle_nulls = options.get('handle_nulls', True)
+        self.normalize_text = options.get('normalize_text', True)
+        self.remove_special_chars = options.get('remove_special_chars', False)
+        self.min_length = int(options.get('min_length', 10)) if options.get('filter_min_length', False) else None
+        self.seen = set()
+
+    def prepare(self, record):
+        if not isinstance(record, dict):
+            return None, 'invalid'
+        if self.handle_nulls and not _has_valid_data(record):
+            return None, 'empty'
+
+        if self.normalize_text or self.remove_special_chars:
+            for key, value in record.items():
+                if isinstance(value, str):
+                    if self.normalize_text:
+                        value = value.strip()
+                    if self.remove_special_chars:
+                        value = SPECIAL_CHARS_RE.sub('', value)
+                    record[key] = value
+
+        if self.min_length is not None and not any(
+                len(v) >= self.min_length for v in record.values() if isinstance(v, str)):
+            return None, 'too_short'
+        return record, None
+
+    def is_duplicate(self, digest):
+        if digest in self.seen:
+            return True
+        self.seen.add(digest)
+        return False
+
+    def clean(self, record):
+        record, reason = self.prepare(record)
+        if reason:
+            return None, reason
+        if self.remove_duplicates and self.is_duplicate(record_digest(record)):
+            return None, 'duplicate'
+        return record, None
+
+
+def _clean_summary(counts, output_path, cleaner, near=None, output_info=None):
+    initial_count, final_count = counts["initial_count"], counts["final_count"]
+    removed_count = initial_count - final_count
+    return {
+        "type": "done",
+        "success": True,
+        "initial_count": initial_count,
+        "final_count": final_count,
+        "removed_count": removed_count,
+        "removed_by": counts["removed_by"],
+        "reduction_percent": round((removed_count / initial_count * 100), 2) if initial_count > 0 else 0,
+        "output_path": output_path,
+        "parse_errors": counts["parse_errors"],
+        "unique_digests": len(cleaner.seen),
+        **({"near_dedup": near.filter.stats()} if near else {}),
+        **(output_info or {})
+    }
+
+
+def _new_clean_counts():
+    return {
+        "initial_count": 0,
+        "final_count": 0,
+        "parse_errors": 0,
+        "removed_by": {"duplicate": 0, "near_duplicate": 0, "empty": 0, "too_short": 0, "invalid": 0}
+    }
+
+
+class NearDedupStage:
+    """
+    prep_clean's optional near-duplicate pass (see dedup_utils). Records
+    are hashed in batches of NEAR_DEDUP_BATCH; decisions are still made one
+    record at a time in file order.
+    """
+
+    def __init__(self, options):
+        from dedup_utils import MinHasher, NearDuplicateFilter, DEFAULT_NUM_PERM, DEFAULT_THRESHOLD
+        num_perm = int(options.get('near_dedup_num_perm', DEFAULT_NUM_PERM))
+        self.hasher = MinHasher(num_perm, options.get('near_dedup_shingle', 'char'),
+                                options.get('near_dedup_shingle_size'))
+        self.filter = NearDuplicateFilter(num_perm, float(options.get('near_dedup_threshold', DEFAULT_THRESHOLD)))
+        self.fields = options.get('near_dedup_fields') or None
+
+    @classmethod
+    def from_options(cls, options):
+        return cls(options) if (options or {}).get('near_dedup', False) else None
+
+    def signatures(self, records):
+        from dedup_utils import record_text
+        return self.hasher.signatures([record_text(r, self.fields) for r in records])
+
+
+def _write_near_dedup_batch(out, batch, near, counts):
+    signatures, empty = near.signatures(batch)
+    for record, signature, is_empty in zip(batch, signatures, empty):
+        if near.filter.check(signature, is_empty):
+            counts["removed_by"]["near_duplicate"] += 1
+            continue
+        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        counts["final_count"] += 1
+    batch.clear()
+
+
+def iter_clean(input_path, output_path, options=None, workers=1, shards=None):
+    """
+    Clean a JSONL(.gz) file in a single streaming pass.
+
+    Yields progress events ({"type": "progress", ...}) at most every
+    PROGRESS_INTERVAL_SECONDS, then one {"type": "done", ...} summary.
+    Peak memory is the dedup set: one DIGEST_BYTES digest per unique record,
+    plus one MinHash signature per kept record when near_dedup is on.
+    With workers > 1 an uncompressed input is cleaned by _iter_clean_sharded.
+    shards (see parse_shard_options) writes compressed output shards plus
+    an index instead of one file.
+    """
+    if can_shard(input_path, workers):
+        yield from _iter_clean_sharded(input_path, output_path, options, workers, shards)
+        return
+
+    cleaner = RecordCleaner(options)
+    near = NearDedupStage.from_options(options)
+    pending = []
+    total_bytes = os.path.getsize(input_path)
+    counts = _new_clean_counts()
+    removed = counts["removed_by"]
+    last_report = time.monotonic()
+
+    text, raw = open_jsonl_input(input_path)
+    try:
+        with open_record_output(output_path, shards, 'cleaned', input_path) as (out, output_info):
+            for line in text:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = fast_loads(line)
+                except ValueError:
+                    counts["parse_errors"] += 1
+                    continue
+                counts["initial_count"] += 1
+                record, reason = cleaner.clean(record)
+                if reason:
+                    removed[reason] += 1
+                elif near:
+                    pending.append(record)
+                    if len(pending) >= NEAR_DEDUP_BATCH:
+                        _write_near_dedup_batch(out, pending, near, counts)
+                else:
+                    out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    counts["final_count"] += 1
+
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL_SECONDS:
+                    last_report = now
+                    yield {
+                        "type": "progress",
+                        "bytes_read": raw.tell(),
+                        "total_bytes": total_bytes,
+                        "records_read": counts["initial_count"],
+                        "records_written": counts["final_count"]
+                    }
+            if pending:
+                _write_near_dedup_batch(out, pending, near, counts)
+    finally:
+        text.close()
+
+    yield _clean_summary(counts, output_path, cleaner, near, output_info)
+
+
+def _spill_batch(out, batch, near):
+    signatures, empty = near.signatures([record for _, record in batch]) if near else (None, None)
+    for i, (digest, record) in enumerate(batch):
+        signature = ''
+        if near and not empty[i]:
+            signature = base64.b64encode(signatures[i].tobytes()).decode('ascii')
+        out.write(f"{digest}\t{signature}\t{json.dumps(record, ensure_ascii=False)}\n")
+    batch.clear()
+
+
+def _clean_range(path, start, end, options, spill_dir):
+    """
+    Worker: clean one byte range without deduplicating. Survivors are
+    spilled as "digest \t minhash \t json" lines so the parent can dedup
+    in file order.
+    """
+    cleaner = RecordCleaner(options)
+    near = NearDedupStage.from_options(options)
+    counts = _new_clean_counts()
+    batch = []
+    spill_path = os.path.join(spill_dir, f"range_{start:016d}.tsv")
+    with open(spill_path, 'w', encoding='utf-8', newline='\n') as out:
+        for line in iter_range_lines(path, start, end):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = fast_loads(line)
+            except ValueError:
+                counts["parse_errors"] += 1
+                continue
+            counts["initial_count"] += 1
+            record, reason = cleaner.prepare(record)
+            if reason:
+                counts["removed_by"][reason] += 1
+                continue
+            batch.append((record_digest(record).hex() if cleaner.remove_duplicates else '', record))
+            if len(batch) >= NEAR_DEDUP_BATCH:
+                _spill_batch(out, batch, near)
+        if batch:
+            _spill_batch(out, batch, near)
+    counts["spill_path"] = spill_path
+    return counts
+
+
+def _iter_clean_sharded(input_path, output_path, options, workers, shards=None):
+    # Workers parse, filter, normalize and hash; the parent only dedups
+    # digests and copies lines, in range order, so output matches one process
+    cleaner = RecordCleaner(options)
+    near = NearDedupStage.from_options(options)
+    counts = _new_clean_counts()
+    total_bytes = os.path.getsize(input_path)
+    ranges = newline_ranges(input_path, workers * RANGES_PER_WORKER)
+    spill_root = os.path.dirname(os.path.abspath(output_path)) or None
+    os.makedirs(spill_root, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(prefix='.xtools_clean_', dir=spill_root) as spill_dir:
+        with open_record_output(output_path, shards, 'cleaned', input_path) as (out, output_info):
+            results = run_shards(_clean_range, input_path, ranges, (options, spill_dir), workers)
+            for (start, end), shard in zip(ranges, results):
+                for key in ("initial_count", "parse_errors"):
+                    counts[key] += shard[key]
+                for reason, n in shard["removed_by"].items():
+                    counts["removed_by"][reason] += n
+                with open(shard["spill_path"], 'r', encoding='utf-8', newline='\n') as f:
+                    for entry in f:
+                        digest, signature, line = entry.split('\t', 2)
+                        if digest and cleaner.is_duplicate(bytes.fromhex(digest)):
+                            counts["removed_by"]["duplicate"] += 1
+                            continue
+                        if near:
+                            vector = np.frombuffer(base64.b64decode(signature), dtype=np.uint32)
+                            if near.filter.check(vector, empty=not signature):
+                                counts["removed_by"]["near_duplicate"] += 1
+                                continue
+                        out.write(line)
+                        counts["final_count"] += 1
+                os.remove(shard["spill_path"])
+                yield {
+                    "type": "progress",
+                    "bytes_read": end,
+                    "total_bytes": total_bytes,
+                    "records_read": counts["initial_count"],
+                    "records_written": counts["final_count"]
+                }
+
+    yield _clean_summary(counts, output_path, cleaner, near, output_info)
+
+
+class InvalidEncoding(ValueError):
+    pass
+
+
+class LineValidator:
+    """
+    prep_validate's per-line checks. check() returns (valid, messages);
+    an invalid line can have no messages (unparseable with validate_json off).
+    """
+
+    def __init__(self, options=None):
+        options = options or {}
+        self.validate_json = options.get('validate_json', True)
+        self.validate_fields = options.get('validate_fields', True)
+        self.validate_types = options.get('validate_types', False)
+        self.required_fields = options.get('required_fields', []) or []
+
+    def check(self, line):
+        if not line.strip():
+            return False, ["Empty line"]
+        try:
+            record = fast_loads(line)
+        except ValueError as e:
+            return self.check_parsed(None, e)
+        return self.check_parsed(record)
+
+    def check_parsed(self, record, error=None):
+        """Checks for a line that was already parsed (error is the parse exception, if any)."""
+        if error is not None:
+            # fast_loads re-raises json's own error, so messages don't depend on orjson
+            if not self.validate_json:
+                return False, []
+            return False, [f"Invalid JSON: {str(error)}"]
+
+        line_errors = []
+        if self.validate_fields and self.required_fields:
+            missing_fields = [f for f in self.required_fields if f not in record]
+            if missing_fields:
+                line_errors.append(f"Missing fields: {', '.join(missing_fields)}")
+
+        if self.validate_types and isinstance(record, dict):
+            for key, value in record.items():
+                if value is not None and not isinstance(value, (str, int, float, bool, list, dict)):
+                    line_errors.append(f"Field '{key}' has unsupported type: {type(value).__name__}")
+
+        if line_errors:
+            return False, line_errors[:3]  # Limit errors per line
+        return True, []
+
+
+def _validate_range(path, start, end, options):
+    validator = LineValidator(options)
+    encoding_state = {"valid_utf8": True}
+    result = {"lines": 0, "valid": 0, "invalid": 0, "errors": [], "total_errors": 0}
+    for line in iter_range_lines(path, start, end, encoding_state):
+        result["lines"] += 1
+        valid, messages = validator.check(line)
+        if valid:
+            result["valid"] += 1
+            continue
+        result["invalid"] += 1
+        result["total_errors"] += len(messages)
+        room = MAX_ERRORS_REPORTED - len(result["errors"])
+        result["errors"].extend({"line": result["lines"], "message": m} for m in messages[:max(room, 0)])
+    result["valid_utf8"] = encoding_state["valid_utf8"]
+    return result
+
+
+def validate_sharded(input_path, options, workers):
+    """
+    prep_validate over an uncompressed file on a process pool. Line numbers
+    are rebased per range, so errors and counts match a sequential run.
+    Raises InvalidEncoding if validate_encoding is set and any byte range
+    is not valid UTF-8.
+    """
+    options = options or {}
+    ranges = newline_ranges(input_path, workers * RANGES_PER_WORKER)
+    total = valid = invalid = total_errors = 0
+    errors = []
+    valid_utf8 = True
+    for shard in run_shards(_validate_range, input_path, ranges, (options,), workers):
+        for err in shard["errors"]:
+            if len(errors) < MAX_ERRORS_REPORTED:
+                errors.append({"line": total + err["line"], "message": err["message"]})
+        total += shard["lines"]
+        valid += shard["valid"]
+        invalid += shard["invalid"]
+        total_errors += shard["total_errors"]
+        valid_utf8 = valid_utf8 and shard["valid_utf8"]
+
+    if options.get('validate_encoding', True) and not valid_utf8:
+        raise InvalidEncoding("File is not valid UTF-8 encoded")
+    return {
+        "success": True,
+        "total_count": total,
+        "valid_count": valid,
+        "invalid_count": invalid,
+        "success_rate": round(valid / total * 100, 2) if total > 0 else 0,
+        "errors": errors,
+        "total_errors": total_errors,
+        "stopped_early": False
+    }
+
+
+def validate_stream(input_path, options, max_records=0, max_errors=0):
+    """
+    prep_validate in one streaming pass: each line is decoded, parsed and
+    checked in turn, and only the first MAX_ERRORS_REPORTED messages are
+    kept, so memory stays constant. Stops after max_records lines or once
+    max_errors lines are invalid (0 = no limit). With validate_encoding,
+    raises InvalidEncoding at the first line that is not valid UTF-8.
+    """
+    options = options or {}
+    validate_encoding = options.get('validate_encoding', True)
+    validator = LineValidator(options)
+    total = valid = invalid = total_errors = 0
+    errors = []
+    stopped_early = False
+    with open(input_path, 'rb') as raw:
+        stream = gzip.GzipFile(fileobj=raw, mode='rb') if input_path.lower().endswith('.gz') else raw
+        for line, valid_utf8 in iter_checked_lines(stream):
+            if max_records > 0 and total >= max_records:
+                break
+            total += 1
+            if validate_encoding and not valid_utf8:
+                raise InvalidEncoding(f"File is not valid UTF-8 encoded (line {total})")
+            ok, messages = validator.check(line)
+            if ok:
+                valid += 1
+                continue
+            invalid += 1
+            total_errors += len(messages)
+            room = MAX_ERRORS_REPORTED - len(errors)
+            errors.extend({"line": total, "message": m} for m in messages[:max(room, 0)])
+            if max_errors > 0 and invalid >= max_errors:
+                stopped_early = True
+                break
+    return {
+        "success": True,
+        "total_count": total,
+        "valid_count": valid,
+        "invalid_count": invalid,
+        "success_rate": round(valid / total * 100, 2) if total > 0 else 0,
+        "errors": errors,
+        "total_errors": total_errors,
+        "stopped_early": stopped_early
+    }
+
+
+def _serialize_lines(lines):
+    records = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            records.append(json.dumps(fast_loads(line), ensure_ascii=False))
+        except ValueError:
+            pass
+    return records
+
+
+def _serialize_range(path, start, end):
+    return _serialize_lines(iter_range_lines(path, start, end))
+
+
+def load_serialized_records(input_path, workers=1):
+    """
+    Parse every record of a JSONL(.gz) file and return them re-serialized
+    (json.dumps, ensure_ascii=False) in file order, skipping bad lines.
+    Uncompressed files are parsed on a process pool when workers > 1.
+    """
+    if not can_shard(input_path, workers):
+        text, _ = open_jsonl_input(input_path)
+        with text:
+            return _serialize_lines(text)
+    records = []
+    ranges = newline_ranges(input_path, workers * RANGES_PER_WORKER)
+    for shard in run_shards(_serialize_range, input_path, ranges, (), workers):
+        records.extend(shard)
+    return records
+
+
+TEXT_FALLBACK_FIELDS = ('text', 'content', 'instruction', 'input', 'output')
+
+
+def extract_text(record, text_field='text'):
+    """Text to tokenize: text_field if present, else the first common text field."""
+    if isinstance(text_field, str) and text_field in record:
+        return str(record[text_field])
+    for field in TEXT_FALLBACK_FIELDS:
+        if field in record:
+            return str(record[field])
+    return ''
+
+
+def parse_split_ratios(splits=None, train_ratio=0.8):
+    """
+    Named split ratios as an ordered {name: fraction} summing to 1. Accepts
+    a {name: weight} mapping; without one, train/validation from train_ratio.
+    """
+    if not splits:
+        splits = {"train": train_ratio, "validation": 1 - train_ratio}
+    if not isinstance(splits, dict):
+        raise ValueError("splits must be an object of {name: ratio}")
+    ratios = {}
+    for name, weight in splits.items():
+        if not re.match(r'^[\w-]+$', str(name)):
+            raise ValueError(f"Invalid split name: {name}")
+        weight = float(weight)
+        if weight < 0:
+            raise ValueError(f"Split ratio for {name} must not be negative")
+        ratios[str(name)] = weight
+    total = sum(ratios.values())
+    if total <= 0:
+        raise ValueError("Split ratios must sum to more than 0")
+    return {name: weight / total for name, weight in ratios.items()}
+
+
+class HashSplitter:
+    """
+    Assigns records to named splits by a seeded hash, so the assignment of
+    a record never depends on input order or on the rest of the file. With
+    key_field, the hash covers only that field's value, so every record
+    sharing a key (same document, user, conversation...) lands in the same
+    split. Records missing the key are hashed whole and counted.
+    """
+
+    def __init__(self, splits, seed=42, key_field=None):
+        self.names = list(splits)
+        self.bounds = []
+        cumulative = 0.0
+        for name in self.names:
+            cumulative += splits[name]
+            self.bounds.append(cumulative)
+        self.bounds[-1] = 1.0
+        self.key = hashlib.blake2b(str(seed).encode('utf-8'), digest_size=32).digest()
+        self.key_field = key_field
+        self.missing_key = 0
+
+    def assign(self, record):
+        if self.key_field and isinstance(record, dict) and record.get(self.key_field) is not None:
+            value = record[self.key_field]
+        else:
+            if self.key_field:
+                self.missing_key += 1
+            value = record
+        raw = json.dumps(value, sort_keys=True, ensure_ascii=False)
+        digest = hashlib.blake2b(raw.encode('utf-8'), key=self.key, digest_size=8).digest()
+        position = int.from_bytes(digest, 'big') / 2**64
+        for name, bound in zip(self.names, self.bounds):
+            if position < bound:
+                return name
+        return self.names[-1]
+
+
+def _split_base(input_path, output_dir):
+    output_dir = output_dir or os.path.dirname(os.path.abspath(input_path)) or '.'
+    base_name = os.path.splitext(os.path.basename(input_path))[0]
+    if input_path.lower().endswith('.gz'):
+        base_name = base_name.replace('.jsonl', '')
+    return os.path.join(output_dir, base_name)
+
+
+def split_output_paths(input_path, output_dir, names):
+    base = _split_base(input_path, output_dir)
+    return {name: f"{base}_{name}.jsonl" for name in names}
+
+
+def split_index_path(input_path, output_dir):
+    return _split_base(input_path, output_dir) + '_splits.index.json'
+
+
+def _split_line(line, splitter, handles, counts):
+    line = line.strip()
+    if not line:
+        return
+    try:
+        record = fast_loads(line)
+    except ValueError:
+        counts["parse_errors"] += 1
+        return
+    name = splitter.assign(record)
+    handles[name].write(json.dumps(record, ensure_ascii=False) + '\n')
+    counts["splits"][name] += 1
+
+
+def _split_range(path, start, end, splits, seed, key_field, spill_dir):
+    splitter = HashSplitter(splits, seed, key_field)
+    counts = {"parse_errors": 0, "splits": {name: 0 for name in splits}}
+    spill_paths = {name: os.path.join(spill_dir, f"range_{start:016d}_{name}.jsonl") for name in splits}
+    handles = {name: open(p, 'w', encoding='utf-8') for name, p in spill_paths.items()}
+    try:
+        for line in iter_range_lines(path, start, end):
+            _split_line(line, splitter, handles, counts)
+    finally:
+        for handle in handles.values():
+            handle.close()
+    counts["spill_paths"] = spill_paths
+    counts["missing_key"] = splitter.missing_key
+    return counts
+
+
+def _split_summary(counts, files, missing_key, shard_index=None):
+    total = sum(counts["splits"].values())
+    return {
+        "type": "done",
+        "success": True,
+        "total_count": total,
+        "parse_errors": counts["parse_errors"],
+        "missing_key": missing_key,
+        "splits": {
+            name: {
+                "count": n,
+                "percent": round(n / total * 100, 1) if total else 0,
+                "file": files[name]
+            }
+            for name, n in counts["splits"].items()
+        },
+        **({"shard_index": shard_index} if shard_index else {})
+    }
+
+
+def iter_split(input_path, files, splits, seed=42, key_field=None, workers=1, shards=None, index_path=None):
+    """
+    Stream a JSONL(.gz) file into one file per named split (files maps
+    name -> path) with HashSplitter; memory is O(1). Uncompressed inputs
+    are split on a process pool when workers > 1: ranges write their own
+    per-split parts, which are appended in range order, so output matches
+    a single-process run. With shards, each split is written as shards
+    (file becomes the shard prefix) and one index at index_path covers
+    all splits.
+    Yields progress events, then a summary.
+    """
+    counts = {"parse_errors": 0, "splits": {name: 0 for name in splits}}
+    total_bytes = os.path.getsize(input_path)
+    for path in files.values():
+        os.makedirs(os.path.dirname(os.path.abspath(path)) or '.', exist_ok=True)
+    sharded = None
+    if shards:
+        sharded = ShardedOutput(shards, index_path, input_path)
+        files = {name: strip_jsonl_extension(path) for name, path in files.items()}
+        handles = {name: sharded.writer(name, files[name]) for name in splits}
+    else:
+        handles = {name: open(files[name], 'w', encoding='utf-8') for name in splits}
+    missing_key = 0
+    completed = False
+    try:
+        if can_shard(input_path, workers):
+            ranges = newline_ranges(input_path, workers * RANGES_PER_WORKER)
+            spill_root = os.path.dirname(os.path.abspath(next(iter(files.values()))))
+            with tempfile.TemporaryDirectory(prefix='.xtools_split_', dir=spill_root) as spill_dir:
+                results = run_shards(_split_range, input_path, ranges, (splits, seed, key_field, spill_dir), workers)
+                for (start, end), shard in zip(ranges, results):
+                    counts["parse_errors"] += shard["parse_errors"]
+                    missing_key += shard["missing_key"]
+                    for name, path in shard["spill_paths"].items():
+                        counts["splits"][name] += shard["splits"][name]
+                        with open(path, 'r', encoding='utf-8', newline='\n') as part:
+                            handles[name].writelines(part)
+                        os.remove(path)
+                    yield {"type": "progress", "bytes_read": end, "total_bytes": total_bytes,
+                           "records_written": sum(counts["splits"].values())}
+        else:
+            splitter = HashSplitter(splits, seed, key_field)
+            text, raw = open_jsonl_input(input_path)
+            with text:
+                last_report = time.monotonic()
+                for line in text:
+                    _split_line(line, splitter, handles, counts)
+                    now = time.monotonic()
+                    if now - last_report >= PROGRESS_INTERVAL_SECONDS:
+                        last_report = now
+                        yield {"type": "progress", "bytes_read": raw.tell(), "total_bytes": total_bytes,
+                               "records_written": sum(counts["splits"].values())}
+            missing_key = splitter.missing_key
+        completed = True
+    finally:
+        if sharded is None:
+            for handle in handles.values():
+                handle.close()
+        elif not completed:
+            sharded.executor.shutdown(wait=True)
+
+    shard_index = {"path": sharded.index_path, **sharded.close()} if sharded else None
+    yield _split_summary(counts, files, missing_key, shard_index)
+
+
+# --- Sharded output ---
+
+SHARD_FORMATS = ('jsonl', 'jsonl.gz', 'parquet')
+DEFAULT_SHARD_BYTES = 256 * 1024**2
+SHARD_WRITER_THREADS = 4
+
+
+class _ShardSource:
+    """Minimal ConvertInput stand-in so convert_utils can encode an in-memory shard."""
+
+    def __init__(self, data):
+        self._file = io.BytesIO(data)
+
+    def handle(self):
+        self._file.seek(0)
+        return self._file
+
+
+def _encode_shard(path, fmt, data, schema=None):
+    # Runs on a writer thread. zlib releases the GIL while compressing;
+    # Parquet shards re-parse their JSON lines in Python, so they mostly hold it
+    tmp = path + '.tmp'
+    if fmt == 'parquet':
+        from convert_utils import write_jsonl_parquet
+        write_jsonl_parquet(_ShardSource(data), tmp, is_gz=False, schema=schema)
+    else:
+        with open(tmp, 'wb') as f:
+            f.write(gzip.compress(data, compresslevel=6, mtime=0) if fmt == 'jsonl.gz' else data)
+    os.replace(tmp, path)
+    return os.path.getsize(path)
+
+
+def parse_shard_options(options):
+    """Validate a request's shards option; returns None when sharding is off."""
+    if not options:
+        return None
+    fmt = options.get('format', 'jsonl.gz')
+    if fmt not in SHARD_FORMATS:
+        raise ValueError(f"Shard format must be one of {', '.join(SHARD_FORMATS)}")
+    max_records = int(options['max_records']) if options.get('max_records') else None
+    max_bytes = int(options['max_bytes']) if options.get('max_bytes') else None
+    if max_records is not None and max_records < 1 or max_bytes is not None and max_bytes < 1:
+        raise ValueError("Shard max_records and max_bytes must be positive")
+    if max_records is None and max_bytes is None:
+        max_bytes = DEFAULT_SHARD_BYTES
+    return {
+        "format": fmt,
+        "max_records": max_records,
+        "max_bytes": max_bytes,
+        "threads": max(1, int(options.get('threads', SHARD_WRITER_THREADS)))
+    }
+
+
+class ShardedWriter:
+    """
+    Line sink that cuts its output into numbered shards of at most
+    max_records lines / max_bytes uncompressed bytes. Full shards are
+    encoded (gzip, Parquet or plain) and written by a shared thread pool
+    while the caller keeps producing; at most `pending` shards per writer
+    are buffered in memory. write() must be given whole lines.
+    """
+
+    def __init__(self, prefix, shard_options, executor, pending=2, schema=None):
+        self.prefix = prefix
+        self.schema = schema
+        self.format = shard_options["format"]
+        self.max_records = shard_options["max_records"]
+        self.max_bytes = shard_options["max_bytes"]
+        self.executor = executor
+        self.slots = threading.BoundedSemaphore(pending)
+        self.shards = []
+        self.futures = []
+        self.buffer = []
+        self.buffer_records = 0
+        self.buffer_bytes = 0
+
+    def write(self, line):
+        data = line.encode('utf-8')
+        self.buffer.append(data)
+        self.buffer_records += 1
+        self.buffer_bytes += len(data)
+        if (self.max_records and self.buffer_records >= self.max_records
+                or self.max_bytes and self.buffer_bytes >= self.max_bytes):
+            self._flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        path = f"{self.prefix}-{len(self.shards):05d}.{self.format}"
+        data = b''.join(self.buffer)
+        self.shards.append({"path": path, "records": self.buffer_records, "uncompressed_bytes": len(data)})
+        self.buffer, self.buffer_records, self.buffer_bytes = [], 0, 0
+        self.slots.acquire()
+        future = self.executor.submit(_encode_shard, path, self.format, data, self.schema)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def close(self):
+        self._flush()
+        for shard, future in zip(self.shards, self.futures):
+            shard["bytes"] = future.result()
+        return self.shards
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShardedOutput:
+    """
+    A set of ShardedWriters (one per split, or one for prep_clean) sharing
+    a writer thread pool. close() waits for every shard and writes the
+    shard index JSON listing each output's shards and record counts.
+    Parquet shards are written with one schema, inferred up front from
+    schema_source, so the set reads back as a single dataset.
+    """
+
+    def __init__(self, shard_options, index_path, schema_source=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.options = shard_options
+        self.index_path = index_path
+        self.schema = None
+        if shard_options["format"] == 'parquet' and schema_source:
+            from convert_utils import infer_jsonl_schema
+            schema, _ = infer_jsonl_schema(schema_source, schema_source.lower().endswith('.gz'))
+            self.schema = schema if len(schema) else None
+        self.executor = ThreadPoolExecutor(max_workers=shard_options["threads"])
+        self.writers = {}
+
+    def writer(self, name, prefix):
+        os.makedirs(os.path.dirname(os.path.abspath(prefix)) or '.', exist_ok=True)
+        self.writers[name] = ShardedWriter(prefix, self.options, self.executor, schema=self.schema)
+        return self.writers[name]
+
+    def close(self):
+        try:
+            outputs = {}
+            for name, writer in self.writers.items():
+                shards = writer.close()
+                outputs[name] = {
+                    "records": sum(s["records"] for s in shards),
+                    "shards": [{**s, "path": os.path.basename(s["path"])} for s in shards]
+                }
+        finally:
+            self.executor.shutdown(wait=True)
+        index = {
+            "format": self.options["format"],
+            "total_records": sum(o["records"] for o in outputs.values()),
+            "outputs": outputs
+        }
+        with open(self.index_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, indent=2)
+        return index
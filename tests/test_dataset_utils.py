@@ -0,0 +1,29 @@
+import csv
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dataset_utils import external_dedup, profile_dataset
+
+
+def test_external_dedup_keeps_full_float_precision(tmp_path):
+    source = tmp_path / "floats.csv"
+    source.write_text("id,value\n1,0.123456789012345\n1,0.123456789012399\n1,0.123456789012345\n")
+    output = tmp_path / "floats_cleaned.csv"
+
+    result = external_dedup(str(source), str(output))
+
+    assert result["initial_rows"] == 3
+    assert result["cleaned_rows"] == 2
+    with open(output, newline='') as f:
+        values = [row["value"] for row in csv.DictReader(f)]
+    assert values == ["0.123456789012345", "0.123456789012399"]
+
+
+def test_profile_sample_keeps_full_float_precision(tmp_path):
+    source = tmp_path / "floats.jsonl"
+    source.write_text(json.dumps({"value": 0.123456789012399}) + "\n")
+
+    assert profile_dataset(str(source))["sample"] == [{"value": 0.123456789012399}]
@@ -0,0 +1,546 @@
+"""
+Tokenizer loading and token statistics for the Data Preparation endpoints.
+"""
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from file_utils import last_byte, tail_hash
+from prep_utils import fast_loads, open_jsonl_input, extract_text, PROGRESS_INTERVAL_SECONDS
+
+# Loaded tokenizers kept in memory (override with XTOOLS_TOKENIZER_CACHE_* env vars)
+TOKENIZER_CACHE_MAX_ENTRIES = int(os.environ.get('XTOOLS_TOKENIZER_CACHE_MAX_ENTRIES', 8))
+TOKENIZER_CACHE_MAX_BYTES = int(os.environ.get('XTOOLS_TOKENIZER_CACHE_MAX_BYTES', 2 * 1024**3))
+# Comma separated model_base[@revision] list loaded in the background at startup
+TOKENIZER_WARMUP = os.environ.get('XTOOLS_TOKENIZER_WARMUP', '')
+# Size guess per vocabulary entry for tokenizers that cannot be serialized
+SLOW_TOKENIZER_BYTES_PER_TOKEN = 256
+# Texts per tokenizer call in full-dataset mode, and parsed batches buffered ahead of it
+TOKENIZE_BATCH_ROWS = 2048
+TOKENIZE_READ_AHEAD = 4
+DEFAULT_HISTOGRAM_BINS = 20
+TOKEN_CACHE_MAX_ENTRIES = 100
+
+
+def load_tokenizer(model_base, revision=None):
+    """AutoTokenizer.from_pretrained; raises ImportError when transformers is missing."""
+    from transformers import AutoTokenizer
+    kwargs = {"trust_remote_code": True}
+    if revision:
+        kwargs["revision"] = revision
+    return AutoTokenizer.from_pretrained(model_base, **kwargs)
+
+
+def estimate_tokenizer_bytes(tokenizer):
+    """
+    Rough in-memory size of a tokenizer: the length of its serialized
+    definition for fast (Rust) tokenizers, a per-token guess otherwise.
+    """
+    backend = getattr(tokenizer, 'backend_tokenizer', None)
+    if backend is not None:
+        try:
+            return len(backend.to_str())
+        except Exception:
+            pass
+    try:
+        return len(tokenizer) * SLOW_TOKENIZER_BYTES_PER_TOKEN
+    except Exception:
+        return 0
+
+
+def parse_warmup_list(value):
+    """'org/a, org/b@main' -> [("org/a", None), ("org/b", "main")]"""
+    specs = []
+    for item in (value or '').split(','):
+        item = item.strip()
+        if item:
+            model_base, _, revision = item.partition('@')
+            specs.append((model_base, revision or None))
+    return specs
+
+
+class SharedTokenizer:
+    """
+    A cached tokenizer shared by request threads. Calls into it are
+    serialized by one lock: fast tokenizers set truncation/padding on the
+    Rust backend per call and raise "Already borrowed" when two threads
+    encode at once.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.lock = threading.Lock()
+
+    def encode(self, text, **kwargs):
+        with self.lock:
+            return self.tokenizer.encode(text, **kwargs)
+
+    def convert_ids_to_tokens(self, ids):
+        with self.lock:
+            return self.tokenizer.convert_ids_to_tokens(ids)
+
+
+class TokenizerCache:
+    """
+    Process-wide LRU of loaded tokenizers keyed by (model_base, revision).
+    Entries are evicted least-recently-used once there are more than
+    max_entries or their estimated size exceeds max_bytes. Concurrent
+    requests for the same tokenizer wait for a single load.
+
+    get() hands every thread the same SharedTokenizer, whose calls hold a
+    per-tokenizer lock; use it through its methods and token_lengths(),
+    never through the wrapped .tokenizer directly.
+    """
+
+    def __init__(self, max_entries=TOKENIZER_CACHE_MAX_ENTRIES, max_bytes=TOKENIZER_CACHE_MAX_BYTES,
+                 loader=load_tokenizer):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._entries = OrderedDict()
+        self._total = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model_base, revision=None):
+        """Return (tokenizer, 'hit' | 'miss'), loading it on a miss."""
+        key = (model_base, revision or None)
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry["last_used"] = time.time()
+                    self.hits += 1
+                    return entry["tokenizer"], 'hit'
+                pending = self._loading.get(key)
+                if pending is None:
+                    pending = self._loading[key] = threading.Event()
+                    break
+            # Another request is loading this tokenizer; use its result (or retry if it failed)
+            pending.wait()
+
+        try:
+            started = time.perf_counter()
+            tokenizer = self._loader(model_base, revision)
+            load_seconds = time.perf_counter() - started
+            size = estimate_tokenizer_bytes(tokenizer)
+            with self._lock:
+                self.misses += 1
+                tokenizer = SharedTokenizer(tokenizer)
+                self._entries[key] = {"tokenizer": tokenizer, "size": size,
+                                      "load_seconds": round(load_seconds, 3), "last_used": time.time()}
+                self._total += size
+                self._evict()
+            return tokenizer, 'miss'
+        finally:
+            with self._lock:
+                self._loading.pop(key).set()
+
+    def _evict(self):
+        # The newest entry is always kept, even when it alone exceeds max_bytes
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self._total > self.max_bytes):
+            _, old = self._entries.popitem(last=False)
+            self._total -= old["size"]
+
+    def warm(self, specs):
+        """Load [(model_base, revision)] now; failures are logged and skipped."""
+        for model_base, revision in specs:
+            try:
+                self.get(model_base, revision)
+            except Exception as e:
+                print(f"Tokenizer warm-up failed for {model_base}: {e}")
+
+    def warm_async(self, specs):
+        """Run warm() on a background thread so startup is not blocked."""
+        if not specs:
+            return None
+        thread = threading.Thread(target=self.warm, args=(list(specs),), daemon=True)
+        thread.start()
+        return thread
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total = 0
+        return {"success": True, "message": "Tokenizer cache cleared"}
+
+    def status(self):
+        with self._lock:
+            return {
+                "entries": [
+                    {"model_base": key[0], "revision": key[1], "estimated_bytes": entry["size"],
+                     "load_seconds": entry["load_seconds"]}
+                    for key, entry in self._entries.items()
+                ],
+                "total_bytes": self._total,
+                "max_bytes": self.max_bytes,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+def token_lengths(tokenizer, texts):
+    """
+    Token count of each text, without special tokens. Fast tokenizers
+    encode the whole batch in the Rust backend, which spreads it over all
+    cores (RAYON_NUM_THREADS) and skips building Python id lists.
+    A SharedTokenizer is encoded under its lock.
+    """
+    if isinstance(tokenizer, SharedTokenizer):
+        with tokenizer.lock:
+            return token_lengths(tokenizer.tokenizer, texts)
+    backend = getattr(tokenizer, 'backend_tokenizer', None)
+    if backend is not None:
+        return [len(encoding) for encoding in backend.encode_batch(texts, add_special_tokens=False)]
+    return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+
+class TokenLengths:
+    """Growable uint32 array of per-line token counts (0 for lines without text)."""
+
+    def __init__(self, capacity=1024):
+        self._data = np.zeros(capacity, dtype=np.uint32)
+        self.size = 0
+
+    def extend(self, values):
+        needed = self.size + len(values)
+        if needed > len(self._data):
+            grown = np.zeros(max(needed, len(self._data) * 2), dtype=np.uint32)
+            grown[:self.size] = self._data[:self.size]
+            self._data = grown
+        self._data[self.size:needed] = values
+        self.size = needed
+
+    def array(self):
+        return self._data[:self.size]
+
+
+def token_length_summary(lengths, max_length=None, bins=DEFAULT_HISTOGRAM_BINS):
+    """
+    Statistics over the non-zero entries of a per-line token length array:
+    totals, p50/p95/p99, a histogram of about `bins` equal-width bins and,
+    with max_length, how many records exceed the context limit.
+    """
+    counted = lengths[lengths > 0]
+    result = {
+        "text_records": int(len(counted)),
+        "total_tokens": int(counted.sum(dtype=np.uint64)) if len(counted) else 0,
+        "max_tokens": int(counted.max()) if len(counted) else 0,
+        "min_tokens": int(counted.min()) if len(counted) else 0,
+        "avg_tokens": round(float(counted.mean()), 2) if len(counted) else 0,
+        "percentiles": {},
+        "histogram": []
+    }
+    if len(counted):
+        p50, p95, p99 = np.percentile(counted, [50, 95, 99])
+        result["percentiles"] = {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+        # Integer-width bins from min to max, so every bin is an exact token range
+        low = result["min_tokens"]
+        width = max(1, -(-(result["max_tokens"] - low + 1) // max(1, int(bins))))
+        counts = np.bincount((counted - low) // width)
+        result["histogram"] = [
+            {"min": low + i * width, "max": low + (i + 1) * width - 1, "count": int(n)}
+            for i, n in enumerate(counts)
+        ]
+    if max_length:
+        over = int(np.count_nonzero(counted > max_length))
+        result["max_length"] = int(max_length)
+        result["over_max_length"] = over
+        result["over_max_length_percent"] = round(over / len(counted) * 100, 2) if len(counted) else 0
+    return result
+
+
+def _read_text_batches(input_path, text_field, batch_rows, batches, stop, start_offset=0, end_offset=None):
+    """
+    Reader thread: parse lines and put (texts, text_line_indexes, lines,
+    records, parse_errors, bytes_read) batches on the queue, then None.
+    An exception is put on the queue in place of a batch.
+    """
+    try:
+        text, raw = open_jsonl_input(input_path, start_offset, end_offset)
+        with text:
+            texts, indexes, lines, records, errors = [], [], 0, 0, 0
+            for line in text:
+                if stop.is_set():
+                    return
+                if line.strip():
+                    try:
+                        record = fast_loads(line)
+                        records += 1
+                        value = extract_text(record, text_field) if isinstance(record, dict) else ''
+                        if value:
+                            texts.append(value)
+                            indexes.append(lines)
+                    except ValueError:
+                        errors += 1
+                lines += 1
+                if lines >= batch_rows:
+                    batches.put((texts, indexes, lines, records, errors, raw.tell()))
+                    texts, indexes, lines, records, errors = [], [], 0, 0, 0
+            if lines:
+                batches.put((texts, indexes, lines, records, errors, raw.tell()))
+        batches.put(None)
+    except Exception as e:
+        batches.put(e)
+
+
+def iter_token_stats(input_path, tokenizer, text_field='text', max_length=None, bins=DEFAULT_HISTOGRAM_BINS,
+                     batch_rows=TOKENIZE_BATCH_ROWS, preview=0, lengths=None, start_offset=0, end_offset=None):
+    """
+    Tokenize every record of a JSONL(.gz) file, or of the lines between
+    start_offset and end_offset (uncompressed only). A reader thread parses
+    batches ahead while the tokenizer encodes the current one. Yields
+    progress events, then a {"type": "done", ...} summary. Per-line counts
+    are collected in `lengths` (a TokenLengths) when given.
+    """
+    started = time.perf_counter()
+    lengths = lengths if lengths is not None else TokenLengths()
+    total_bytes = end_offset if end_offset is not None else os.path.getsize(input_path)
+    counts = {"lines": 0, "records": 0, "parse_errors": 0, "tokens": 0}
+    previews = []
+    batches = queue.Queue(maxsize=TOKENIZE_READ_AHEAD)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_text_batches,
+                              args=(input_path, text_field, batch_rows, batches, stop, start_offset, end_offset),
+                              daemon=True)
+    reader.start()
+    last_report = time.monotonic()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            texts, indexes, lines, records, errors, bytes_read = batch
+            values = np.zeros(lines, dtype=np.uint32)
+            if texts:
+                values[indexes] = token_lengths(tokenizer, texts)
+                for text in texts[:preview - len(previews)]:
+                    ids = tokenizer.encode(text, add_special_tokens=False)
+                    previews.append(tokenizer.convert_ids_to_tokens(ids[:20]))
+            lengths.extend(values)
+            counts["lines"] += lines
+            counts["records"] += records
+            counts["parse_errors"] += errors
+            counts["tokens"] += int(values.sum(dtype=np.uint64))
+
+            now = time.monotonic()
+            if now - last_report >= PROGRESS_INTERVAL_SECONDS:
+                last_report = now
+                elapsed = time.perf_counter() - started
+                yield {
+                    "type": "progress",
+                    "bytes_read": bytes_read,
+                    "total_bytes": total_bytes,
+                    "records": counts["records"],
+                    "total_tokens": counts["tokens"],
+                    "records_per_second": round(counts["records"] / elapsed, 1) if elapsed else 0
+                }
+    finally:
+        stop.set()
+        # Unblock a reader waiting on a full queue so it can see the stop flag
+        while reader.is_alive():
+            try:
+                batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    result = {
+        "type": "done",
+        "success": True,
+        "mode": "full",
+        "record_count": counts["records"],
+        "total_lines": counts["lines"],
+        "parse_errors": counts["parse_errors"],
+        "text_field": text_field,
+        **token_length_summary(lengths.array(), max_length, bins),
+        "seconds": round(time.perf_counter() - started, 3)
+    }
+    if previews:
+        result["preview"] = previews
+    yield result
+
+
+class TokenLengthCache:
+    """
+    Per-line token lengths persisted as raw uint32 sidecar files keyed by
+    (path, tokenizer, revision, text_field) and checked against the file's
+    size and mtime. Readers memory-map the array instead of tokenizing.
+    For uncompressed JSONL that has only been appended to (old tail
+    unchanged), just the new lines are tokenized and appended.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=TOKEN_CACHE_MAX_ENTRIES):
+        self.cache_dir = cache_dir or os.path.join(os.getcwd(), '.xtools_token_cache')
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def _entry_base(self, path, model_base, revision, text_field):
+        raw = json.dumps([path, model_base, revision or None, text_field])
+        return os.path.join(self.cache_dir, hashlib.sha1(raw.encode('utf-8')).hexdigest())
+
+    def _read_meta(self, base):
+        try:
+            with open(base + '.json', 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def _mapped(self, base, meta):
+        """The sidecar array as a read-only memmap, or None if it does not match meta."""
+        array_path = base + '.u32'
+        try:
+            if os.path.getsize(array_path) != meta["lines"] * 4:
+                return None
+        except OSError:
+            return None
+        if meta["lines"] == 0:
+            return np.zeros(0, dtype=np.uint32)
+        return np.memmap(array_path, dtype=np.uint32, mode='r', shape=(meta["lines"],))
+
+    def _evict(self):
+        entries = [os.path.join(self.cache_dir, n) for n in os.listdir(self.cache_dir) if n.endswith('.json')]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - self.max_entries]:
+            for stale in (path, path[:-len('.json')] + '.u32'):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+
+    def load(self, file_path, model_base, revision=None, text_field='text'):
+        """Memory-mapped per-line token lengths of an unchanged file, or None."""
+        path = os.path.abspath(file_path)
+        stat = os.stat(path)
+        base = self._entry_base(path, model_base, revision, text_field)
+        meta = self._read_meta(base)
+        if meta and meta["size"] == stat.st_size and meta["mtime"] == stat.st_mtime_ns:
+            return self._mapped(base, meta)
+        return None
+
+    def iter_lengths(self, file_path, load_tokenizer, model_base, revision=None, text_field='text', preview=0):
+        """
+        Bring the sidecar up to date, yielding tokenization progress events.
+        Returns (lengths, meta, status, preview) where status is 'hit'
+        (nothing tokenized), 'incremental' (only appended lines tokenized)
+        or 'miss'. load_tokenizer() is only called when tokenizing.
+        """
+        path = os.path.abspath(file_path)
+        stat = os.stat(path)
+        size, mtime = stat.st_size, stat.st_mtime_ns
+        base = self._entry_base(path, model_base, revision, text_field)
+        meta = self._read_meta(base)
+
+        if meta and meta["size"] == size and meta["mtime"] == mtime:
+            lengths = self._mapped(base, meta)
+            if lengths is not None:
+                return lengths, meta, 'hit', None
+
+        status, start_offset, previous = 'miss', 0, None
+        appendable = path.lower().endswith('.jsonl')
+        if (meta and appendable and meta.get("appendable") and 0 < meta["size"] < size
+                and meta.get("tail_hash") == tail_hash(path, meta["size"])):
+            previous = self._mapped(base, meta)
+            if previous is not None:
+                status, start_offset = 'incremental', meta["size"]
+
+        new = TokenLengths()
+        done = None
+        # Stop at the size stat'ed above so the sidecar covers exactly the bytes recorded in meta
+        for event in iter_token_stats(path, load_tokenizer(), text_field, preview=preview, lengths=new,
+                                      start_offset=start_offset, end_offset=size if appendable else None):
+            if event["type"] == "done":
+                done = event
+            else:
+                yield event
+
+        counts = {"lines": done["total_lines"], "records": done["record_count"], "parse_errors": done["parse_errors"]}
+        if status == 'incremental':
+            for key in counts:
+                counts[key] += meta[key]
+        meta = {
+            "path": path,
+            "size": size,
+            "mtime": mtime,
+            "tokenizer": model_base,
+            "revision": revision or None,
+            "text_field": text_field,
+            # Resuming is only safe from a line boundary
+            "appendable": appendable and last_byte(path, size) == b'\n',
+            "tail_hash": tail_hash(path, size) if appendable else None,
+            **counts
+        }
+        self._write(base, meta, new.array(), append=status == 'incremental')
+        lengths = self._mapped(base, meta)
+        if lengths is None:
+            # Sidecar could not be written; fall back to the in-memory counts
+            lengths = new.array() if previous is None else np.concatenate([previous, new.array()])
+        return lengths, meta, status, done.get("preview")
+
+    def iter_stats(self, file_path, tokenizer, model_base, revision=None, text_field='text', max_length=None,
+                   bins=DEFAULT_HISTOGRAM_BINS, preview=0):
+        """iter_token_stats through the sidecar; the done event carries token_cache."""
+        started = time.perf_counter()
+        lengths, meta, status, previews = yield from self.iter_lengths(file_path, lambda: tokenizer, model_base,
+                                                                       revision, text_field, preview)
+        result = self._done(meta, lengths, text_field, max_length, bins, status, started)
+        if previews:
+            result["preview"] = previews
+        yield result
+
+    def _write(self, base, meta, values, append=False):
+        with self._lock:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                array_path = base + '.u32'
+                if append:
+                    with open(array_path, 'r+b') as f:
+                        f.seek(0, os.SEEK_END)
+                        f.write(values.tobytes())
+                else:
+                    tmp = array_path + '.tmp'
+                    values.tofile(tmp)
+                    os.replace(tmp, array_path)
+                tmp = base + '.json.tmp'
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(meta, f)
+                os.replace(tmp, base + '.json')
+                self._evict()
+            except Exception as e:
+                print(f"Error saving token length sidecar: {e}")
+
+    def _done(self, meta, lengths, text_field, max_length, bins, status, started):
+        return {
+            "type": "done",
+            "success": True,
+            "mode": "full",
+            "record_count": meta["records"],
+            "total_lines": meta["lines"],
+            "parse_errors": meta["parse_errors"],
+            "text_field": text_field,
+            **token_length_summary(lengths, max_length, bins),
+            "token_cache": status,
+            "seconds": round(time.perf_counter() - started, 3)
+        }
+
+    def clear(self):
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+        return {"success": True, "message": "Token length cache cleared"}